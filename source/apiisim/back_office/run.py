@@ -379,6 +379,24 @@ def compute_mis_connections(db_session, stats):
     stats.nb_deleted_mis_connections = nb_deleted
 
 
+"""
+Refresh transfer_mis materialized view, used by the planner to retrieve
+transfers between 2 MIS, so that it matches transfers computed by this import.
+The view is refreshed concurrently (which requires its unique index), so that
+planner reads are not blocked meanwhile. A view that has never been populated
+cannot be refreshed concurrently, it is then populated the usual way.
+"""
+@db_transaction
+def refresh_transfer_mis(db_session):
+    logging.info("Refreshing transfer_mis...")
+    populated = db_session.execute("SELECT ispopulated FROM pg_matviews "
+                                   "WHERE matviewname = 'transfer_mis'").scalar()
+    if populated:
+        db_session.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY transfer_mis")
+    else:
+        db_session.execute("REFRESH MATERIALIZED VIEW transfer_mis")
+
+
 def get_config():
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", help="Configuration file")
@@ -435,6 +453,7 @@ def main():
         retrieve_all_stops(db_session, import_stats)
         compute_transfers(db_session, transfer_max_distance, orig_nb_transfers, import_stats)
         compute_mis_connections(db_session, import_stats)
+        refresh_transfer_mis(db_session)
     except:
         db_session.rollback()
         import_stats.result = "fail"
@@ -1,10 +1,12 @@
 import re
-from datetime import timedelta
+from datetime import datetime, timedelta
 from mis_plan_trip import LocationContextType, LocationStructure
 
 
 # Encoding used when converting objects to strings
 OUTPUT_ENCODING = "utf-8"
+# Format of dates exchanged with clients and MIS translators
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
 
 def parse_location_context(location, has_AccessTime=True):
     ret = LocationContextType()
@@ -38,20 +40,35 @@ def timedelta_to_xsd_duration(delta):
     return ret
 
 
+_XSD_DURATION_REGEX = re.compile('P(?:(?P<years>\d+)Y)?(?:(?P<months>\d+)M)?'
+                                 '(?:(?P<days>\d+)D)?(?:T(?:(?P<hours>\d+)H)?'
+                                 '(?:(?P<minutes>\d+)M)?(?:(?P<seconds>\d+)S)?)?')
+
 def xsd_duration_to_timedelta(duration):
-    regex  = re.compile('P(?:(?P<years>\d+)Y)?(?:(?P<months>\d+)M)?'
-                        '(?:(?P<days>\d+)D)?(?:T(?:(?P<hours>\d+)H)?(?:(?P<minutes>\d+)M)?'
-                        '(?:(?P<seconds>\d+)S)?)?')
-    duration = regex.match(duration).groupdict(0)
-    delta = timedelta(days=int(duration['days']) + (int(duration['months']) * 30) \
-                           + (int(duration['years']) * 365),
-                      hours=int(duration['hours']),
-                      minutes=int(duration['minutes']),
-                      seconds=int(duration['seconds']))
+    years, months, days, hours, minutes, seconds = \
+        _XSD_DURATION_REGEX.match(duration).groups(0)
+    delta = timedelta(days=int(days) + (int(months) * 30) + (int(years) * 365),
+                      hours=int(hours),
+                      minutes=int(minutes),
+                      seconds=int(seconds))
 
     return delta
 
 
+_DATETIME_REGEX = re.compile('(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})$')
+
+"""
+    Same as datetime.strptime(string, DATE_FORMAT), but faster for strings
+    having exactly that format (other strings go through strptime()).
+"""
+def parse_datetime(string):
+    match = _DATETIME_REGEX.match(string)
+    if match is None:
+        return datetime.strptime(string, DATE_FORMAT)
+    year, month, day, hour, minute, second = match.groups()
+    return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))
+
+
 def string_to_bool(string):
     if string in ["True", "true", "TRUE"]:
         return True
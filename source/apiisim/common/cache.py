@@ -0,0 +1,75 @@
+"""
+    Generic in-memory caches shared between threads.
+"""
+import threading, time
+from collections import OrderedDict
+
+
+"""
+    Thread-safe dictionary holding at most max_size entries. When full, the
+    least recently used entry is evicted. If ttl is given, entries expire ttl
+    seconds after having been put.
+    Cached values are shared by all callers, so they should be immutable.
+"""
+class LruCache(object):
+    def __init__(self, max_size, ttl=None):
+        if max_size < 1:
+            raise ValueError("max_size must be > 0")
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = OrderedDict() # {key : (value, expiration time or None)}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    """
+        Return value associated to key, or default if there is none.
+    """
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                self._misses += 1
+                return default
+            if entry[1] is not None and entry[1] <= time.time():
+                self._misses += 1
+                return default
+            # Move entry to the end (most recently used).
+            self._entries[key] = entry
+            self._hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        expiration = (time.time() + self._ttl) if self._ttl is not None else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expiration)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    """
+        Remove entries whose key matches predicate, return the number of
+        removed entries.
+    """
+    def purge(self, predicate):
+        with self._lock:
+            keys = [x for x in self._entries if predicate(x)]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    """
+        Return (number of hits, number of misses).
+    """
+    def get_stats(self):
+        with self._lock:
+            return self._hits, self._misses
@@ -0,0 +1,52 @@
+"""
+    Cancellation of long running operations, possibly from another thread.
+"""
+import logging, threading
+
+
+class CancelledError(Exception):
+    def __init__(self, message="Operation cancelled"):
+        Exception.__init__(self, message)
+
+
+"""
+    Shared between the thread that may cancel an operation and the threads
+    running it. Callbacks registered by the latter (e.g. to close a socket
+    they are blocked on) are called by cancel(), in the cancelling thread.
+"""
+class CancelToken(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.cancelled = False
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logging.exception("<CancelToken> Error in callback %s", callback)
+
+    # Register callback, it is called immediately if token is already cancelled.
+    def add_callback(self, callback):
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    # Raise CancelledError if token has been cancelled.
+    def check(self):
+        if self.cancelled:
+            raise CancelledError()
@@ -0,0 +1,162 @@
+"""
+    Process-wide pool of threads running independent calls concurrently,
+    typically MIS requests sent by the mis_translator to answer a single
+    request (one per departure/arrival pair for instance).
+
+    Calls are submitted in batches with FanOutExecutor.map(), which returns
+    their results in the order of the given arguments, whatever the order in
+    which they complete. Every batch has a key (a Navitia coverage for
+    instance): at most max_per_key calls with the same key run at the same
+    time, so that a large batch cannot flood a MIS, and batches waiting for a
+    thread are served in a round-robin fashion.
+"""
+import logging, sys, threading
+from collections import deque
+
+
+class _Batch(object):
+    def __init__(self, key, func, args_list):
+        self.key = key
+        self.func = func
+        self.pending = deque(enumerate(args_list)) # [(index, args)]
+        self.results = [None] * len(args_list)
+        self.remaining = len(args_list)
+        # (index, exc_info) of the failed call with the lowest index.
+        self.error = None
+        self.done = threading.Event()
+
+
+class FanOutExecutor(object):
+    DEFAULT_SIZE = 32
+    # Default maximum number of calls with the same key running at the same time
+    DEFAULT_MAX_PER_KEY = 8
+
+    def __init__(self, size=DEFAULT_SIZE, max_per_key=DEFAULT_MAX_PER_KEY):
+        self._size = max(1, size)
+        self._max_per_key = max(1, max_per_key)
+        self._cond = threading.Condition()
+        # Batches that still have pending calls, in round-robin order.
+        self._batches = deque()
+        self._running = {} # {key : number of running calls}
+        self._threads = []
+        self._stopped = False
+
+    def _start(self):
+        for i in range(self._size):
+            t = threading.Thread(target=self._worker_loop, name="FanOut-%s" % i)
+            t.daemon = True
+            self._threads.append(t)
+            t.start()
+        logging.info("<FanOutExecutor> %s threads started", self._size)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    """
+        Call func(*args) for every args tuple of args_list, and return the
+        list of results, in the same order. If some calls raise an exception,
+        calls not started yet are dropped and the exception raised by the
+        failed call with the lowest index is raised again.
+    """
+    def map(self, key, func, args_list):
+        if not args_list:
+            return []
+        batch = _Batch(key, func, args_list)
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("FanOutExecutor stopped")
+            if not self._threads:
+                self._start()
+            self._batches.append(batch)
+            self._cond.notify_all()
+        batch.done.wait()
+
+        if batch.error:
+            exc_info = batch.error[1]
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return batch.results
+
+    def get_stats(self):
+        with self._cond:
+            return {"size" : self._size,
+                    "batches" : len(self._batches),
+                    "pending" : sum([len(x.pending) for x in self._batches]),
+                    "running" : sum(self._running.values())}
+
+    # Must be called with self._cond acquired. Return (batch, index, args) of
+    # the next call to run, (None, None, None) if there is none or if all
+    # batches that have pending calls already run max_per_key calls.
+    def _next_call(self):
+        for _ in range(len(self._batches)):
+            batch = self._batches.popleft()
+            self._batches.append(batch)
+            if self._running.get(batch.key, 0) < self._max_per_key:
+                index, args = batch.pending.popleft()
+                self._running[batch.key] = self._running.get(batch.key, 0) + 1
+                if not batch.pending:
+                    self._batches.remove(batch)
+                return batch, index, args
+        return None, None, None
+
+    def _call_done(self, batch, index, result, exc_info):
+        with self._cond:
+            running = self._running[batch.key] - 1
+            if running:
+                self._running[batch.key] = running
+            else:
+                del self._running[batch.key]
+            batch.remaining -= 1
+            if exc_info:
+                if batch.error is None or index < batch.error[0]:
+                    batch.error = (index, exc_info)
+                # Drop calls not started yet.
+                batch.remaining -= len(batch.pending)
+                batch.pending.clear()
+                if batch in self._batches:
+                    self._batches.remove(batch)
+            else:
+                batch.results[index] = result
+            if batch.remaining == 0:
+                batch.done.set()
+            # A call with that key may now be started.
+            self._cond.notify_all()
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                batch, index, args = self._next_call()
+                while batch is None:
+                    if self._stopped:
+                        return
+                    self._cond.wait()
+                    batch, index, args = self._next_call()
+            result = None
+            exc_info = None
+            try:
+                result = batch.func(*args)
+            except:
+                exc_info = sys.exc_info()
+            self._call_done(batch, index, result, exc_info)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+"""
+    Return the process-wide FanOutExecutor, created on first call with given
+    size and max_per_key (default values if None).
+"""
+def get_fan_out_executor(size=None, max_per_key=None):
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = FanOutExecutor(size or FanOutExecutor.DEFAULT_SIZE,
+                                       max_per_key or FanOutExecutor.DEFAULT_MAX_PER_KEY)
+        return _executor
@@ -0,0 +1,192 @@
+"""
+    Thread-safe pool of keep-alive HTTP connections.
+
+    Connections are grouped by host (scheme, host and port). A connection is
+    used by one thread at a time and given back to the pool once its response
+    has been read, unless the server asked to close it. Connections that have
+    been idle for more than idle_timeout seconds are closed.
+"""
+import httplib, socket, threading, time, logging
+from functools import partial
+from urlparse import urlsplit
+from apiisim.common.cancellation import CancelledError
+
+
+class HttpPoolException(Exception):
+    pass
+
+
+class _HostPool(object):
+    def __init__(self):
+        self.idle = [] # [(connection, last_used)], most recently used last
+        self.in_use = 0
+
+
+class HttpConnectionPool(object):
+    DEFAULT_MAX_PER_HOST = 16
+    DEFAULT_IDLE_TIMEOUT = 30 # In seconds
+
+    def __init__(self, max_per_host=DEFAULT_MAX_PER_HOST,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, timeout=None):
+        self._max_per_host = max(1, max_per_host)
+        self._idle_timeout = idle_timeout
+        self._timeout = timeout # Socket timeout, in seconds
+        self._cond = threading.Condition()
+        self._hosts = {} # {(scheme, netloc) : _HostPool}
+        self._opened = 0
+        self._reused = 0
+        self._evicted = 0
+
+    def _new_connection(self, scheme, netloc):
+        if scheme == "https":
+            return httplib.HTTPSConnection(netloc, timeout=self._timeout)
+        elif scheme == "http":
+            return httplib.HTTPConnection(netloc, timeout=self._timeout)
+        raise HttpPoolException("Unsupported URL scheme: %s" % scheme)
+
+    # Must be called with self._cond acquired.
+    def _evict_idle(self, host_pool, now):
+        while host_pool.idle and (now - host_pool.idle[0][1]) > self._idle_timeout:
+            conn, _ = host_pool.idle.pop(0)
+            conn.close()
+            self._evicted += 1
+
+    """
+        Return (connection, reused), blocking until a connection to given host
+        is available. If cancel_token gets cancelled meanwhile, CancelledError
+        is raised.
+    """
+    def _acquire(self, key, cancel_token=None):
+        if cancel_token is None:
+            return self._acquire_connection(key, None)
+        wake = self._wake_waiters
+        cancel_token.add_callback(wake)
+        try:
+            return self._acquire_connection(key, cancel_token)
+        finally:
+            cancel_token.remove_callback(wake)
+
+    # Called from the cancelling thread, wakes threads waiting for a connection.
+    def _wake_waiters(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def _acquire_connection(self, key, cancel_token):
+        with self._cond:
+            host_pool = self._hosts.setdefault(key, _HostPool())
+            while True:
+                if cancel_token is not None and cancel_token.cancelled:
+                    # We may have been woken by _release(), let another
+                    # thread take the connection.
+                    self._cond.notify()
+                    raise CancelledError()
+                self._evict_idle(host_pool, time.time())
+                if host_pool.idle:
+                    conn, _ = host_pool.idle.pop()
+                    host_pool.in_use += 1
+                    self._reused += 1
+                    return conn, True
+                if host_pool.in_use < self._max_per_host:
+                    host_pool.in_use += 1
+                    self._opened += 1
+                    break
+                self._cond.wait()
+        try:
+            return self._new_connection(*key), False
+        except:
+            self._release(key, None)
+            raise
+
+    # If conn is None, the connection is considered as closed.
+    def _release(self, key, conn):
+        with self._cond:
+            host_pool = self._hosts[key]
+            host_pool.in_use -= 1
+            if conn is not None:
+                host_pool.idle.append((conn, time.time()))
+            self._cond.notify()
+
+    # Called from the cancelling thread, unblocks thread waiting on conn.
+    def _abort(self, conn):
+        sock = conn.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    """
+        Send request and return (response, content), response being an
+        httplib.HTTPResponse whose content has already been read.
+        If a reused connection turns out to have been closed by the server,
+        the request is sent again once on a new connection.
+        If cancel_token (a cancellation.CancelToken) is given and gets
+        cancelled, the connection is shut down and CancelledError is raised.
+    """
+    def request(self, url, method="GET", body=None, headers=None, cancel_token=None):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        while True:
+            if cancel_token is not None:
+                cancel_token.check()
+            conn, reused = self._acquire(key, cancel_token)
+            abort = None
+            if cancel_token is not None:
+                abort = partial(self._abort, conn)
+                cancel_token.add_callback(abort)
+            try:
+                conn.request(method, path, body, headers or {})
+                if cancel_token is not None:
+                    # Token may have been cancelled before the socket was opened.
+                    cancel_token.check()
+                resp = conn.getresponse()
+                content = resp.read()
+            except (httplib.HTTPException, socket.error) as exc:
+                conn.close()
+                self._release(key, None)
+                if cancel_token is not None:
+                    cancel_token.check()
+                if reused:
+                    logging.debug("Reused connection to <%s> failed (%s), retrying",
+                                  parts.netloc, exc)
+                    continue
+                raise
+            except:
+                conn.close()
+                self._release(key, None)
+                raise
+            finally:
+                if abort is not None:
+                    cancel_token.remove_callback(abort)
+
+            if resp.will_close or (cancel_token is not None and cancel_token.cancelled):
+                # Connection may have been shut down after response was read.
+                conn.close()
+                conn = None
+            self._release(key, conn)
+            return resp, content
+
+    # Close all idle connections.
+    def clear(self):
+        with self._cond:
+            for host_pool in self._hosts.values():
+                for conn, _ in host_pool.idle:
+                    conn.close()
+                host_pool.idle = []
+
+    """
+        Return {"opened" : number of connections opened,
+                "reused" : number of requests sent on an already opened connection,
+                "evicted" : number of connections closed after being idle too long,
+                "idle" : number of connections currently idle}
+    """
+    def get_stats(self):
+        with self._cond:
+            return {"opened" : self._opened,
+                    "reused" : self._reused,
+                    "evicted" : self._evicted,
+                    "idle" : sum([len(x.idle) for x in self._hosts.values()])}
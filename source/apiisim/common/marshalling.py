@@ -1,8 +1,8 @@
 from flask_restful import fields, marshal as flask_marshal
+from collections import OrderedDict
+from types import InstanceType
 import datetime
-from apiisim.common import timedelta_to_xsd_duration
-
-DATE_FORMAT="%Y-%m-%dT%H:%M:%S"
+from apiisim.common import timedelta_to_xsd_duration, DATE_FORMAT
 
 """
     Custom float marshaller as stock Flask float marshaller is buggy, it outputs
@@ -62,6 +62,218 @@ class NonNullList(fields.List):
         self.display_empty = False
 
 
+################################################################################
+# Field spec compiler
+#
+# flask_restful.marshal walks the field spec for every object it marshals:
+# field classes are instantiated, values are fetched with get_value() (which
+# splits keys on dots and checks whether the object is indexable), and every
+# field goes through its generic output() method. Field specs never change, so
+# each of them is turned once into a serializer, running a list of steps
+# precomputed from the spec in a single loop.
+# Serializers give the same output as flask_restful.marshal (same values,
+# same OrderedDict key order), including the handling of null elements by our
+# patched flask library, if it is installed (see _probe()).
+
+"""
+    Return True if given field drops the "k" key when marshalling data
+    with the installed flask library, False if it keeps it (stock library).
+"""
+def _probe(field, data):
+    try:
+        return "k" not in flask_marshal(data, {"k" : field})
+    except Exception:
+        return False
+
+# Null NonNullNested fields are dropped.
+_HIDE_NULL_NESTED = _probe(NonNullNested({}), {"k" : None})
+# Empty and null NonNullList fields are dropped.
+_HIDE_EMPTY_LIST = _probe(NonNullList(fields.String), {"k" : []})
+_HIDE_NULL_LIST = _probe(NonNullList(fields.String), {"k" : None})
+# Null elements of a list of NonNullNested are dropped.
+try:
+    _HIDE_NULL_ITEMS = flask_marshal({"k" : [None]},
+                                     {"k" : fields.List(NonNullNested({}))})["k"] == []
+except Exception:
+    _HIDE_NULL_ITEMS = False
+
+
+_indexable_types = {} # {type : fields.is_indexable_but_not_string() result}
+
+def _is_indexable(obj):
+    cls = type(obj)
+    ret = _indexable_types.get(cls, None)
+    if ret is None:
+        ret = fields.is_indexable_but_not_string(obj)
+        # Old-style instances all have the same type.
+        if cls is not InstanceType:
+            _indexable_types[cls] = ret
+    return ret
+
+
+def _method_func(cls, name):
+    return getattr(getattr(cls, name), "im_func", None)
+
+_RAW_OUTPUT = _method_func(fields.Raw, "output")
+_NESTED_OUTPUT = _method_func(fields.Nested, "output")
+_LIST_OUTPUT = _method_func(fields.List, "output")
+_RAW_FORMAT = _method_func(fields.Raw, "format")
+
+# Default value meaning that None values are formatted as well.
+_FORMAT_NONE = object()
+
+
+def _format_string(value):
+    try:
+        return unicode(value)
+    except ValueError as ve:
+        raise fields.MarshallingException(ve)
+
+
+"""
+    Return (default, format) such that field.output() returns default when
+    the value fetched from the marshalled object is None (unless default is
+    _FORMAT_NONE), format(value) otherwise (value itself if format is None).
+    Return None if field has a custom output() method.
+"""
+def _compile_value(field):
+    output = _method_func(type(field), "output")
+
+    if output is _RAW_OUTPUT:
+        if _method_func(type(field), "format") is _RAW_FORMAT:
+            return field.default, None
+        if type(field) is fields.String:
+            return field.default, _format_string
+        return field.default, field.format
+
+    if output is _NESTED_OUTPUT:
+        return None if field.allow_null else _FORMAT_NONE, compile_fields(field.nested)
+
+    if output is _LIST_OUTPUT:
+        return field.default, _compile_list(field)
+
+    return None
+
+
+def _compile_list(field):
+    container = field.container
+    value_format = _compile_value(container)
+    if value_format is not None:
+        default, format = value_format
+        if default is _FORMAT_NONE:
+            convert = format
+        elif format is None:
+            convert = lambda x: default if x is None else x
+        else:
+            convert = lambda x: default if x is None else format(x)
+    hide_null_items = _HIDE_NULL_ITEMS and getattr(container, "display_null", True) is False
+    pass_dicts = not isinstance(container, fields.Nested) and \
+                 type(container) is not fields.Raw
+
+    def format_list(value):
+        if not fields.is_indexable_but_not_string(value) or isinstance(value, dict):
+            return [flask_marshal(value, container.nested)]
+        if isinstance(value, set):
+            value = list(value)
+        if value_format is None or not isinstance(value, (list, tuple)):
+            ret = [container.output(i, x if isinstance(x, dict) and pass_dicts else value)
+                   for i, x in enumerate(value)]
+        elif pass_dicts:
+            ret = [container.output(i, x) if isinstance(x, dict) else convert(x)
+                   for i, x in enumerate(value)]
+        else:
+            ret = [convert(x) for x in value]
+        if hide_null_items:
+            ret = [x for x in ret if x is not None]
+        return ret
+
+    return format_list
+
+
+"""
+    Return predicate telling if the marshalled value of given field is dropped
+    by the installed flask library, None if it never is.
+"""
+def _compile_hide(field):
+    hide_null = False
+    hide_empty = False
+    if getattr(field, "display_null", True) is False:
+        hide_null = _HIDE_NULL_NESTED
+    if getattr(field, "display_empty", True) is False:
+        hide_null = hide_null or _HIDE_NULL_LIST
+        hide_empty = _HIDE_EMPTY_LIST
+    if hide_null and hide_empty:
+        return lambda value: value is None or value == []
+    if hide_null:
+        return lambda value: value is None
+    if hide_empty:
+        return lambda value: value == []
+    return None
+
+
+_serializers = {} # {id(field spec) : (field spec, serializer)}
+
+"""
+    Return serializer(data, skip_none=False) for given field spec (dict of
+    fields, as given to flask_restful.marshal), compiled on first use.
+    serializer(data) returns the same thing as flask_restful.marshal(data,
+    spec), keys whose value is None being skipped if skip_none is True.
+    Field specs must not be modified once compiled.
+"""
+def compile_fields(spec):
+    entry = _serializers.get(id(spec), None)
+    if entry is not None and entry[0] is spec:
+        return entry[1]
+
+    # [(key, name, default, format, hide)]: value is fetched from the
+    # marshalled object under name, then formatted (see _compile_value()).
+    # If name is None, value is format(marshalled object).
+    # hide is None or a predicate telling if the value is dropped.
+    steps = []
+    for key, field in spec.items():
+        if isinstance(field, dict):
+            steps.append((key, None, None, compile_fields(field), None))
+            continue
+        if isinstance(field, type):
+            field = field()
+        name = key if field.attribute is None else field.attribute
+        value_format = _compile_value(field)
+        if value_format is None or not isinstance(name, basestring) or "." in name:
+            output = lambda data, key=key, field=field: field.output(key, data)
+            steps.append((key, None, None, output, _compile_hide(field)))
+        else:
+            steps.append((key, name) + value_format + (_compile_hide(field),))
+
+    def serializer(data, skip_none=False):
+        if isinstance(data, (list, tuple)):
+            return [serializer(x, skip_none) for x in data]
+        indexable = _is_indexable(data)
+        ret = OrderedDict()
+        for key, name, default, format, hide in steps:
+            if name is None:
+                value = format(data)
+            else:
+                # Same as fields.get_value(name, data)
+                if indexable:
+                    try:
+                        value = data[name]
+                    except (IndexError, TypeError, KeyError):
+                        value = getattr(data, name, None)
+                else:
+                    value = getattr(data, name, None)
+                if value is None and default is not _FORMAT_NONE:
+                    value = default
+                elif format is not None:
+                    value = format(value)
+            if (value is None and skip_none) or (hide is not None and hide(value)):
+                continue
+            ret[key] = value
+        return ret
+
+    _serializers[id(spec)] = (spec, serializer)
+    return serializer
+
+
 """
     Ignore None attributes. Note that this is not recursive, only top-level
     attributes will be filtered, attributes in nested objects won't. 
@@ -71,12 +283,7 @@ def marshal(obj, fields):
     if isinstance(obj, list):
         return [marshal(x, fields) for x in obj]
 
-    ret = flask_marshal(obj, fields)
-    items = ret.iteritems()
-    for k, v in items:
-        if v is None:
-            del ret[k]
-    return ret
+    return compile_fields(fields)(obj, skip_none=True)
 
 
 location_structure_type = {
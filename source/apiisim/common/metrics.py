@@ -0,0 +1,216 @@
+"""
+    In-process timing metrics.
+
+    Durations are measured with a monotonic clock and recorded in per-name
+    histograms (count, total, min, max and approximate percentiles), kept in
+    process memory until reset. Recording a duration costs a few dict and
+    arithmetic operations: nothing is formatted or logged on the hot path.
+    Histograms can be dumped on demand with Metrics.snapshot().
+
+    Durations can also be added to a RequestTimings object, giving the
+    breakdown of the time spent by a single request.
+"""
+import math, threading, time
+from functools import wraps
+
+
+CLOCK_MONOTONIC = 1 # From <time.h>, Linux value
+
+
+def _init_monotonic():
+    try:
+        import ctypes, ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+        lib = ctypes.CDLL(ctypes.util.find_library("rt") or ctypes.util.find_library("c"),
+                          use_errno=True)
+        clock_gettime = lib.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        clock_gettime.restype = ctypes.c_int
+
+        def monotonic():
+            ts = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+                raise OSError(ctypes.get_errno(), "clock_gettime failed")
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+
+        monotonic()
+        return monotonic
+    except Exception:
+        # Not monotonic, but good enough when clock_gettime is not available.
+        return time.time
+
+"""
+    Return seconds elapsed since an arbitrary point, never going backwards
+    (unless clock_gettime is not available, time.time() being used instead).
+"""
+monotonic = _init_monotonic()
+
+
+"""
+    Histogram of durations (in seconds). Buckets grow geometrically, so that
+    percentiles have the same relative precision (about 5%) from a microsecond
+    to several minutes. Not thread-safe, see Metrics.
+"""
+class Histogram(object):
+    MIN_VALUE = 1e-6
+    GROWTH = 2 ** 0.125
+    NB_BUCKETS = 8 * 30
+    _LOG_GROWTH = math.log(GROWTH)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self._buckets = [0] * self.NB_BUCKETS
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if value <= self.MIN_VALUE:
+            i = 0
+        else:
+            i = min(int(math.log(value / self.MIN_VALUE) / self._LOG_GROWTH) + 1,
+                    self.NB_BUCKETS - 1)
+        self._buckets[i] += 1
+
+    """
+        Return approximate value below which percent % of values are, None if
+        no value has been added.
+    """
+    def percentile(self, percent):
+        if not self.count:
+            return None
+        rank = math.ceil(self.count * percent / 100.0)
+        if rank >= self.count:
+            return self.max
+        seen = 0
+        for i, n in enumerate(self._buckets):
+            seen += n
+            if seen >= rank:
+                break
+        if i == 0:
+            return self.min
+        # Geometric middle of the bucket, within observed bounds.
+        value = self.MIN_VALUE * self.GROWTH ** (i - 0.5)
+        return max(self.min, min(self.max, value))
+
+    def to_dict(self):
+        return {"count" : self.count,
+                "total" : self.total,
+                "mean" : (self.total / self.count) if self.count else None,
+                "min" : self.min,
+                "max" : self.max,
+                "p50" : self.percentile(50),
+                "p95" : self.percentile(95),
+                "p99" : self.percentile(99)}
+
+
+"""
+    Thread-safe set of named histograms.
+"""
+class Metrics(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {} # {name : Histogram}
+
+    def record(self, name, seconds):
+        with self._lock:
+            histogram = self._histograms.get(name, None)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    """
+        Return {name : {"count", "total", "mean", "min", "max", "p50", "p95",
+        "p99"}}, durations being in seconds.
+    """
+    def snapshot(self):
+        with self._lock:
+            return dict([(name, x.to_dict()) for name, x in self._histograms.items()])
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+
+    # One line per histogram, durations in milliseconds, sorted by total.
+    def format(self):
+        lines = []
+        for name, x in sorted(self.snapshot().items(), key=lambda x: -x[1]["total"]):
+            lines.append("%s: count=%s total=%.1fms mean=%.3fms p50=%.3fms "
+                         "p95=%.3fms p99=%.3fms max=%.3fms"
+                         % (name, x["count"], x["total"] * 1000, x["mean"] * 1000,
+                            x["p50"] * 1000, x["p95"] * 1000, x["p99"] * 1000,
+                            x["max"] * 1000))
+        return "\n".join(lines)
+
+
+"""
+    Time spent by a single request, by name: only counts and totals are kept.
+    Thread-safe, as a request may be processed by several threads.
+"""
+class RequestTimings(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timings = {} # {name : [count, total in seconds]}
+
+    def add(self, name, seconds):
+        with self._lock:
+            timing = self._timings.get(name, None)
+            if timing is None:
+                self._timings[name] = [1, seconds]
+            else:
+                timing[0] += 1
+                timing[1] += seconds
+
+    # Return {name : (count, total in seconds)}
+    def get(self):
+        with self._lock:
+            return dict([(name, tuple(x)) for name, x in self._timings.items()])
+
+    # "name=count/totalms ...", sorted by total.
+    def format(self):
+        return " ".join(["%s=%s/%.1fms" % (name, count, total * 1000)
+                         for name, (count, total) in
+                         sorted(self.get().items(), key=lambda x: -x[1][1])])
+
+
+# Process-wide metrics
+metrics = Metrics()
+
+
+"""
+    Record duration in process-wide metrics, and in request_timings
+    (RequestTimings) if given.
+"""
+def record(name, seconds, request_timings=None):
+    metrics.record(name, seconds)
+    if request_timings is not None:
+        request_timings.add(name, seconds)
+
+
+"""
+    Decorator recording the duration of each call to func under its name.
+    If the first argument (self for methods) has a request_timings attribute
+    that is not None, the duration is added to it as well.
+"""
+def timed(func):
+    name = func.__name__
+
+    @wraps(func)
+    def decorator(*args, **kwargs):
+        start = monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record(name, monotonic() - start,
+                   getattr(args[0], "request_timings", None) if args else None)
+
+    return decorator
@@ -159,13 +159,22 @@ class MisMode(Base):
         return (u"<MisMode(id='%s', mis_id='%s', mode_id='%s')>" % \
                 (self.id, self.mis_id, self.mode_id)).encode(OUTPUT_ENCODING)
 
+# Materialized view, each transfer appears in both orientations (stop1 belongs
+# to mis1).
 class TransferMis(Base):
     __tablename__ = 'transfer_mis'
 
     transfer_id = Column(Integer, primary_key=True)
-    mis1_id = Column(Integer, nullable=False)
+    mis1_id = Column(Integer, primary_key=True)
     mis2_id = Column(Integer, nullable=False)
     transfer_active = Column(Boolean)
+    duration = Column(Integer)
+    stop1_code = Column(String(50))
+    stop1_lat = Column(Float(53))
+    stop1_long = Column(Float(53))
+    stop2_code = Column(String(50))
+    stop2_lat = Column(Float(53))
+    stop2_long = Column(Float(53))
 
 class BackOfficeImport(Base):
     __tablename__ = 'back_office_import'
@@ -40,5 +40,7 @@ INSERT INTO mis_mode (mis_id, mode_id) VALUES
     (1,2),
     (2,2);
 
+REFRESH MATERIALIZED VIEW transfer_mis;
+
 COMMIT;
 \q
@@ -293,9 +293,29 @@ EXECUTE PROCEDURE set_updated_at_timestamp();
 
 -- Views
 
-CREATE VIEW transfer_mis AS 
-SELECT t.id transfer_id, m1.id mis1_id, m2.id mis2_id, t.active transfer_active
-FROM transfer t, stop s1, stop s2, mis m1, mis m2
-WHERE s1.mis_id=m1.id AND s2.mis_id=m2.id AND t.stop1_id=s1.id AND t.stop2_id=s2.id;
+-- Transfers with the stop data needed by the planner, in both orientations
+-- (stop1 always belongs to mis1), so that transfers between 2 MIS are
+-- retrieved with a single index-only scan, without joins.
+-- It is a materialized view, which must be refreshed once transfers have been
+-- modified (back_office does it at the end of each successful import).
+CREATE MATERIALIZED VIEW transfer_mis AS
+SELECT t.id transfer_id, s1.mis_id mis1_id, s2.mis_id mis2_id, t.active transfer_active,
+       t.duration, s1.code stop1_code, s1.lat stop1_lat, s1.long stop1_long,
+       s2.code stop2_code, s2.lat stop2_lat, s2.long stop2_long
+FROM transfer t JOIN stop s1 ON t.stop1_id=s1.id JOIN stop s2 ON t.stop2_id=s2.id
+UNION ALL
+SELECT t.id transfer_id, s2.mis_id mis1_id, s1.mis_id mis2_id, t.active transfer_active,
+       t.duration, s2.code stop1_code, s2.lat stop1_lat, s2.long stop1_long,
+       s1.code stop2_code, s1.lat stop2_lat, s1.long stop2_long
+FROM transfer t JOIN stop s1 ON t.stop1_id=s1.id JOIN stop s2 ON t.stop2_id=s2.id
+WHERE s1.mis_id <> s2.mis_id;
+
+CREATE INDEX transfer_mis_pair_idx ON transfer_mis USING btree(
+    mis1_id, mis2_id, transfer_active, transfer_id, duration,
+    stop1_code, stop1_lat, stop1_long, stop2_code, stop2_lat, stop2_long);
+-- Required to refresh the view concurrently, without blocking readers. A
+-- transfer appears at most once per orientation.
+CREATE UNIQUE INDEX transfer_mis_transfer_idx ON transfer_mis USING btree(
+    transfer_id, mis1_id);
 COMMIT;
 \q
@@ -4,6 +4,10 @@ from apiisim.common import StatusCodeEnum
 
 class MisApiException(Exception):
     error_code = StatusCodeEnum.INTERNAL_ERROR
+    # error_id: identifier of the error given by the MIS, if any.
+    def __init__(self, message="", error_id=""):
+        super(MisApiException, self).__init__(message)
+        self.error_id = error_id
 class MisApiDateOutOfScopeException(MisApiException):
     error_code = StatusCodeEnum.DATE_OUT_OF_SCOPE
 class MisApiBadRequestException(MisApiException):
@@ -32,6 +36,22 @@ class MisApiBase(object):
     def __init__(self, config, api_key=""):
         self._api_key = api_key
 
+    """
+        Called once, when the MIS API is loaded, with the mis_translator
+        configuration (a ConfigParser), to set up state shared by all
+        instances.
+    """
+    @classmethod
+    def configure(cls, config):
+        pass
+
+    """
+        Called when the object is given back to the pool of MisApi objects,
+        once a request is processed, to release per-request state.
+    """
+    def reset(self):
+        pass
+
     """
         Return a list with all stop points from this mis
     """
@@ -4,7 +4,7 @@ from base import MisApiBase, MisApiException, \
                  MisApiDateOutOfScopeException, MisApiBadRequestException, \
                  MisApiInternalErrorException, MisApiUnauthorizedException, \
                  MisCapabilities, MisApiUnknownObjectException
-import json, httplib2, logging, urllib
+import json, httplib2, logging, urllib, threading, calendar
 from apiisim.common.mis_plan_trip import TripStopPlaceType, LocationStructure, \
                                          EndPointType, StepEndPointType, StepType, \
                                          QuayType, CentroidType, TripType, \
@@ -12,6 +12,8 @@ from apiisim.common.mis_plan_trip import TripStopPlaceType, LocationStructure, \
                                          LineType, PTNetworkType
 from apiisim.common.mis_collect_stops import StopPlaceType
 from apiisim.common.mis_plan_summed_up_trip import SummedUpItinerariesResponseType, SummedUpTripType
+from apiisim.common.fan_out import get_fan_out_executor
+from apiisim.common.cache import LruCache
 from apiisim.common import AlgorithmEnum, SelfDriveModeEnum, TripPartEnum, TypeOfPlaceEnum, \
                    TransportModeEnum, PublicTransportModeEnum, PlanSearchOptions
 from datetime import datetime, timedelta
@@ -22,6 +24,20 @@ NAME = "navitia"
 ITEMS_PER_PAGE = 1000
 DATE_FORMAT = "%Y%m%dT%H%M%S"
 
+# httplib2.Http objects are not thread-safe, each thread sending requests
+# (fan-out threads, see _journeys_requests()) has its own one, kept between
+# requests so that connections are reused.
+_thread_local = threading.local()
+
+# URLs of coverages that rejected one-to-many journeys requests, see
+# MisApi._one_to_many_journeys().
+_one_to_many_unsupported = set()
+
+# Navitia errors meaning that journeys requests without 'to' or 'from'
+# parameter are not supported by a coverage. Other errors only make the
+# request that failed fall back to pairwise requests.
+ONE_TO_MANY_UNSUPPORTED_ERRORS = ["unknown_api", "bad_format"]
+
 
 class SectionTypeEnum:
     PUBLIC_TRANSPORT = "public_transport"
@@ -179,6 +195,16 @@ def parse_stop_times(stop_times):
     return steps
 
 
+# Total duration of the non public transport parts of given journey.
+def journey_transfer_duration(journey):
+    sections = journey.get("sections", [])
+    if not sections:
+        # One-to-many journeys have no sections, only durations per mode.
+        return journey.get("durations", {}).get("walking", 0)
+    return sum([x["duration"] for x in sections
+                if x["type"] != SectionTypeEnum.PUBLIC_TRANSPORT])
+
+
 def journey_to_summed_up_trip(journey):
     if not journey:
         return None
@@ -186,19 +212,26 @@ def journey_to_summed_up_trip(journey):
     trip = SummedUpTripType()
     trip.InterchangeCount = journey["nb_transfers"]
     sections = journey.get('sections', [])
-    if not sections:
+    if sections:
+        departure = sections[0]['from']
+        arrival = sections[-1]['to']
+        departure_time = sections[0]['departure_date_time']
+        arrival_time = sections[-1]['arrival_date_time']
+    elif "from" in journey and "to" in journey:
+        # One-to-many journeys only give their end points.
+        departure = journey['from']
+        arrival = journey['to']
+        departure_time = journey['departure_date_time']
+        arrival_time = journey['arrival_date_time']
+    else:
         logging.debug("No section found")
         return None
 
-    first_section = sections[0]
-    last_section = sections[-1]
-    trip.Departure = parse_end_point(first_section['from'])
-    trip.Departure.DateTime = datetime.strptime(first_section['departure_date_time'], DATE_FORMAT)
-    trip.Arrival = parse_end_point(last_section['to'])
-    trip.Arrival.DateTime = datetime.strptime(last_section['arrival_date_time'], DATE_FORMAT)
-    trip.InterchangeDuration = 0
-    for s in [x for x in sections if x["type"] != SectionTypeEnum.PUBLIC_TRANSPORT]:
-        trip.InterchangeDuration += s["duration"]
+    trip.Departure = parse_end_point(departure)
+    trip.Departure.DateTime = datetime.strptime(departure_time, DATE_FORMAT)
+    trip.Arrival = parse_end_point(arrival)
+    trip.Arrival.DateTime = datetime.strptime(arrival_time, DATE_FORMAT)
+    trip.InterchangeDuration = journey_transfer_duration(journey)
 
     return trip
 
@@ -207,7 +240,7 @@ def journey_to_str(journey):
     return ("<Journey> Departure: %s | Arrival: %s | Duration: %s | "
             "Nb_transfers: %s | Type: %s" % (journey["departure_date_time"],
             journey["arrival_date_time"], journey["duration"],
-            journey["nb_transfers"], journey["type"]))
+            journey["nb_transfers"], journey.get("type", "")))
 
 
 def journey_to_detailed_trip(journey):
@@ -306,7 +339,7 @@ def algo_classic(journeys, departure_at=False):
 
     # We have several journeys to choose from, so get journey of type "best"
     # (which is according to Navitia, the best journey).
-    l = [x for x in first_selection if x["type"] == "best"]
+    l = [x for x in first_selection if x.get("type", "") == "best"]
     if len(l) == 0:
         # If there is no journey of type "best", just go to the next step.
         second_selection = first_selection
@@ -351,9 +384,7 @@ def algo_minchanges(journeys):
     # Get journey with minimum transfer duration
     transfer_durations = [] # [(journey, transfer_duration)]
     for j in journeys:
-        transfer_durations.append( \
-                (j, sum([x["duration"] for x in j["sections"] \
-                         if x["type"] != SectionTypeEnum.PUBLIC_TRANSPORT])))
+        transfer_durations.append((j, journey_transfer_duration(j)))
     l = sorted(transfer_durations, key=itemgetter(1))
     logging.debug("transfer_durations: Best %s from %s", l[0][1], [x[1] for x in transfer_durations])
     return l[0][0]
@@ -414,6 +445,32 @@ def params_set_datetime(params, departure_time, arrival_time, departure, arrival
                 (arrival_time + arrival.AccessTime).strftime(DATE_FORMAT)
 
 
+"""
+    Return a copy of params whose datetime is moved to the beginning of its
+    time_bucket seconds interval (to its end for an arrival time). Journeys
+    found for it can be used for another datetime of the interval only if
+    they all match that datetime, see journey_matches_datetime().
+"""
+def params_bucket_datetime(params, time_bucket):
+    date_time = datetime.strptime(params["datetime"], DATE_FORMAT)
+    timestamp = calendar.timegm(date_time.utctimetuple())
+    timestamp -= timestamp % time_bucket
+    if params.get("datetime_represents", "departure") == "arrival":
+        timestamp += time_bucket - 1
+    params = dict(params)
+    params["datetime"] = datetime.utcfromtimestamp(timestamp).strftime(DATE_FORMAT)
+    return params
+
+
+# Return False if journey leaves before the departure time (arrives after
+# the arrival time) of params.
+def journey_matches_datetime(journey, params):
+    if params.get("datetime_represents", "departure") == "arrival":
+        date_time = journey.get("arrival_date_time", "")
+        return bool(date_time) and date_time <= params["datetime"]
+    return journey.get("departure_date_time", "") >= params["datetime"]
+
+
 def params_set_modes(params, modes, self_drive_conditions):
     params["forbidden_uris[]"] = modes_to_forbidden_uris(modes)
     params["first_section_mode[]"] = list(
@@ -437,12 +494,49 @@ def params_set_modes(params, modes, self_drive_conditions):
     # optimization (it cannot be disabled).
 
 
+# Return a copy of params for every (departure, arrival) pair of pairs.
+def pairs_to_params(params, pairs, departure_time, arrival_time):
+    ret = []
+    for d, a in pairs:
+        pair_params = dict(params)
+        pair_params['from'] = get_location_id(d)
+        pair_params['to'] = get_location_id(a)
+        params_set_datetime(pair_params, departure_time, arrival_time, d, a)
+        ret.append(pair_params)
+    return ret
+
+
 # location is a LocationContextType object
 def get_location_id(location):
     return location.PlaceTypeId \
         or "%s;%s" % (location.Position.Longitude, location.Position.Latitude)
 
 
+# Return ids of given Navitia place: its own id and, for a stop point, the id
+# of its stop area.
+def get_place_ids(place):
+    ret = [place["id"]]
+    stop_area = place.get(place.get("embedded_type", ""), {}).get("stop_area", None)
+    if stop_area:
+        ret.append(stop_area["id"])
+    return ret
+
+
+# Return a copy of given journey whose departure (if side is 'from') or
+# arrival (if side is 'to') place has the given id.
+def set_journey_place_id(journey, side, place_id):
+    ret = dict(journey)
+    if side in ret:
+        ret[side] = dict(ret[side], id=place_id)
+    sections = ret.get("sections", [])
+    if sections:
+        i = 0 if side == "from" else -1
+        ret["sections"] = list(sections)
+        ret["sections"][i] = dict(sections[i])
+        ret["sections"][i][side] = dict(sections[i][side], id=place_id)
+    return ret
+
+
 # We need that to be able to remove duplicated stops easily (in get_stops()).
 class _StopPlaceType(StopPlaceType):
     def __eq__(self, other):
@@ -453,14 +547,102 @@ class _StopPlaceType(StopPlaceType):
 
 
 class MisApi(MisApiBase):
+    # Journeys responses, shared by all instances, see configure().
+    JOURNEYS_CACHE_SIZE = 10000
+    JOURNEYS_CACHE_TTL = 60 # In seconds
+    JOURNEYS_CACHE_TIME_BUCKET = 60 # In seconds
+    journeys_cache = LruCache(JOURNEYS_CACHE_SIZE, JOURNEYS_CACHE_TTL)
+    journeys_time_bucket = JOURNEYS_CACHE_TIME_BUCKET
+
+    """
+        Replace journeys cache. Requests whose datetime parameters are in the
+        same time_bucket seconds interval may share the same cached response
+        (see _journeys_request()). A size of 0 disables the cache.
+    """
+    @classmethod
+    def configure_journeys_cache(cls, size, ttl, time_bucket):
+        cls.journeys_cache = LruCache(size, ttl) if size > 0 else None
+        cls.journeys_time_bucket = max(1, time_bucket)
+
+    @classmethod
+    def configure(cls, config):
+        def get_int(option, default):
+            if config.has_option("Navitia", option):
+                return config.getint("Navitia", option)
+            return default
+        cls.configure_journeys_cache(
+                get_int("journeys_cache_size", cls.JOURNEYS_CACHE_SIZE),
+                get_int("journeys_cache_ttl", cls.JOURNEYS_CACHE_TTL),
+                get_int("journeys_cache_time_bucket", cls.JOURNEYS_CACHE_TIME_BUCKET))
+
+    """
+        Return {"hits" : number of journeys requests answered from the cache,
+                "misses" : number of journeys requests sent to Navitia,
+                "hit_rate" : hits / (hits + misses),
+                "size" : number of cached responses}
+    """
+    @classmethod
+    def get_journeys_cache_stats(cls):
+        if cls.journeys_cache is None:
+            return {"hits" : 0, "misses" : 0, "hit_rate" : 0.0, "size" : 0}
+        hits, misses = cls.journeys_cache.get_stats()
+        return {"hits" : hits, "misses" : misses,
+                "hit_rate" : (float(hits) / (hits + misses)) if (hits + misses) else 0.0,
+                "size" : len(cls.journeys_cache)}
 
     def __init__(self, config, api_key=""):
         # self._api_url = "http://api.navitia.io/v1/coverage/paris"
         self._api_url = "http://navitia2-ws.ctp.dev.canaltp.fr//v1/coverage/paysdelaloire/"
         self._api_key = api_key
-        self._http = None
 
-    def _journeys_request(self, params):
+    """
+        Key of journeys cache: coverage, API key, query parameters (whatever
+        their order and the order of list values) and datetime bucket.
+    """
+    def _journeys_cache_key(self, params):
+        items = []
+        time_key = None
+        for k, v in params.items():
+            if k == "datetime":
+                date_time = datetime.strptime(v, DATE_FORMAT)
+                time_key = calendar.timegm(date_time.utctimetuple()) // self.journeys_time_bucket
+            elif isinstance(v, (list, tuple, set, frozenset)):
+                items.append((k, tuple(sorted(v))))
+            else:
+                items.append((k, v))
+        return (self._api_url, self._api_key, tuple(sorted(items)), time_key)
+
+    """
+        Return journeys for given request parameters. Unless use_cache is
+        False, Navitia is asked for journeys at the beginning (end) of the
+        datetime bucket, which are cached. Cached journeys are returned only
+        if none of them leaves before the requested departure time (arrives
+        after the arrival time). Otherwise, since Navitia only returns a few
+        journeys, better ones may exist for the requested datetime, which is
+        then sent to Navitia as is. Returned journeys may be shared with other
+        callers, they must not be modified.
+    """
+    def _journeys_request(self, params, use_cache=True):
+        cache = self.journeys_cache if use_cache else None
+        if cache is None or "datetime" not in params:
+            return self._send_journeys_request(params)
+
+        bucket_params = params_bucket_datetime(params, self.journeys_time_bucket)
+        cache_key = self._journeys_cache_key(bucket_params)
+        journeys = cache.get(cache_key)
+        if journeys is None:
+            journeys = tuple(self._send_journeys_request(bucket_params))
+            cache.put(cache_key, journeys)
+        else:
+            logging.debug("NB JOURNEYS (cached): %s", len(journeys))
+
+        if all([journey_matches_datetime(x, params) for x in journeys]):
+            return list(journeys)
+        # Some journeys found for the bucket are too early (late) for the
+        # requested datetime.
+        return self._send_journeys_request(params)
+
+    def _send_journeys_request(self, params):
         url = self._api_url + "/journeys" + '?' + urllib.urlencode(params, True)
         resp, content = self._send_request(url)
 
@@ -471,15 +653,104 @@ class MisApi(MisApiBase):
         return [x for x in content.get("journeys", [])]
 
 
+    """
+        Send a journeys request for every params dict of params_list, at the
+        same time, and return the list of their journeys lists, in the same
+        order. At most FanOutExecutor max_per_key requests to the same
+        coverage are sent at the same time.
+    """
+    def _journeys_requests(self, params_list, use_cache=True):
+        return get_fan_out_executor().map(self._api_url, self._journeys_request,
+                                          [(x, use_cache) for x in params_list])
+
+    """
+        Return [(departure, arrival, journey)] for every departure/arrival
+        pair, in the order of departures and arrivals.
+    """
+    def _get_journeys(self, params, departures, arrivals, departure_time, arrival_time):
+        ret = self._one_to_many_journeys(params, departures, arrivals,
+                                         departure_time, arrival_time)
+        if ret is not None:
+            return ret
+
+        pairs = [(d, a) for d in departures for a in arrivals]
+        params_list = pairs_to_params(params, pairs, departure_time, arrival_time)
+        ret = []
+        for (d, a), l in zip(pairs, self._journeys_requests(params_list)):
+            for j in l:
+                ret.append((d, a, j))
+        return ret
+
+    """
+        If there is a single departure (arrival) point and the request time
+        is a departure (arrival) time, send a single journeys request without
+        'to' ('from') parameter, to which Navitia answers with journeys to
+        (from) every reachable stop, and return journeys of every pair, like
+        _get_journeys(). Return None if such a request can't be used: other
+        end points are not all stops, or the request failed (if the coverage
+        doesn't support it, pairwise requests are used from then on).
+    """
+    def _one_to_many_journeys(self, params, departures, arrivals, departure_time,
+                              arrival_time):
+        if departure_time and len(departures) == 1 and len(arrivals) > 1:
+            origin, origin_side = departures[0], "from"
+            targets, target_side = arrivals, "to"
+        elif arrival_time and len(arrivals) == 1 and len(departures) > 1:
+            origin, origin_side = arrivals[0], "to"
+            targets, target_side = departures, "from"
+        else:
+            return None
+        if self._api_url in _one_to_many_unsupported \
+           or not all([x.PlaceTypeId for x in targets]):
+            return None
+
+        params = dict(params)
+        params[origin_side] = get_location_id(origin)
+        # Datetime only depends on the departure (arrival) point.
+        params_set_datetime(params, departure_time, arrival_time, departures[0], arrivals[0])
+        try:
+            journeys = self._journeys_request(params)
+        except MisApiBadRequestException as exc:
+            if exc.error_id in ONE_TO_MANY_UNSUPPORTED_ERRORS:
+                logging.warning("One-to-many journeys not supported by <%s>, "
+                                "using pairwise requests: %s", self._api_url, exc)
+                _one_to_many_unsupported.add(self._api_url)
+            else:
+                logging.warning("One-to-many journeys request failed, "
+                                "using pairwise requests: %s", exc)
+            return None
+
+        found = {} # {place id : [journey]}
+        for j in journeys:
+            place = j.get(target_side, None)
+            if not place and j.get("sections", []):
+                place = j["sections"][0 if target_side == "from" else -1][target_side]
+            if not place:
+                continue
+            for place_id in get_place_ids(place):
+                found.setdefault(place_id, []).append(j)
+
+        ret = []
+        for t in targets:
+            for j in found.get(t.PlaceTypeId, []):
+                # Journey may end at a stop point of the requested stop area.
+                j = set_journey_place_id(j, target_side, t.PlaceTypeId)
+                if target_side == "to":
+                    ret.append((origin, t, j))
+                else:
+                    ret.append((t, origin, j))
+        return ret
+
     def _send_request(self, url):
-        if not self._http:
-            self._http = httplib2.Http()
+        http = getattr(_thread_local, "http", None)
+        if not http:
+            http = _thread_local.http = httplib2.Http()
 
         logging.debug("NAVITIA URL %s", url)
 
         headers = {'Authorization' : self._api_key}
 
-        resp, content = self._http.request(url, "GET", headers=headers)
+        resp, content = http.request(url, "GET", headers=headers)
         if resp.status == 200:
             return resp, content
 
@@ -495,16 +766,16 @@ class MisApi(MisApiBase):
 
         if resp.status == 404:
             if error_id == 'date_out_of_bounds':
-                raise MisApiDateOutOfScopeException(exc_msg)
+                raise MisApiDateOutOfScopeException(exc_msg, error_id)
             if error_id == 'unknown_object':
-                raise MisApiUnknownObjectException(exc_msg)
+                raise MisApiUnknownObjectException(exc_msg, error_id)
         elif resp.status == 400:
-            raise MisApiBadRequestException(exc_msg)
+            raise MisApiBadRequestException(exc_msg, error_id)
         elif resp.status == 401:
-            raise MisApiUnauthorizedException(exc_msg)
+            raise MisApiUnauthorizedException(exc_msg, error_id)
         elif resp.status == 500:
-            raise MisApiInternalErrorException(exc_msg)
-        raise MisApiException(exc_msg)
+            raise MisApiInternalErrorException(exc_msg, error_id)
+        raise MisApiException(exc_msg, error_id)
 
     def get_capabilities(self):
         return MisCapabilities(True, True, [TransportModeEnum.ALL])
@@ -572,21 +843,18 @@ class MisApi(MisApiBase):
                       accessibility_constraint, language, options):
         params = {}
         params_set_modes(params, modes, self_drive_conditions)
-        journeys = []
         # Request journeys for every departure/arrival pair and then
         # choose best.
         if len(departures) > 1:
-            params['to'] = get_location_id(arrivals[0])
-            for d in departures:
-                params['from'] = get_location_id(d)
-                params_set_datetime(params, departure_time, arrival_time, d, arrivals[0])
-                journeys.extend(self._journeys_request(params))
+            pairs = [(d, arrivals[0]) for d in departures]
         else:
-            params['from'] = get_location_id(departures[0])
-            for a in arrivals:
-                params['to'] = get_location_id(a)
-                params_set_datetime(params, departure_time, arrival_time, departures[0], a)
-                journeys.extend(self._journeys_request(params))
+            pairs = [(departures[0], a) for a in arrivals]
+        params_list = pairs_to_params(params, pairs, departure_time, arrival_time)
+        journeys = []
+        # The planner chains detailed trips on their exact times, don't give it
+        # journeys found for another datetime.
+        for l in self._journeys_requests(params_list, use_cache=False):
+            journeys.extend(l)
 
         best_journey = choose_best_journey(journeys, algorithm, bool(departure_time))
         # If no journey found, DetailedTrip is None
@@ -604,15 +872,8 @@ class MisApi(MisApiBase):
 
         # Request itinerary for every departure/arrival pair and then
         # choose best.
-        journeys = []
-        for d in departures:
-            for a in arrivals:
-                params['from'] = get_location_id(d)
-                params['to'] = get_location_id(a)
-                params_set_datetime(params, departure_time, arrival_time, d, a)
-                for j in self._journeys_request(params):
-                    journeys.append((d, a, j))
-
+        journeys = self._get_journeys(params, departures, arrivals, departure_time,
+                                      arrival_time)
         if not journeys:
             # No journey found, no need to go further, just return empty list.
             return []
@@ -630,14 +891,14 @@ class MisApi(MisApiBase):
             if departure_time:
                 for a in arrivals:
                     journeys_to_arrival = [x[2] for x in journeys if x[1] == a]
-                    if not j:
+                    if not journeys_to_arrival:
                         continue
                     best_journeys.append(
                             choose_best_journey(journeys_to_arrival, algorithm))
             else:
                 for d in departures:
                     journeys_from_departure = [x[2] for x in journeys if x[0] == d]
-                    if not j:
+                    if not journeys_from_departure:
                         continue
                     best_journeys.append(
                             choose_best_journey(journeys_from_departure, algorithm,
@@ -32,7 +32,7 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, Integer, String, Float
 from geoalchemy2 import Geography
 from geoalchemy2.functions import ST_Distance, GenericFunction
-import sys, ConfigParser
+import sys, ConfigParser, threading
 
 
 NAME = "stub_base"
@@ -83,7 +83,19 @@ class DbStop(Base):
                             spatial_index=True))
 
 
+# Engines (and so connection pools) of stub databases, shared by all MisApi
+# instances of this process: {db_name : (pid, engine)}
+_engines = {}
+_engines_lock = threading.Lock()
+
+
 def create_db(db_name):
+    # Pooled connections would prevent the database from being dropped.
+    with _engines_lock:
+        pid, engine = _engines.pop(db_name, (None, None))
+    if engine is not None and pid == os.getpid():
+        engine.dispose()
+
     engine = create_engine("postgresql+psycopg2://%s:%s@localhost/postgres" % \
                            (DB_ADMIN_NAME, DB_ADMIN_PASS),
                            echo=False)
@@ -114,11 +126,24 @@ def create_db(db_name):
     engine.dispose()
 
 
+"""
+    Return the engine of given database, created on first call. An engine
+    created by a parent process is not reused, as its pooled connections must
+    not be shared with the child process (mis_translator workers are forked).
+"""
+def get_engine(db_name):
+    with _engines_lock:
+        pid, engine = _engines.get(db_name, (None, None))
+        if engine is None or pid != os.getpid():
+            engine = create_engine("postgresql+psycopg2://%s:%s@localhost/%s" % \
+                                   (DB_ADMIN_NAME, DB_ADMIN_PASS, db_name),
+                                   echo=False)
+            _engines[db_name] = (os.getpid(), engine)
+        return engine
+
+
 def connect_db(db_name):
-    engine = create_engine("postgresql+psycopg2://%s:%s@localhost/%s" % \
-                           (DB_ADMIN_NAME, DB_ADMIN_PASS, db_name),
-                           echo=False)
-    return Session(bind=engine, expire_on_commit=False)
+    return Session(bind=get_engine(db_name), expire_on_commit=False)
 
 
 def populate_db(db_name, stops_file, stops_field):
@@ -139,7 +164,6 @@ def populate_db(db_name, stops_file, stops_field):
         db_session.commit()
     finally:
         db_session.close()
-        db_session.bind.dispose()
 
 
 # location is a LocationContextType object
@@ -236,10 +260,14 @@ class _StubMisApi(object):
 
         return ret
 
+    # End the transaction of the request (objects are pooled between
+    # requests), the connection is given back to the engine's pool.
+    def reset(self):
+        self._db_session.close()
+
     def __del__(self):
         if self._db_session:
             self._db_session.close()
-            self._db_session.bind.dispose()
 
 
 def generate_section(leg=False):
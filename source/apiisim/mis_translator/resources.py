@@ -1,6 +1,8 @@
 from flask_restful import abort, Resource
-import logging, datetime, json
+import logging, datetime, json, threading
+from collections import OrderedDict
 from flask import request, Response
+from werkzeug.exceptions import HTTPException
 from apiisim.common.mis_plan_trip import LocationContextType, LocationStructure, \
                                   ItineraryResponseType, StatusType, \
                                   SelfDriveConditionType
@@ -13,6 +15,7 @@ from apiisim.common.marshalling import DATE_FORMAT, marshal, itinerary_response_
                                        stops_response_type, capabilities_response_type
 from apiisim.common.mis_collect_stops import StopsResponseType
 from apiisim.common.mis_capabilities import CapabilitiesResponseType
+from apiisim.common.fan_out import get_fan_out_executor
 from mis_api.base import MisApiException, MisApiDateOutOfScopeException, \
                          MisApiBadRequestException, MisApiInternalErrorException
 from traceback import format_exc
@@ -29,6 +32,7 @@ STUB_MIS_APIS_AVAILABLE = frozenset(["stub_transilien",
                                      "stub_back_office_test1", "stub_back_office_test2"])
 mis_api_mapping = {} # Mis name : MisApi Class
 mis_api_config = None
+mis_api_pool = None # MisApiPool, created by load_mis_apis()
 
 """
 Load all available Mis APIs modules and populate mis_api_mapping dict so that
@@ -36,8 +40,23 @@ we can easily instanciate a MisApi object based on the Mis name.
 """
 def load_mis_apis(config):
     global mis_api_config
+    global mis_api_pool
 
     mis_api_config = config
+    max_idle = MisApiPool.DEFAULT_MAX_IDLE
+    if config.has_option("General", "mis_api_pool_max_idle"):
+        max_idle = config.getint("General", "mis_api_pool_max_idle")
+    mis_api_pool = MisApiPool(max_idle)
+    # MIS requests needed to answer a single request (one per departure/arrival
+    # pair) are sent at the same time by a pool of fan_out_pool_size threads,
+    # at most max_concurrent_mis_requests of them to the same MIS.
+    size = max_per_key = None
+    if config.has_option("General", "fan_out_pool_size"):
+        size = config.getint("General", "fan_out_pool_size")
+    if config.has_option("General", "max_concurrent_mis_requests"):
+        max_per_key = config.getint("General", "max_concurrent_mis_requests")
+    get_fan_out_executor(size, max_per_key)
+
     to_load = [("mis_api", MIS_APIS_AVAILABLE)]
     if mis_api_config.getboolean("General", "enable_stub_mis_apis"):
         to_load.append(("mis_api.stub", STUB_MIS_APIS_AVAILABLE))
@@ -58,8 +77,20 @@ def load_mis_apis(config):
                 continue
             mis_name = eval("%s.NAME" % mis_module)
             mis_api_mapping[mis_name] = eval("%s.MisApi" % mis_module)
+            # Stub MIS APIs are factories that don't derive from MisApiBase.
+            if hasattr(mis_api_mapping[mis_name], "configure"):
+                mis_api_mapping[mis_name].configure(config)
             logging.info("Loaded Mis API <%s> ", mis_name)
 
+"""
+Instantiate every loaded Mis API once, so that their one-time initializations
+(such as the creation of stub MIS databases) are done before processes
+serving requests are forked.
+"""
+def init_mis_apis():
+    for mis_name in mis_api_mapping.keys():
+        get_mis_api(mis_name)
+
 """
 Return new MisApi object based on given mis_name.
 """
@@ -69,8 +100,85 @@ def get_mis_api(mis_name, api_key=""):
     else:
         return None
 
+"""
+Pool of MisApi objects, reused by successive requests instead of being
+instantiated for each of them, so that their connections (HTTP connections,
+stub database sessions) are reused as well. An object is only used by one
+request at a time, so MisApi classes don't need to be thread-safe.
+Objects are created on demand (acquire() never blocks). At most max_idle idle
+objects are kept per (mis_name, api_key), for the max_keys most recently used
+keys.
+"""
+class MisApiPool(object):
+    DEFAULT_MAX_IDLE = 8
+    DEFAULT_MAX_KEYS = 1000
+
+    def __init__(self, max_idle=DEFAULT_MAX_IDLE, max_keys=DEFAULT_MAX_KEYS):
+        self._max_idle = max(0, max_idle)
+        self._max_keys = max(1, max_keys)
+        self._idle = OrderedDict() # {(mis_name, api_key) : [MisApi]}, most recently used last
+        self._lock = threading.Lock()
+        self._created = 0
+        self._reused = 0
+
+    # Must be called with self._lock acquired.
+    def _get_idle(self, key):
+        instances = self._idle.pop(key, [])
+        self._idle[key] = instances
+        while len(self._idle) > self._max_keys:
+            self._idle.popitem(last=False)
+        return instances
+
+    """
+    Return an idle MisApi object for given mis_name and api_key, or a new one
+    if there is none, None if mis_name is unknown. It must be given back
+    with release() once the request is processed.
+    """
+    def acquire(self, mis_name, api_key=""):
+        with self._lock:
+            instances = self._get_idle((mis_name, api_key))
+            if instances:
+                self._reused += 1
+                return instances.pop()
+        mis = get_mis_api(mis_name, api_key)
+        if mis:
+            with self._lock:
+                self._created += 1
+        return mis
+
+    """
+    Give back a MisApi object got from acquire(). Its reset() method, if any,
+    is called so that it doesn't keep per-request state (such as an open
+    database transaction). It is dropped if it is not reusable (the request
+    failed with an unexpected error) or if reset() fails.
+    """
+    def release(self, mis_name, api_key, mis, reusable=True):
+        reset = getattr(mis, "reset", None)
+        if reset:
+            try:
+                reset()
+            except:
+                logging.error(format_exc())
+                reusable = False
+        if not reusable:
+            return
+        with self._lock:
+            instances = self._get_idle((mis_name, api_key))
+            if len(instances) < self._max_idle:
+                instances.append(mis)
+
+    def clear(self):
+        with self._lock:
+            self._idle.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {"created" : self._created,
+                    "reused" : self._reused,
+                    "idle" : sum([len(x) for x in self._idle.values()])}
+
 def get_mis_or_abort(mis_name, api_key=""):
-    mis = get_mis_api(mis_name, api_key)
+    mis = mis_api_pool.acquire(mis_name, api_key)
     if not mis:
         abort(404, message="Mis <%s> not supported" % mis_name)
 
@@ -187,7 +295,11 @@ class RequestProcessor(object):
         self._mis_name = mis_name
         self._request = request
         self._start_date = datetime.datetime.now()
-        self._mis = get_mis_or_abort(mis_name, request.headers.get("Authorization", ""))
+        self._api_key = request.headers.get("Authorization", "")
+        self._mis = get_mis_or_abort(mis_name, self._api_key)
+        # Set when the MIS request failed with an unexpected error, in which
+        # case the MisApi object may be in an inconsistent state.
+        self._failed = False
 
         logging.debug("MIS NAME %s", mis_name)
         logging.debug("URL: %s", request.url)
@@ -198,6 +310,21 @@ class RequestProcessor(object):
         return None
 
     def process(self):
+        try:
+            return self._process()
+        except HTTPException:
+            # Request aborted (invalid parameters).
+            raise
+        except:
+            self._failed = True
+            raise
+        finally:
+            # Give MisApi object back to the pool, even if request was aborted.
+            mis_api_pool.release(self._mis_name, self._api_key, self._mis,
+                                 reusable=not self._failed)
+            self._mis = None
+
+    def _process(self):
         params = self._parse_request()
         self._resp = self._new_response()
 
@@ -210,6 +337,7 @@ class RequestProcessor(object):
             self._resp.Status = StatusType(Code=exc.error_code)
         except:
             logging.error(format_exc())
+            self._failed = True
             resp_code = 500
             self._resp.Status = StatusType(Code=StatusCodeEnum.INTERNAL_ERROR)
 
@@ -1,7 +1,8 @@
 # -*- coding: utf8 -*-
 
-import resources
+import resources, server
 from flask import Flask
+from werkzeug.serving import WSGIRequestHandler
 import flask_restful, logging, sys
 from logging.handlers import RotatingFileHandler
 import argparse, os, ConfigParser
@@ -10,6 +11,21 @@ def get_cmd_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", help="Configuration file")
     parser.add_argument("-l", "--log", help="Log file")
+    parser.add_argument("-b", "--bind", default=server.DEFAULT_OPTIONS["bind"],
+                        help="Address to listen on (HOST:PORT)")
+    parser.add_argument("-w", "--workers", type=int, default=0,
+                        help="Number of worker processes (requires gunicorn), "
+                             "0 to use the development server")
+    parser.add_argument("--threads", type=int, default=server.DEFAULT_OPTIONS["threads"],
+                        help="Number of threads per worker process")
+    parser.add_argument("--backlog", type=int, default=server.DEFAULT_OPTIONS["backlog"],
+                        help="Maximum number of pending connections")
+    parser.add_argument("--keep-alive", type=int, default=server.DEFAULT_OPTIONS["keepalive"],
+                        help="Seconds to wait for requests on a keep-alive connection")
+    parser.add_argument("--graceful-timeout", type=int,
+                        default=server.DEFAULT_OPTIONS["graceful_timeout"],
+                        help="Seconds given to workers to finish their requests "
+                             "when restarted (SIGHUP) or stopped")
 
     return parser.parse_args()
 
@@ -36,7 +52,7 @@ def init_logging(log_file):
         handler = RotatingFileHandler(log_file, maxBytes=4*1024*1024, backupCount=3)
     else:
         handler = logging.StreamHandler(stream=sys.stdout)
-    formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
+    formatter = logging.Formatter('%(asctime)s [%(process)d] [%(levelname)s] %(message)s')
     handler.setFormatter(formatter)
     root_logger = logging.getLogger()
     root_logger.setLevel(logging.DEBUG)
@@ -44,18 +60,49 @@ def init_logging(log_file):
 
     print "Logging to '%s'" % (log_file or "stdout")
 
+"""
+    Return a new Flask application serving MIS APIs enabled in config.
+    Called once per process serving requests.
+"""
+def create_app(config):
+    resources.load_mis_apis(config)
 
-args = get_cmd_args()
-init_logging(args.log)
-config = get_config(args)
+    app = Flask(__name__)
+    api = flask_restful.Api(app)
+    api.add_resource(resources.Stops, '/<string:mis_name>/v0/stops')
+    api.add_resource(resources.Capabilities, '/<string:mis_name>/v0/capabilities')
+    api.add_resource(resources.Itineraries, '/<string:mis_name>/v0/itineraries')
+    api.add_resource(resources.SummedUpItineraries, '/<string:mis_name>/v0/summed_up_itineraries')
 
-resources.load_mis_apis(config)
+    return app
 
-app = Flask(__name__)
-api = flask_restful.Api(app)
-api.add_resource(resources.Stops, '/<string:mis_name>/v0/stops')
-api.add_resource(resources.Capabilities, '/<string:mis_name>/v0/capabilities')
-api.add_resource(resources.Itineraries, '/<string:mis_name>/v0/itineraries')
-api.add_resource(resources.SummedUpItineraries, '/<string:mis_name>/v0/summed_up_itineraries')
 
-app.run(debug=False)
+# Keep connections alive between requests (werkzeug defaults to HTTP/1.0).
+class _RequestHandler(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+
+def main():
+    args = get_cmd_args()
+    init_logging(args.log)
+    config = get_config(args)
+
+    if args.workers > 0:
+        if not server.is_available():
+            logging.error("gunicorn is required to run %s worker processes", args.workers)
+            exit(1)
+        # One-time initializations (stub MIS databases) are done before
+        # workers are forked, workers then load MIS APIs on their own.
+        resources.load_mis_apis(config)
+        resources.init_mis_apis()
+        server.serve(lambda: create_app(config), bind=args.bind, workers=args.workers,
+                     threads=args.threads, backlog=args.backlog,
+                     keepalive=args.keep_alive, graceful_timeout=args.graceful_timeout)
+    else:
+        host, _, port = args.bind.rpartition(":")
+        create_app(config).run(host=host or None, port=int(port), debug=False,
+                               threaded=True, request_handler=_RequestHandler)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+    Production server of the mis_translator.
+
+    A gunicorn master process manages a pool of worker processes, each of
+    them serving requests with a pool of threads and keep-alive connections.
+    Every worker creates its own Flask application (and so loads MIS APIs)
+    once, when it starts. Sending SIGHUP to the master process gracefully
+    restarts workers: running requests are completed (within graceful_timeout
+    seconds) before old workers exit.
+
+    gunicorn is an optional dependency, only needed by that serving mode.
+"""
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = None
+
+
+DEFAULT_OPTIONS = {
+    "bind" : "127.0.0.1:5000",
+    "workers" : 4,
+    "threads" : 8, # Threads per worker process
+    "backlog" : 2048, # Maximum number of pending connections
+    "keepalive" : 5, # In seconds
+    "graceful_timeout" : 30, # In seconds
+    "timeout" : 120, # Workers silent for more than that many seconds are restarted
+}
+
+
+def is_available():
+    return BaseApplication is not None
+
+
+if BaseApplication is not None:
+    class TranslatorApplication(BaseApplication):
+        # app_factory is called in every worker process, it must return the
+        # WSGI application.
+        def __init__(self, app_factory, options):
+            self._app_factory = app_factory
+            self._options = options
+            super(TranslatorApplication, self).__init__()
+
+        def load_config(self):
+            for k, v in self._options.items():
+                self.cfg.set(k, v)
+
+        def load(self):
+            return self._app_factory()
+
+
+"""
+    Serve application returned by app_factory with gunicorn, see
+    DEFAULT_OPTIONS for available options (any gunicorn setting can be given).
+    Return when the master process is stopped.
+"""
+def serve(app_factory, **options):
+    if BaseApplication is None:
+        raise RuntimeError("gunicorn is not installed")
+
+    opts = dict(DEFAULT_OPTIONS)
+    opts.update([(k, v) for k, v in options.items() if v is not None])
+    if opts["threads"] > 1:
+        # Only threaded workers keep connections alive.
+        opts.setdefault("worker_class", "gthread")
+    TranslatorApplication(app_factory, opts).run()
@@ -1,32 +1,34 @@
-import logging, os, json, httplib2
-from datetime import datetime, timedelta
+import logging, os, json, calendar
+from datetime import timedelta
+from functools import partial
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, scoped_session
-from apiisim.common.mis_plan_trip import ItineraryResponseType, ItineraryRequestType, \
-                                         LineType, PTNetworkType
+from apiisim.common.mis_plan_trip import ItineraryResponseType, ItineraryRequestType
 from apiisim.common.plan_trip import PlanTripRequestType, \
                                      PlanTripExistenceNotificationResponseType, \
                                      PlanTripNotificationResponseType, \
                                      PlanTripResponse, EndingSearch, StartingSearch, \
-                                     AbstractNotificationResponseType, StepEndPointType, \
-                                     EndPointType, TripStopPlaceType, LocationStructure, \
-                                     TripType, StepType, PTRideType, LegType, SectionType, \
+                                     AbstractNotificationResponseType, LocationStructure, \
                                      PartialTripType, ComposedTripType, ProviderType
 from apiisim.common.mis_plan_summed_up_trip import LocationContextType, \
                                                    SummedUpItinerariesResponseType, \
                                                    StatusType, SummedUpTripType, \
                                                    SummedUpItinerariesRequestType
-from apiisim.common import OUTPUT_ENCODING, StatusCodeEnum, xsd_duration_to_timedelta, \
-                           TypeOfPlaceEnum
+from apiisim.common import OUTPUT_ENCODING, StatusCodeEnum
 from apiisim.common.marshalling import marshal, itinerary_request_type, \
                                summed_up_itineraries_request_type, \
                                summed_up_trip_type, \
                                plan_trip_existence_notification_response_type, \
                                plan_trip_notification_response_type, \
                                plan_trip_response_type, ending_search_type, \
-                               starting_search_type, DATE_FORMAT, \
+                               starting_search_type, \
                                plan_trip_cancellation_response_type
-from apiisim import metabase
+from apiisim.planner.mis_topology import MisTopologyCache, MIS_SHAPES
+from apiisim.planner.trip_decoder import decode_detailed_trip, decode_end_point
+from apiisim.planner.transfer_cache import TransferCache
+from apiisim.planner.coroutines import Return, run_sync
+from apiisim.common.http_pool import HttpConnectionPool
+from apiisim.common.cache import LruCache
 
 
 class PlannerException(Exception):
@@ -90,129 +92,49 @@ SummedUpTripType.__repr__ = _repr
 
 ################################################################################
 
-def benchmark(func):
-    def decorator(*args, **kwargs):
-        start_date = datetime.now()
-        logging.debug("%s(%s %s) | START: %s", func.__name__, args, kwargs, start_date)
-
-        result = func(*args, **kwargs)
-
-        end_date = datetime.now()
-        logging.debug("%s(%s %s) | END: %s | DURATION: %ss",
-            func.__name__, args, kwargs, end_date,
-            (end_date - start_date).total_seconds())
-        return result
-
-    return decorator
-
-def parse_end_point(point, step_end_point=False):
-    if step_end_point:
-        ret = StepEndPointType()
-        ret.PassThrough = point.get("PassThrough", False)
-    else:
-        ret = EndPointType()
-
-    place = TripStopPlaceType()
-    p = point["TripStopPlace"]
-    place.id = p["id"]
-    place.Name = p.get("Name", None)
-    place.CityCode = p.get("CityCode", None)
-    place.CityName = p.get("CityName", None)
-    place.TypeOfPlaceRef = p.get("TypeOfPlaceRef", TypeOfPlaceEnum.LOCATION)
-    if "Position" in p:
-        place.Position = LocationStructure(
-                            Latitude=p["Position"]["Latitude"],
-                            Longitude=p["Position"]["Longitude"])
-
-    ret.TripStopPlace = place
-    ret.DateTime = datetime.strptime(point["DateTime"], DATE_FORMAT)
-    return ret
-
-
 def parse_summed_up_trips(trips):
     ret = [] # [summedUpTripType]
     for trip in trips:
-        departure = parse_end_point(trip["Departure"])
-        arrival = parse_end_point(trip["Arrival"])
+        departure = decode_end_point(trip["Departure"])
+        arrival = decode_end_point(trip["Arrival"])
         ret.append(SummedUpTripType(
                         Departure=departure, Arrival=arrival,
                         InterchangeCount=trip["InterchangeCount"],
                         InterchangeDuration=trip["InterchangeDuration"]))
     return ret
 
-def parse_detailed_trip(trip):
-    if not trip:
-        return None
-
-    ret = TripType()
-
-    ret.Departure = parse_end_point(trip["Departure"])
-    ret.Arrival = parse_end_point(trip["Arrival"])
-    ret.Duration = xsd_duration_to_timedelta(trip["Duration"])
-    ret.Distance = trip.get("Distance", 0)
-    ret.Disrupted = trip.get("Disrupted", False)
-    ret.InterchangeNumber = trip.get("InterchangeNumber", 0)
-    ret.sections = parse_sections(trip["sections"])
-
-    return ret
-
-def parse_steps(steps):
-    ret = [] # [StepType]
-    for step in steps:
-        ret.append(
-                StepType(
-                    id=step["id"],
-                    Departure=parse_end_point(step["Departure"], step_end_point=True),
-                    Arrival=parse_end_point(step["Arrival"], step_end_point=True),
-                    Duration=xsd_duration_to_timedelta(step["Duration"])))
-    return ret
-
-
-def parse_sections(sections):
-    ret = []
-    for section in sections:
-        ptr = None
-        leg = None
-        if "PTRide" in section:
-            p = section["PTRide"]
-            ptr = PTRideType()
-
-            if "Line" in p:
-                line = LineType()
-                line.id = p["Line"]["id"]
-                line.Name = p["Line"]["Name"]
-                line.Number = p["Line"].get("Number", None)
-                line.PublishedName = p["Line"].get("PublishedName", None)
-                line.RegistrationNumber = p["Line"].get("RegistrationNumber", None)
-                ptr.Line = line
-
-            if "PTNetwork" in p:
-                network = PTNetworkType()
-                network.id = p["PTNetwork"]["id"]
-                network.Name = p["PTNetwork"]["Name"]
-                network.RegistrationNumber = p["PTNetwork"].get("RegistrationNumber", None)
-                ptr.PTNetwork = network
-
-            ptr.PublicTransportMode = p["PublicTransportMode"]
-            ptr.Departure = parse_end_point(p["Departure"])
-            ptr.Arrival = parse_end_point(p["Arrival"])
-            ptr.Duration = xsd_duration_to_timedelta(p["Duration"])
-            ptr.Distance = p.get("Distance", None)
-            ptr.StopHeadSign = p.get("StopHeadSign", None)
-            ptr.steps = parse_steps(p["steps"])
-        elif "Leg" in section:
-            l = section["Leg"]
-            leg = LegType()
-            leg.SelfDriveMode = l["SelfDriveMode"]
-            leg.Departure = parse_end_point(l["Departure"])
-            leg.Arrival = parse_end_point(l["Arrival"])
-            leg.Duration = xsd_duration_to_timedelta(l["Duration"])
-
-        ret.append(SectionType(
-                        PartialTripId=section.get("PartialTripId", None),
-                        PTRide=ptr, Leg=leg))
-
-    return ret
+def check_complete(resp, nb_expected):
+    if len(resp.summedUpTrips) < nb_expected:
+        raise Exception("Incomplete MIS reply: expected %s itineraries, got %s"
+                        % (nb_expected, len(resp.summedUpTrips)))
+
+"""
+    Return {PlaceTypeId : earliest departure time} of departure stops of given
+    SummedUpItinerariesRequestType if it is a departure_at request,
+    {PlaceTypeId : latest arrival time} of arrival stops otherwise.
+"""
+def trip_time_limits(request):
+    if request.DepartureTime:
+        date_time, stops = request.DepartureTime, request.departures
+    else:
+        date_time, stops = request.ArrivalTime, request.arrivals
+    return dict([(x.PlaceTypeId, date_time + (x.AccessTime or timedelta()))
+                 for x in stops])
+
+# Return trips of request that respect given limits (see trip_time_limits()),
+# in the same order.
+def filter_trips(trips, request, limits):
+    if request.DepartureTime:
+        return [x for x in trips
+                if x.Departure.DateTime >= limits.get(x.Departure.TripStopPlace.id,
+                                                      request.DepartureTime)]
+    return [x for x in trips
+            if x.Arrival.DateTime <= limits.get(x.Arrival.TripStopPlace.id,
+                                                request.ArrivalTime)]
+
+def trip_pairs(trips):
+    return set([(x.Departure.TripStopPlace.id, x.Arrival.TripStopPlace.id)
+                for x in trips])
 
 def stop_to_trace_stop(stop):
     ret = TraceStop()
@@ -261,11 +183,6 @@ def create_full_notification(request_id, trace_id, full_trip, runtime_duration):
 
 
 class TraceStop(LocationContextType):
-    def __init__(self, *args, **kwargs):
-        super(TraceStop, self).__init__(*args, **kwargs)
-        self.departure_time = None
-        self.arrival_time = None
-
     def __eq__(self, other):
         return self.PlaceTypeId == other.PlaceTypeId
 
@@ -278,14 +195,125 @@ class TraceStop(LocationContextType):
                 .encode(OUTPUT_ENCODING)
 
 
+"""
+    Request to be sent to a MIS translator. PlanTripCalculator coroutines yield
+    MisCall objects, which are either run in the current thread (run()), or
+    sent by an event loop, parse() being called on the response.
+    If cache (an LruCache) is given, successful responses are stored in it
+    under cache_key, and reused by subsequent calls with the same cache_key.
+"""
+class MisCall(object):
+    def __init__(self, url, headers, body, parser, cache=None, cache_key=None):
+        self.url = url
+        self.headers = headers
+        self.body = body
+        self._parser = parser
+        self._cache = cache
+        self._cache_key = cache_key
+        logging.debug("<MIS REQUEST>\n"
+                      "URL: \n%s\n"
+                      "DATA: \n%s", url, body)
+
+    # Return result of the call given the HTTP response.
+    def parse(self, status, content):
+        if status != 200:
+            # TODO error handling (raise exception)
+            logging.error("POST <%s> FAILED: %s" % (self.url, status))
+        logging.debug("Content: \n%s", content)
+        return self._parser(json.loads(content))
+
+    # Identifies identical requests, see coalescing module.
+    def key(self):
+        return (self.url, self.body)
+
+    # Return content of a cached response, None if there is none.
+    def get_cached_response(self):
+        if self._cache is None:
+            return None
+        return self._cache.get(self._cache_key)
+
+    # Must only be called once the response has been successfully parsed.
+    def cache_response(self, status, content):
+        if self._cache is not None and status == 200:
+            self._cache.put(self._cache_key, content)
+
+    # Send request and return (status, content).
+    def send(self, cancel_token=None):
+        resp, content = MisApi.http_pool.request(self.url, "POST", headers=self.headers,
+                                                 body=self.body, cancel_token=cancel_token)
+        logging.debug("Response: \n%s %s", resp.status, resp.getheaders())
+        return resp.status, content
+
+    # Send request and wait for its response. cancel_token is a
+    # cancellation.CancelToken that aborts the request once cancelled.
+    # If coalescer (a coalescing.RequestCoalescer) is given, the response of
+    # an identical request is used if there is one.
+    def run(self, cancel_token=None, coalescer=None):
+        content = self.get_cached_response()
+        if content is not None:
+            return self.parse(200, content)
+        if coalescer is not None:
+            status, content = coalescer.run(self.key(), partial(self.send, cancel_token))
+        else:
+            status, content = self.send(cancel_token)
+        ret = self.parse(status, content)
+        self.cache_response(status, content)
+        return ret
+
+    def __repr__(self):
+        return "<MisCall(url='%s')>" % self.url
+
+
 class MisApi(object):
-    def __init__(self, db_session, id):
-        mis = db_session.query(metabase.Mis).filter_by(id=id).one()
+    # Keep-alive connections to MIS translators, shared by all instances.
+    http_pool = HttpConnectionPool()
+    # Summed-up itineraries responses, shared by all instances, see
+    # configure_summed_up_cache().
+    SUMMED_UP_CACHE_SIZE = 10000
+    SUMMED_UP_CACHE_TTL = 60 # In seconds
+    SUMMED_UP_CACHE_TIME_BUCKET = 60 # In seconds
+    summed_up_cache = LruCache(SUMMED_UP_CACHE_SIZE, SUMMED_UP_CACHE_TTL)
+    summed_up_time_bucket = SUMMED_UP_CACHE_TIME_BUCKET
+
+    """
+        Replace summed-up itineraries cache. Requests whose departure (or
+        arrival) times are in the same time_bucket seconds interval share the
+        same cached response, see summed_up_itineraries(). A size of 0 disables
+        the cache.
+    """
+    @classmethod
+    def configure_summed_up_cache(cls, size, ttl, time_bucket):
+        cls.summed_up_cache = LruCache(size, ttl) if size > 0 else None
+        cls.summed_up_time_bucket = max(1, time_bucket)
+
+    # Remove cached responses of MIS mis_name, return number of removed entries.
+    @classmethod
+    def purge_summed_up_cache(cls, mis_name):
+        if cls.summed_up_cache is None:
+            return 0
+        return cls.summed_up_cache.purge(lambda key: key[0] == mis_name)
+
+    """
+        Return {"hits" : number of requests answered from the cache,
+                "misses" : number of requests sent to a MIS,
+                "hit_rate" : hits / (hits + misses),
+                "size" : number of cached responses}
+    """
+    @classmethod
+    def get_summed_up_cache_stats(cls):
+        if cls.summed_up_cache is None:
+            return {"hits" : 0, "misses" : 0, "hit_rate" : 0.0, "size" : 0}
+        hits, misses = cls.summed_up_cache.get_stats()
+        return {"hits" : hits, "misses" : misses,
+                "hit_rate" : (float(hits) / (hits + misses)) if (hits + misses) else 0.0,
+                "size" : len(cls.summed_up_cache)}
+
+    # mis is either a metabase.Mis object or a mis_topology.MisInfo object.
+    def __init__(self, mis):
         self._api_url = mis.api_url
         self._api_key = mis.api_key
         self._name = mis.name
         self._multiple_starts_and_arrivals = mis.multiple_starts_and_arrivals
-        self._http = httplib2.Http()
 
     def get_multiple_starts_and_arrivals(self):
         return self._multiple_starts_and_arrivals
@@ -298,40 +326,36 @@ class MisApi(object):
 
     # Should not be hard-coded but it will do the job for now.
     def get_shape(self):
-        if self._name == "paysdelaloire":
-            return "POLYGON((-2.557442956 46.26975161,-2.557442956 48.56805252," \
-                   "0.915342221 48.56805252,0.915342221 46.26975161,-2.557442956 46.26975161))"
-        elif self._name == "transilien":
-            return "POLYGON((1.447406441 48.12237262,1.447406441 " \
-                   "49.2334534,3.54286966 49.2334534,3.54286966 48.12237262,1.447406441 48.12237262))"
-        elif self._name == "bretagne":
-            return "POLYGON((-5.139900401 47.27952014,-5.139900401 48.87967361," \
-                   "-1.013521807 48.87967361,-1.013521807 47.27952014,-5.139900401 47.27952014))"
-        else:
-            return None
+        return MIS_SHAPES.get(self._name, None)
 
-    def _send_request(self, resource, data):
+    def _new_call(self, resource, data, parser, cache=None, cache_key=None):
         url = self._api_url + ("/" if self._api_url[-1] != "/" else "") + resource
-        logging.debug("<MIS REQUEST>\n"
-                      "URL: \n%s\n"
-                      "DATA: \n%s", url, json.dumps(data))
         headers = {'Content-type': 'application/json',
                    'Authorization' : self._api_key}
-        resp, content = self._http.request(url, "POST", headers=headers, body=json.dumps(data))
-        if resp.status != 200:
-            # TODO error handling (raise exception)
-            logging.error("POST <%s> FAILED: %s" % (url, resp.status))
-
-        logging.debug("Response: \n%s", resp)
-        logging.debug("Content: \n%s", content)
-        return resp, json.loads(content)
-
-    # request is an object of class ItineraryRequestType
-    def get_itinerary(self, request):
+        return MisCall(url, headers, json.dumps(data), parser, cache, cache_key)
+
+    """
+        Key of summed-up itineraries cache: departure and arrival stops (as in
+        data, the marshalled request), departure or arrival time bucket, modes,
+        algorithm, accessibility constraint and other request options.
+    """
+    def _summed_up_cache_key(self, request, data):
+        date_time = request.DepartureTime or request.ArrivalTime
+        time_key = (bool(request.DepartureTime),
+                    calendar.timegm(date_time.utctimetuple()) // self.summed_up_time_bucket)
+        return (self._name,
+                tuple([json.dumps(x, sort_keys=True) for x in data.get("departures", None) or []]),
+                tuple([json.dumps(x, sort_keys=True) for x in data.get("arrivals", None) or []]),
+                time_key,
+                tuple(sorted(data.get("modes", None) or [])),
+                data.get("Algorithm", None),
+                data.get("AccessibilityConstraint", None),
+                json.dumps(data.get("selfDriveConditions", None), sort_keys=True),
+                data.get("Language", None),
+                tuple(data.get("options", None) or []))
+
+    def _parse_itinerary_response(self, content):
         ret = ItineraryResponseType()
-
-        data = request.marshal()
-        _, content = self._send_request("itineraries", data)
         # TODO error handling
         content = content["ItineraryResponseType"]
         ret.RequestId = content["RequestId"]
@@ -339,26 +363,15 @@ class MisApi(object):
                                 content["Status"].get("RuntimeDuration", 0))
         if ret.Status.Code != StatusCodeEnum.OK:
             raise Exception("<get_itinerary> %s" % ret.Status.Code)
-        ret.DetailedTrip = parse_detailed_trip(content.get("DetailedTrip", None))
+        ret.DetailedTrip = decode_detailed_trip(content.get("DetailedTrip", None))
         if ret.DetailedTrip:
             ret.DetailedTrip.id = self._name
 
         return ret
 
-    # request is an object of class SummedUpItinerariesRequestType
-    # If must_be_complete is True, an exception is raised if MIS response
-    # doesn't contain an itinerary for each given arrival point (if
-    # it is a departure_at request). If it is an arrival_at request, it ensures
-    # that MIS response contains an itinerary for each given departure point.
-    def get_summed_up_itineraries(self, request, must_be_complete=False):
+    # nb_expected: minimum number of itineraries the response must contain.
+    def _parse_summed_up_itineraries_response(self, nb_expected, content):
         ret = SummedUpItinerariesResponseType()
-
-        # data = {"SummedUpItinerariesRequestType" : request.marshal()}
-        # Remove duplicates
-        request.departures = list(set(request.departures))
-        request.arrivals = list(set(request.arrivals))
-        data = request.marshal()
-        _, content = self._send_request("summed_up_itineraries", data)
         # TODO error handling
         content = content["SummedUpItinerariesResponseType"]
         ret.RequestId = content["RequestId"]
@@ -367,17 +380,97 @@ class MisApi(object):
         if ret.Status.Code != StatusCodeEnum.OK:
             raise Exception("<get_summed_up_itineraries> %s" % ret.Status.Code)
         ret.summedUpTrips = parse_summed_up_trips(content.get("summedUpTrips", []))
+        check_complete(ret, nb_expected)
+
+        return ret
+
+    # request is an object of class ItineraryRequestType
+    # Return a MisCall whose result is an ItineraryResponseType object.
+    def itinerary_call(self, request):
+        return self._new_call("itineraries", request.marshal(),
+                              self._parse_itinerary_response)
+
+    def get_itinerary(self, request):
+        return self.itinerary_call(request).run()
+
+    # Return marshalled request, its departure (arrival) time being moved to
+    # the beginning (end) of its time bucket.
+    def _marshal_bucket_request(self, request):
+        attr = "DepartureTime" if request.DepartureTime else "ArrivalTime"
+        date_time = getattr(request, attr)
+        offset = calendar.timegm(date_time.utctimetuple()) % self.summed_up_time_bucket
+        bucket_time = date_time - timedelta(seconds=offset,
+                                            microseconds=date_time.microsecond)
+        if attr == "ArrivalTime":
+            bucket_time += timedelta(seconds=self.summed_up_time_bucket - 1)
+        setattr(request, attr, bucket_time)
+        try:
+            return request.marshal()
+        finally:
+            setattr(request, attr, date_time)
 
+    # request is an object of class SummedUpItinerariesRequestType
+    # If must_be_complete is True, an exception is raised if MIS response
+    # doesn't contain an itinerary for each given arrival point (if
+    # it is a departure_at request). If it is an arrival_at request, it ensures
+    # that MIS response contains an itinerary for each given departure point.
+    # If the cache is enabled and use_cache is True, the MIS is asked for
+    # the beginning (end) of the time bucket of the request and completeness
+    # isn't checked, see summed_up_itineraries().
+    # Return a MisCall whose result is a SummedUpItinerariesResponseType object.
+    def summed_up_itineraries_call(self, request, must_be_complete=False, use_cache=True):
+        # data = {"SummedUpItinerariesRequestType" : request.marshal()}
+        # Remove duplicates, stops are sorted so that identical requests have
+        # identical bodies.
+        request.departures = sorted(set(request.departures), key=lambda x: x.PlaceTypeId)
+        request.arrivals = sorted(set(request.arrivals), key=lambda x: x.PlaceTypeId)
+        if use_cache and self.summed_up_cache is not None:
+            data = self._marshal_bucket_request(request)
+            return self._new_call("summed_up_itineraries", data,
+                                  partial(self._parse_summed_up_itineraries_response, 0),
+                                  self.summed_up_cache,
+                                  self._summed_up_cache_key(request, data))
+
+        nb_expected = 0
         if must_be_complete:
             if request.DepartureTime:
                 nb_expected = len(request.arrivals)
             else:
                 nb_expected = len(request.departures)
-            if len(ret.summedUpTrips) < nb_expected:
-                raise Exception("Incomplete MIS reply: expected %s itineraries, got %s"
-                                % (nb_expected, len(ret.summedUpTrips)))
+        return self._new_call("summed_up_itineraries", request.marshal(),
+                              partial(self._parse_summed_up_itineraries_response,
+                                      nb_expected))
+
+    """
+        Coroutine returning the SummedUpItinerariesResponseType of request,
+        see summed_up_itineraries_call(). Responses found in the cache were
+        computed for the beginning (end) of the time bucket: trips leaving
+        before the requested departure time (arriving after the arrival time)
+        are removed from them. If a departure/arrival pair loses all its trips
+        that way, the MIS is asked again for the requested time.
+    """
+    def summed_up_itineraries(self, request, must_be_complete=False):
+        if self.summed_up_cache is None:
+            resp = yield self.summed_up_itineraries_call(request, must_be_complete)
+            raise Return(resp)
+
+        limits = trip_time_limits(request)
+        resp = yield self.summed_up_itineraries_call(request, must_be_complete)
+        trips = filter_trips(resp.summedUpTrips, request, limits)
+        if trip_pairs(trips) != trip_pairs(resp.summedUpTrips):
+            resp = yield self.summed_up_itineraries_call(request, must_be_complete,
+                                                         use_cache=False)
+            raise Return(resp)
+
+        resp.summedUpTrips = trips
+        if must_be_complete:
+            check_complete(resp, len(request.arrivals if request.DepartureTime \
+                                     else request.departures))
+        raise Return(resp)
 
-        return ret
+    def get_summed_up_itineraries(self, request, must_be_complete=False):
+        return run_sync(self.summed_up_itineraries(request, must_be_complete),
+                        lambda call: call.run())
 
     def __repr__(self):
         return (u"<MisApi(name='%s')>" % \
@@ -385,6 +478,19 @@ class MisApi(object):
                 .encode(OUTPUT_ENCODING)
 
 
+"""
+    Called when a new back_office import is detected (see MisTopologyCache):
+    MIS data may have changed since cached MIS responses were received, they
+    must not be used anymore.
+"""
+def on_topology_reload(previous, topology):
+    for mis in previous.get_mises():
+        nb_purged = MisApi.purge_summed_up_cache(mis.name)
+        if nb_purged:
+            logging.info("New back_office import (%s), %s cached responses of %s purged",
+                         topology.generation, nb_purged, mis.name)
+
+
 class Planner(object):
     def __init__(self, db_url):
         # Create engine used to connect to database
@@ -395,6 +501,8 @@ class Planner(object):
         self._db_session_factory = scoped_session(sessionmaker(
                                                         bind=self._db_engine, 
                                                         expire_on_commit=False))
+        self._topology_cache = MisTopologyCache(on_reload=on_topology_reload)
+        self._transfer_cache = TransferCache()
 
     def __del__(self):
         # Not mandatory but a good way to ensure that no connection to the database
@@ -407,3 +515,10 @@ class Planner(object):
     def remove_db_session(self, db_session):
         db_session.close()
         self._db_session_factory.remove()
+
+    def get_topology(self, db_session):
+        return self._topology_cache.get(db_session)
+
+    # Return tuple of transfer_cache.TransferInfo, see TransferCache.get()
+    def get_transfers(self, db_session, generation, mis1_id, mis2_id):
+        return self._transfer_cache.get(db_session, generation, mis1_id, mis2_id)
@@ -0,0 +1,217 @@
+"""
+    Event loop based alternative to the WorkerPool.
+
+    Traces are computed by PlanTripCalculator.compute_trip_coroutine()
+    coroutines, all run by a single thread. MIS calls they yield are sent with
+    a non-blocking HTTP client, so that the number of MIS requests in flight
+    does not depend on the number of threads.
+    AsyncEngine has the same interface as WorkerPool (start(), stop(),
+    submit()), both can be used by planner_wsh.
+
+    Database accesses (only needed when transfers are not in the transfer
+    cache yet) are still blocking and done from the loop thread, with a
+    session owned by this thread.
+"""
+import logging, sys
+from collections import deque
+from functools import partial
+from apiisim.common.cancellation import CancelledError
+from apiisim.common.metrics import record, monotonic
+from apiisim.planner.coroutines import Task
+from apiisim.planner.event_loop import EventLoop, AsyncHttpClient
+from apiisim.planner.plan_trip_calculator import PlanTripCalculator
+from apiisim.planner.worker_pool import JobGroup, pop_next_job
+
+
+class AsyncEngine(object):
+    # Maximum number of traces computed at the same time
+    DEFAULT_MAX_TASKS = 1000
+    DEFAULT_MAX_TASKS_PER_REQUEST = 50
+
+    def __init__(self, planner, max_tasks=DEFAULT_MAX_TASKS,
+                 max_tasks_per_request=DEFAULT_MAX_TASKS_PER_REQUEST,
+                 max_connections_per_host=AsyncHttpClient.DEFAULT_MAX_PER_HOST):
+        self._planner = planner
+        self._max_tasks = max(1, max_tasks)
+        self._max_tasks_per_request = max(1, max_tasks_per_request)
+        self._loop = EventLoop()
+        self._http = AsyncHttpClient(self._loop, max_per_host=max_connections_per_host)
+        # Following attributes are only used from the loop thread.
+        self._groups = deque() # Groups that still have pending traces
+        self._running = 0
+        self._exchanges = {} # {JobGroup : set([HttpExchange])}, requests in flight
+        self._db_session = None
+
+    def start(self):
+        self._loop.call_soon(self._init_db_session)
+        self._loop.start_thread("PlannerEventLoop")
+        logging.info("<AsyncEngine> event loop started")
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._remove_db_session)
+        self._loop.stop()
+        self._loop.join()
+
+    def _init_db_session(self):
+        self._db_session = self._planner.create_db_session()
+
+    def _remove_db_session(self):
+        if self._db_session:
+            self._planner.remove_db_session(self._db_session)
+            self._db_session = None
+
+    """
+        Submit traces of given request, return the corresponding JobGroup,
+        see WorkerPool.submit(). Can be called from any thread.
+    """
+    def submit(self, params, traces, notif_queue, pruner=None, request_timings=None,
+               topology=None):
+        if params.MaxTrips:
+            traces = traces[:params.MaxTrips]
+        max_tasks = min(self._max_tasks_per_request, len(traces) or 1)
+        group = JobGroup(params, traces, notif_queue, max_tasks, pruner, request_timings,
+                         topology)
+        if not group.pending:
+            group._set_finished()
+            return group
+        self._loop.call_soon_threadsafe(self._add_group, group)
+        group.cancel_token.add_callback(
+                    partial(self._loop.call_soon_threadsafe, self._cancel, group))
+        return group
+
+    # Drop pending traces of given group and abort its requests in flight.
+    def _cancel(self, group):
+        group.dropped += len(group.pending)
+        group.pending.clear()
+        if group in self._groups:
+            self._groups.remove(group)
+        for exchange in list(self._exchanges.pop(group, [])):
+            exchange.cancel()
+        if group.running == 0:
+            group._set_finished()
+
+    def get_stats(self):
+        stats = self._http.get_stats()
+        stats["running"] = self._running
+        return stats
+
+    def _add_group(self, group):
+        self._groups.append(group)
+        self._schedule()
+
+    def _schedule(self):
+        while self._running < self._max_tasks:
+            group, trace = pop_next_job(self._groups)
+            if group is None:
+                break
+            self._running += 1
+            self._start_task(group, trace)
+
+    def _start_task(self, group, trace):
+        try:
+            calculator = PlanTripCalculator(self._planner, group.params,
+                                            group.notif_queue, self._db_session,
+                                            group.request_timings, group.topology)
+            task = Task(calculator.compute_trip_coroutine(trace))
+        except Exception as e:
+            logging.error("compute_trip(%s): %s", trace, e, exc_info=True)
+            self._task_done(group, False)
+            return
+        self._resume(task, group, trace)
+
+    def _resume(self, task, group, trace, value=None, exc_info=None):
+        try:
+            call = task.step(value, exc_info)
+        except Exception as e:
+            if group.is_cancelled():
+                logging.debug("compute_trip(%s) cancelled: %s", trace, e)
+            else:
+                logging.error("compute_trip(%s): %s", trace, e, exc_info=True)
+            self._task_done(group, False)
+            return
+        finally:
+            # Release database connection while waiting for MIS responses.
+            if self._db_session:
+                self._db_session.close()
+
+        if task.done:
+            self._task_done(group, True, task.result)
+            return
+
+        if group.is_cancelled():
+            self._loop.call_soon(self._resume, task, group, trace, None,
+                                 (CancelledError, CancelledError(), None))
+            return
+
+        start = monotonic()
+        def on_response(flight):
+            if flight.exc_info is not None:
+                self._resume(task, group, trace, exc_info=flight.exc_info)
+                return
+            try:
+                value = call.parse(flight.status, flight.content)
+                call.cache_response(flight.status, flight.content)
+            except Exception:
+                self._resume(task, group, trace, exc_info=sys.exc_info())
+                return
+            record("mis_call", monotonic() - start, group.request_timings)
+            self._resume(task, group, trace, value)
+
+        content = call.get_cached_response()
+        if content is not None:
+            self._loop.call_soon(self._resume_cached, task, group, trace, call, content,
+                                 start)
+            return
+
+        # Identical requests of other traces of the same group are only sent
+        # once.
+        key = call.key()
+        flight, leader = group.coalescer.join(key)
+        if not leader:
+            flight.add_callback(lambda flight: self._loop.call_soon(on_response, flight))
+            return
+        flight.add_callback(on_response)
+
+        exchanges = self._exchanges.setdefault(group, set())
+        sent = [] # Request, once sent (callback may be called before)
+        def on_sent(status, headers, content, error):
+            for x in sent:
+                exchanges.discard(x)
+            exc_info = (type(error), error, None) if error is not None else None
+            group.coalescer.finish(key, flight, status, content, exc_info)
+
+        try:
+            exchange = self._http.request(call.url, "POST", call.headers, call.body,
+                                          on_sent)
+            if not exchange.done:
+                sent.append(exchange)
+                exchanges.add(exchange)
+        except Exception:
+            exc_info = sys.exc_info()
+            self._loop.call_soon(group.coalescer.finish, key, flight, None, None, exc_info)
+
+    def _resume_cached(self, task, group, trace, call, content, start):
+        try:
+            value = call.parse(200, content)
+        except Exception:
+            self._resume(task, group, trace, exc_info=sys.exc_info())
+            return
+        record("mis_call", monotonic() - start, group.request_timings)
+        self._resume(task, group, trace, value)
+
+    def _task_done(self, group, success, trip=None):
+        self._running -= 1
+        group.running -= 1
+        if success:
+            group.succeeded += 1
+            group.add_trip(trip)
+            if not group.pending and group in self._groups:
+                self._groups.remove(group)
+        else:
+            group.failed += 1
+        if not group.pending and group.running == 0:
+            self._exchanges.pop(group, None)
+            group._set_finished()
+        # Not called directly to avoid deep recursions when tasks fail
+        # immediately.
+        self._loop.call_soon(self._schedule)
@@ -0,0 +1,114 @@
+"""
+    Coalescing of identical MIS requests sent while computing the traces of a
+    given PlanTrip request.
+
+    Traces often share a prefix (e.g. [A, B] and [A, B, C]), their first MIS
+    requests are then identical. Requests are identified by their URL and
+    their marshalled body: the first caller (the "leader") sends the request,
+    other callers wait for its response instead of sending the same request
+    again. Responses are kept until the PlanTrip request is finished, so that
+    identical requests sent later share it as well.
+    Only the raw response is shared, each caller parses it, as parsed objects
+    are modified while computing trips.
+"""
+import sys, threading
+
+
+class _Flight(object):
+    def __init__(self):
+        self.status = None
+        self.content = None
+        self.exc_info = None # Set if request failed
+        self._done = threading.Event()
+        self._callbacks = []
+
+    def is_done(self):
+        return self._done.is_set()
+
+    # callback(flight) is called once the response has been received, it is
+    # called immediately if it already has been.
+    def add_callback(self, callback):
+        if self.is_done():
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def wait(self):
+        self._done.wait()
+
+    def _finish(self, status, content, exc_info):
+        self.status = status
+        self.content = content
+        self.exc_info = exc_info
+        self._done.set()
+        callbacks = self._callbacks
+        self._callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+
+class RequestCoalescer(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {} # {(url, body) : _Flight}
+        self._calls = 0
+        self._sent = 0
+
+    """
+        Return (flight, leader). If leader is True, the caller must send the
+        request and give its response to finish().
+    """
+    def join(self, key):
+        with self._lock:
+            self._calls += 1
+            flight = self._flights.get(key, None)
+            if flight is not None:
+                return flight, False
+            flight = _Flight()
+            self._flights[key] = flight
+            self._sent += 1
+            return flight, True
+
+    """
+        Give the response of the request sent by the leader of flight to
+        every caller. Failed requests are forgotten, so that they can be sent
+        again by subsequent callers.
+    """
+    def finish(self, key, flight, status=None, content=None, exc_info=None):
+        if exc_info is not None:
+            with self._lock:
+                if self._flights.get(key, None) is flight:
+                    del self._flights[key]
+        flight._finish(status, content, exc_info)
+
+    """
+        Blocking version: send() is called if no identical request has been
+        sent yet, it returns (status, content). Return (status, content).
+    """
+    def run(self, key, send):
+        flight, leader = self.join(key)
+        if leader:
+            try:
+                status, content = send()
+            except:
+                exc_info = sys.exc_info()
+                self.finish(key, flight, exc_info=exc_info)
+                raise exc_info[0], exc_info[1], exc_info[2]
+            self.finish(key, flight, status, content)
+        else:
+            flight.wait()
+            if flight.exc_info is not None:
+                raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+        return flight.status, flight.content
+
+    """
+        Return {"calls" : number of MIS requests asked for,
+                "sent" : number of them actually sent,
+                "dedup_ratio" : proportion of requests not sent}
+    """
+    def get_stats(self):
+        with self._lock:
+            calls, sent = self._calls, self._sent
+        return {"calls" : calls,
+                "sent" : sent,
+                "dedup_ratio" : (float(calls - sent) / calls) if calls else 0.0}
@@ -0,0 +1,94 @@
+"""
+    Generator based coroutines.
+
+    A coroutine is a generator that yields either:
+        - another coroutine, which is run until it finishes, its result being
+          sent back to the calling coroutine,
+        - an operation (any other object), which is executed by whoever runs
+          the coroutine (blocking call in a thread, non-blocking call in an
+          event loop), its result being sent back to the coroutine, or its
+          exception raised in the coroutine.
+    Since generators cannot return values, a coroutine returns a value by
+    raising Return(value).
+
+        def get_trip(self):
+            resp = yield mis_api.itinerary_call(request)
+            raise Return(resp.DetailedTrip)
+"""
+import sys, types
+
+
+class Return(Exception):
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+
+"""
+    Running state of a coroutine and of the coroutines it has called.
+"""
+class Task(object):
+    def __init__(self, coroutine):
+        self._stack = [coroutine]
+        self.done = False
+        self.result = None
+
+    """
+        Resume task, sending it value (result of the last operation), or raising
+        exception described by exc_info (as returned by sys.exc_info()) in it.
+        Return next operation to execute, or None if task is finished, in which
+        case its result is in self.result. If the task raises an exception, it
+        is finished and the exception is raised by step().
+    """
+    def step(self, value=None, exc_info=None):
+        while True:
+            coroutine = self._stack[-1]
+            try:
+                if exc_info:
+                    yielded = coroutine.throw(*exc_info)
+                else:
+                    yielded = coroutine.send(value)
+            except Return as r:
+                value, exc_info = r.value, None
+            except StopIteration:
+                value, exc_info = None, None
+            except Exception:
+                value, exc_info = None, sys.exc_info()
+            else:
+                if isinstance(yielded, types.GeneratorType):
+                    self._stack.append(yielded)
+                    value, exc_info = None, None
+                    continue
+                return yielded
+
+            # Current coroutine is finished, go back to its caller.
+            self._stack.pop()
+            if not self._stack:
+                self.done = True
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                self.result = value
+                return None
+
+    # Stop task, running finally clauses of its coroutines.
+    def close(self):
+        while self._stack:
+            self._stack.pop().close()
+        self.done = True
+
+
+"""
+    Run coroutine in current thread, execute being called on every operation
+    it yields and returning the operation result. Return coroutine result.
+"""
+def run_sync(coroutine, execute):
+    task = Task(coroutine)
+    operation = task.step()
+    while not task.done:
+        try:
+            value = execute(operation)
+        except Exception:
+            operation = task.step(exc_info=sys.exc_info())
+        else:
+            operation = task.step(value)
+    return task.result
@@ -0,0 +1,510 @@
+"""
+    Single-threaded event loop and non-blocking HTTP client.
+
+    All callbacks are run in the loop thread. The only methods that can be
+    called from other threads are EventLoop.call_soon_threadsafe() and
+    EventLoop.stop().
+"""
+import errno, fcntl, heapq, logging, os, select, socket, threading, time
+from collections import deque
+from urlparse import urlsplit
+from apiisim.common.cancellation import CancelledError
+
+
+def _set_non_blocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class Timer(object):
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+
+class EventLoop(object):
+    def __init__(self):
+        self._readers = {} # {fd : callback}
+        self._writers = {} # {fd : callback}
+        self._registered = {} # {fd : poll mask}
+        self._poll = select.poll()
+        self._ready = deque() # [(callback, args)]
+        self._timers = [] # heap of Timer
+        self._lock = threading.Lock()
+        self._threadsafe = deque() # Filled by other threads
+        self._stopped = False
+        self._thread = None
+        # Written to by other threads to wake up the loop.
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        _set_non_blocking(self._wakeup_r)
+        _set_non_blocking(self._wakeup_w)
+        self.add_reader(self._wakeup_r, self._read_wakeup)
+
+    def call_soon(self, callback, *args):
+        self._ready.append((callback, args))
+
+    def call_soon_threadsafe(self, callback, *args):
+        with self._lock:
+            self._threadsafe.append((callback, args))
+        self._wakeup()
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(time.time() + delay, callback, args)
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, "x")
+        except OSError as exc:
+            # Pipe full, loop will wake up anyway.
+            if exc.errno != errno.EAGAIN:
+                raise
+
+    def _read_wakeup(self):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+
+    def _update_fd(self, fd):
+        mask = (select.POLLIN if fd in self._readers else 0) | \
+               (select.POLLOUT if fd in self._writers else 0)
+        if mask:
+            if self._registered.get(fd, None) != mask:
+                self._poll.register(fd, mask)
+                self._registered[fd] = mask
+        elif fd in self._registered:
+            self._poll.unregister(fd)
+            del self._registered[fd]
+
+    def add_reader(self, fd, callback):
+        self._readers[fd] = callback
+        self._update_fd(fd)
+
+    def remove_reader(self, fd):
+        self._readers.pop(fd, None)
+        self._update_fd(fd)
+
+    def add_writer(self, fd, callback):
+        self._writers[fd] = callback
+        self._update_fd(fd)
+
+    def remove_writer(self, fd):
+        self._writers.pop(fd, None)
+        self._update_fd(fd)
+
+    def _run_callback(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            logging.exception("<EventLoop> Error in callback %s", callback)
+
+    def _run_once(self):
+        timeout = -1 # Infinite, in milliseconds
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = max(0, int((self._timers[0].when - time.time()) * 1000) + 1)
+        try:
+            events = self._poll.poll(timeout)
+        except select.error as exc:
+            if exc.args[0] != errno.EINTR:
+                raise
+            events = []
+        for fd, event in events:
+            if event & (select.POLLIN | select.POLLERR | select.POLLHUP) \
+               and fd in self._readers:
+                self._ready.append((self._readers[fd], ()))
+            if event & (select.POLLOUT | select.POLLERR | select.POLLHUP) \
+               and fd in self._writers:
+                self._ready.append((self._writers[fd], ()))
+
+        now = time.time()
+        while self._timers and self._timers[0].when <= now:
+            timer = heapq.heappop(self._timers)
+            if not timer.cancelled:
+                self._ready.append((timer.callback, timer.args))
+
+        with self._lock:
+            self._ready.extend(self._threadsafe)
+            self._threadsafe.clear()
+
+        # Callbacks added while running current ones will be run next time.
+        for _ in range(len(self._ready)):
+            callback, args = self._ready.popleft()
+            self._run_callback(callback, args)
+
+    def run_forever(self):
+        self._stopped = False
+        while not self._stopped:
+            self._run_once()
+
+    def _set_stopped(self):
+        self._stopped = True
+
+    def stop(self):
+        self.call_soon_threadsafe(self._set_stopped)
+
+    # Run loop in a new daemon thread.
+    def start_thread(self, name="EventLoop"):
+        self._thread = threading.Thread(target=self.run_forever, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def join(self):
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+
+class HttpError(Exception):
+    pass
+
+class HttpCancelledError(HttpError, CancelledError):
+    def __init__(self):
+        HttpError.__init__(self, "Request cancelled")
+
+
+class _Connection(object):
+    def __init__(self, key, sock):
+        self.key = key
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.last_used = time.time()
+
+
+"""
+    HTTP request sent by AsyncHttpClient. cancel() can be called from the loop
+    thread to abort it, its callback then receives an HttpCancelledError.
+"""
+class HttpExchange(object):
+    def __init__(self, client, key, path, data, callback):
+        self._client = client
+        self.key = key
+        self.path = path
+        self.data = data # Raw request
+        self.callback = callback
+        self.conn = None
+        self.reused = False
+        self.sent = 0
+        self.buffer = ""
+        self.status = None
+        self.headers = None
+        self.body_mode = None # "length", "chunked" or "close"
+        self.body_length = 0
+        self.keep_alive = False
+        self.timer = None
+        self.done = False
+
+    def cancel(self):
+        self._client._finish(self, error=HttpCancelledError())
+
+
+class AsyncHttpClient(object):
+    DEFAULT_MAX_PER_HOST = 64
+    DEFAULT_IDLE_TIMEOUT = 30 # In seconds
+    DEFAULT_TIMEOUT = 120 # In seconds
+
+    def __init__(self, loop, max_per_host=DEFAULT_MAX_PER_HOST,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, timeout=DEFAULT_TIMEOUT):
+        self._loop = loop
+        self._max_per_host = max(1, max_per_host)
+        self._idle_timeout = idle_timeout
+        self._timeout = timeout
+        self._addresses = {} # {(host, port) : address}
+        self._idle = {} # {key : [_Connection]}, most recently used last
+        self._nb_connections = {} # {key : number of open connections}
+        self._waiting = {} # {key : deque([HttpExchange])}
+        self._opened = 0
+        self._reused = 0
+        self._evicted = 0
+        self._loop.call_later(self._idle_timeout, self._evict_idle)
+
+    def get_stats(self):
+        return {"opened" : self._opened,
+                "reused" : self._reused,
+                "evicted" : self._evicted,
+                "idle" : sum([len(x) for x in self._idle.values()]),
+                "waiting" : sum([len(x) for x in self._waiting.values()])}
+
+    """
+        Send request, callback(status, headers, content, error) being called
+        once done. Either error is None or status, headers and content are None.
+        Return an HttpExchange object.
+        Only plain HTTP URLs are supported.
+    """
+    def request(self, url, method, headers, body, callback):
+        parts = urlsplit(url)
+        if parts.scheme != "http":
+            raise HttpError("Unsupported URL scheme: %s" % parts.scheme)
+        host = parts.hostname
+        port = parts.port or 80
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        body = body or ""
+        lines = ["%s %s HTTP/1.1" % (method, path),
+                 "Host: %s" % parts.netloc,
+                 "Content-Length: %s" % len(body),
+                 "Accept-Encoding: identity"]
+        for k, v in (headers or {}).iteritems():
+            lines.append("%s: %s" % (k, v))
+        data = "\r\n".join(lines) + "\r\n\r\n" + body
+
+        exchange = HttpExchange(self, (host, port), path, data, callback)
+        exchange.timer = self._loop.call_later(self._timeout, self._finish, exchange,
+                                               None, HttpError("Request timed out"))
+        self._start(exchange)
+        return exchange
+
+    def _start(self, exchange):
+        key = exchange.key
+        idle = self._idle.get(key, [])
+        while idle:
+            conn = idle.pop()
+            self._loop.remove_reader(conn.fd)
+            if time.time() - conn.last_used <= self._idle_timeout:
+                self._reused += 1
+                self._send(exchange, conn, True)
+                return
+            self._close(conn)
+            self._evicted += 1
+
+        if self._nb_connections.get(key, 0) >= self._max_per_host:
+            self._waiting.setdefault(key, deque()).append(exchange)
+            return
+
+        try:
+            address = self._addresses.get(key, None)
+            if address is None:
+                # Blocking, but done only once per host.
+                address = socket.getaddrinfo(key[0], key[1], 0, socket.SOCK_STREAM)[0]
+                self._addresses[key] = address
+            family, socktype, proto, _, sockaddr = address
+            sock = socket.socket(family, socktype, proto)
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (socket.error, socket.gaierror) as exc:
+            self._finish(exchange, error=exc)
+            return
+        conn = _Connection(key, sock)
+        self._nb_connections[key] = self._nb_connections.get(key, 0) + 1
+        self._opened += 1
+        exchange.conn = conn
+        err = sock.connect_ex(sockaddr)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self._finish(exchange, error=socket.error(err, os.strerror(err)))
+            return
+        self._send(exchange, conn, False)
+
+    def _send(self, exchange, conn, reused):
+        exchange.conn = conn
+        exchange.reused = reused
+        exchange.sent = 0
+        exchange.buffer = ""
+        self._loop.add_writer(conn.fd, lambda: self._on_writable(exchange))
+
+    def _on_writable(self, exchange):
+        if exchange.done:
+            return
+        conn = exchange.conn
+        if exchange.sent == 0:
+            err = conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self._on_error(exchange, socket.error(err, os.strerror(err)))
+                return
+        try:
+            exchange.sent += conn.sock.send(exchange.data[exchange.sent:])
+        except socket.error as exc:
+            if exc.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self._on_error(exchange, exc)
+            return
+        if exchange.sent == len(exchange.data):
+            self._loop.remove_writer(conn.fd)
+            self._loop.add_reader(conn.fd, lambda: self._on_readable(exchange))
+
+    def _on_readable(self, exchange):
+        if exchange.done:
+            return
+        try:
+            data = exchange.conn.sock.recv(65536)
+        except socket.error as exc:
+            if exc.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self._on_error(exchange, exc)
+            return
+        if not data:
+            if exchange.body_mode == "close":
+                self._complete(exchange, exchange.buffer)
+            else:
+                self._on_error(exchange, HttpError("Connection closed by server"))
+            return
+        exchange.buffer += data
+        try:
+            self._parse(exchange)
+        except HttpError as exc:
+            self._on_error(exchange, exc)
+
+    def _parse(self, exchange):
+        if exchange.status is None:
+            end = exchange.buffer.find("\r\n\r\n")
+            if end < 0:
+                return
+            head = exchange.buffer[:end].split("\r\n")
+            exchange.buffer = exchange.buffer[end + 4:]
+            try:
+                version, status = head[0].split(" ", 2)[:2]
+                exchange.status = int(status)
+            except ValueError:
+                raise HttpError("Invalid status line: %s" % head[0])
+            exchange.headers = {}
+            for line in head[1:]:
+                k, _, v = line.partition(":")
+                exchange.headers[k.strip().lower()] = v.strip()
+            connection = exchange.headers.get("connection", "").lower()
+            if version == "HTTP/1.1":
+                exchange.keep_alive = connection != "close"
+            else:
+                exchange.keep_alive = connection == "keep-alive"
+            if exchange.status in (204, 304) or 100 <= exchange.status < 200:
+                exchange.body_mode = "length"
+                exchange.body_length = 0
+            elif exchange.headers.get("transfer-encoding", "").lower() == "chunked":
+                exchange.body_mode = "chunked"
+            elif "content-length" in exchange.headers:
+                exchange.body_mode = "length"
+                exchange.body_length = int(exchange.headers["content-length"])
+            else:
+                exchange.body_mode = "close"
+                exchange.keep_alive = False
+
+        if exchange.body_mode == "length":
+            if len(exchange.buffer) >= exchange.body_length:
+                self._complete(exchange, exchange.buffer[:exchange.body_length])
+        elif exchange.body_mode == "chunked":
+            body = self._parse_chunked(exchange.buffer)
+            if body is not None:
+                self._complete(exchange, body)
+
+    # Return decoded body, or None if it has not been fully received.
+    def _parse_chunked(self, data):
+        chunks = []
+        pos = 0
+        while True:
+            end = data.find("\r\n", pos)
+            if end < 0:
+                return None
+            try:
+                size = int(data[pos:end].split(";")[0], 16)
+            except ValueError:
+                raise HttpError("Invalid chunk size")
+            if size == 0:
+                # Ignore trailers, just wait for the final empty line.
+                if data.find("\r\n\r\n", end) < 0:
+                    return None
+                return "".join(chunks)
+            if len(data) < end + 2 + size + 2:
+                return None
+            chunks.append(data[end + 2:end + 2 + size])
+            pos = end + 2 + size + 2
+
+    def _on_error(self, exchange, error):
+        conn = exchange.conn
+        if exchange.reused and exchange.status is None:
+            # Server has probably closed this keep-alive connection, retry
+            # once on a new connection.
+            logging.debug("<AsyncHttpClient> Reused connection failed (%s), retrying", error)
+            exchange.conn = None
+            self._close(conn)
+            exchange.reused = False
+            exchange.sent = 0
+            exchange.buffer = ""
+            self._start(exchange)
+            return
+        self._finish(exchange, error=error)
+
+    def _complete(self, exchange, content):
+        self._finish(exchange, content=content)
+
+    def _finish(self, exchange, content=None, error=None):
+        if exchange.done:
+            return
+        exchange.done = True
+        if exchange.timer:
+            exchange.timer.cancel()
+        conn = exchange.conn
+        exchange.conn = None
+        if conn is not None:
+            self._loop.remove_writer(conn.fd)
+            self._loop.remove_reader(conn.fd)
+            if error is None and exchange.keep_alive:
+                self._release(conn)
+            else:
+                self._close(conn)
+        else:
+            waiting = self._waiting.get(exchange.key, None)
+            if waiting and exchange in waiting:
+                waiting.remove(exchange)
+        if error is not None:
+            exchange.callback(None, None, None, error)
+        else:
+            exchange.callback(exchange.status, exchange.headers, content, None)
+
+    def _release(self, conn):
+        conn.last_used = time.time()
+        waiting = self._waiting.get(conn.key, None)
+        if waiting:
+            self._reused += 1
+            self._send(waiting.popleft(), conn, True)
+            return
+        self._idle.setdefault(conn.key, []).append(conn)
+        # Idle connection becoming readable means it has been closed by server.
+        self._loop.add_reader(conn.fd, lambda: self._on_idle_readable(conn))
+
+    def _on_idle_readable(self, conn):
+        idle = self._idle.get(conn.key, [])
+        if conn in idle:
+            idle.remove(conn)
+        self._loop.remove_reader(conn.fd)
+        self._close(conn)
+
+    def _close(self, conn):
+        self._loop.remove_writer(conn.fd)
+        self._loop.remove_reader(conn.fd)
+        try:
+            conn.sock.close()
+        except socket.error:
+            pass
+        self._nb_connections[conn.key] -= 1
+        # A new connection can be opened for a waiting request.
+        waiting = self._waiting.get(conn.key, None)
+        if waiting:
+            self._loop.call_soon(self._start, waiting.popleft())
+
+    def _evict_idle(self):
+        now = time.time()
+        for key, idle in self._idle.items():
+            for conn in [x for x in idle if now - x.last_used > self._idle_timeout]:
+                idle.remove(conn)
+                self._close(conn)
+                self._evicted += 1
+        self._loop.call_later(self._idle_timeout, self._evict_idle)
+
+    # Close all idle connections.
+    def clear(self):
+        for idle in self._idle.values():
+            for conn in idle:
+                self._close(conn)
+            del idle[:]
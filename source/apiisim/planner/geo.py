@@ -0,0 +1,93 @@
+"""
+    Small geographic helpers used by the planner to avoid database round trips
+    for computations on static data.
+
+    Positions are (longitude, latitude) tuples in degrees (WGS84).
+"""
+import re
+from math import radians, sin, cos, tan, atan, asin, sqrt, degrees
+
+
+EARTH_RADIUS = 6371008.8 # Mean radius, in meters
+
+_POLYGON_RE = re.compile(r"^\s*POLYGON\s*\((.*)\)\s*$", re.IGNORECASE)
+_RING_RE = re.compile(r"\(([^()]*)\)")
+
+
+"""
+    Parse a WKT polygon ("POLYGON((lon lat, ...), (lon lat, ...))") and return
+    its rings as a list of [(lon, lat)]. The first ring is the exterior ring,
+    the others are holes.
+    Raise ValueError if wkt is not a valid polygon.
+"""
+def parse_wkt_polygon(wkt):
+    match = _POLYGON_RE.match(wkt)
+    if not match:
+        raise ValueError("Invalid WKT polygon: %s" % wkt)
+    rings = []
+    for ring in _RING_RE.findall(match.group(1)):
+        points = []
+        for point in ring.split(","):
+            lon, lat = point.split()
+            points.append((float(lon), float(lat)))
+        if len(points) < 4 or points[0] != points[-1]:
+            raise ValueError("Invalid WKT polygon ring: %s" % ring)
+        rings.append(points)
+    if not rings:
+        raise ValueError("Invalid WKT polygon: %s" % wkt)
+    return rings
+
+
+"""
+    Latitude (in degrees) at given longitude of the great circle going through
+    (lon1, lat1) and (lon2, lat2), lon1 != lon2.
+    Edges of PostGIS geography polygons are great circle arcs, not parallels,
+    so an edge between 2 points with the same latitude bulges towards the pole.
+"""
+def _great_circle_latitude(lon1, lat1, lon2, lat2, lon):
+    lon1, lat1, lon2, lat2, lon = radians(lon1), radians(lat1), \
+                                  radians(lon2), radians(lat2), radians(lon)
+    return degrees(atan((tan(lat1) * sin(lon2 - lon) + tan(lat2) * sin(lon - lon1)) \
+                        / sin(lon2 - lon1)))
+
+
+"""
+    Return True if the ray going north from (lon, lat) crosses given ring an
+    odd number of times.
+"""
+def _ring_contains(ring, lon, lat):
+    inside = False
+    for (lon1, lat1), (lon2, lat2) in zip(ring, ring[1:]):
+        if (lon1 > lon) == (lon2 > lon):
+            # Edge does not span point longitude (meridian edges included).
+            continue
+        if _great_circle_latitude(lon1, lat1, lon2, lat2, lon) > lat:
+            inside = not inside
+    return inside
+
+
+"""
+    Return True if position (lon, lat) is inside given polygon (as returned by
+    parse_wkt_polygon), i.e. inside its exterior ring and outside its holes.
+    Polygon edges are great circle arcs, so that results match
+    ST_Intersects(geography, geography). Polygons crossing the antimeridian
+    are not supported.
+"""
+def polygon_contains(polygon, lon, lat):
+    if not _ring_contains(polygon[0], lon, lat):
+        return False
+    for hole in polygon[1:]:
+        if _ring_contains(hole, lon, lat):
+            return False
+    return True
+
+
+"""
+    Great-circle distance in meters between (lon1, lat1) and (lon2, lat2),
+    computed on a sphere (haversine formula). It differs by less than 0.5%
+    from the distance on the WGS84 ellipsoid.
+"""
+def haversine(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = radians(lon1), radians(lat1), radians(lon2), radians(lat2)
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * asin(min(1.0, sqrt(a)))
@@ -0,0 +1,195 @@
+"""
+    In-memory snapshot of the static part of the metabase (MIS, MIS connections,
+    MIS modes and MIS capabilities).
+
+    This data only changes when the back_office runs, so instead of querying
+    the database several times per trace, the planner loads it once and shares
+    it between all threads. A snapshot is never modified once built, a new one
+    is loaded and swapped when a new back_office import is detected.
+"""
+import logging, threading, time
+from collections import namedtuple
+from sqlalchemy import func
+from apiisim import metabase
+from apiisim.planner.geo import parse_wkt_polygon, polygon_contains
+
+
+# WKT shapes of MIS that only cover part of the area in which they have stops,
+# indexed by MIS name.
+# Should not be hard-coded but it will do the job for now.
+MIS_SHAPES = {
+    "paysdelaloire" : "POLYGON((-2.557442956 46.26975161,-2.557442956 48.56805252," \
+                      "0.915342221 48.56805252,0.915342221 46.26975161,-2.557442956 46.26975161))",
+    "transilien" : "POLYGON((1.447406441 48.12237262,1.447406441 " \
+                   "49.2334534,3.54286966 49.2334534,3.54286966 48.12237262,1.447406441 48.12237262))",
+    "bretagne" : "POLYGON((-5.139900401 47.27952014,-5.139900401 48.87967361," \
+                 "-1.013521807 48.87967361,-1.013521807 47.27952014,-5.139900401 47.27952014))",
+}
+
+
+# Immutable copy of a metabase.Mis row, along with the codes of its modes.
+# Attribute names match those of metabase.Mis.
+MisInfo = namedtuple("MisInfo", ["id", "name", "api_url", "api_key",
+                                 "start_date", "end_date",
+                                 "geographic_position_compliant",
+                                 "multiple_starts_and_arrivals",
+                                 "modes"])
+
+
+class MisTopology(object):
+    def __init__(self, generation, mises, connections, shapes=None):
+        # Id of the back_office import this snapshot has been built from.
+        self.generation = generation
+        self._mises = mises # {mis_id : MisInfo}
+        self._connections = connections # {mis_id : frozenset([mis_id])}
+        # {mis_id : polygon}, polygons as returned by geo.parse_wkt_polygon()
+        self._shapes = shapes or {}
+        # MIS that can be in the middle of a trace, i.e. that support n-m
+        # itineraries requests.
+        self._transit_mises = frozenset([x.id for x in mises.values() \
+                                         if x.multiple_starts_and_arrivals])
+
+    # Return None if given MIS is not in the snapshot (e.g. created by a
+    # back_office import that is still running).
+    def get_mis(self, mis_id):
+        return self._mises.get(mis_id, None)
+
+    def get_mises(self):
+        return self._mises.values()
+
+    # Return an empty set if given MIS is not in the snapshot.
+    def get_mis_modes(self, mis_id):
+        mis = self._mises.get(mis_id, None)
+        return mis.modes if mis else frozenset()
+
+    def get_connected_mises(self, mis_id):
+        return self._connections.get(mis_id, frozenset())
+
+    def get_connections(self):
+        return self._connections
+
+    def get_transit_mises(self):
+        return self._transit_mises
+
+    """
+        Return True if given position is inside the shape of given MIS, or if
+        this MIS has no shape.
+    """
+    def mis_shape_contains(self, mis_id, longitude, latitude):
+        shape = self._shapes.get(mis_id, None)
+        if shape is None:
+            return True
+        return polygon_contains(shape, float(longitude), float(latitude))
+
+    def __repr__(self):
+        return "<MisTopology(generation='%s', nb_mises=%s)>" % \
+               (self.generation, len(self._mises))
+
+
+"""
+    Return id of the last back_office import that has finished (whatever
+    its result), None if the back_office has never been run.
+"""
+def get_import_generation(db_session):
+    return db_session.query(func.max(metabase.BackOfficeImport.id)) \
+                     .filter(metabase.BackOfficeImport.end_date != None) \
+                     .scalar()
+
+
+def load_topology(db_session, generation):
+    modes = {} # {mis_id : set([mode_code])}
+    for mis_id, code in db_session.query(metabase.MisMode.mis_id, metabase.Mode.code) \
+                                  .filter(metabase.Mode.id == metabase.MisMode.mode_id) \
+                                  .all():
+        modes.setdefault(mis_id, set()).add(code)
+
+    mises = {}
+    shapes = {}
+    for mis in db_session.query(metabase.Mis).all():
+        if mis.name in MIS_SHAPES:
+            shapes[mis.id] = parse_wkt_polygon(MIS_SHAPES[mis.name])
+        mises[mis.id] = MisInfo(id=mis.id, name=mis.name,
+                                api_url=mis.api_url, api_key=mis.api_key,
+                                start_date=mis.start_date, end_date=mis.end_date,
+                                geographic_position_compliant=mis.geographic_position_compliant,
+                                multiple_starts_and_arrivals=mis.multiple_starts_and_arrivals,
+                                modes=frozenset(modes.get(mis.id, [])))
+
+    connections = {}
+    for mis1_id, mis2_id in db_session.query(metabase.MisConnection.mis1_id,
+                                             metabase.MisConnection.mis2_id) \
+                                      .all():
+        connections.setdefault(mis1_id, set()).add(mis2_id)
+        connections.setdefault(mis2_id, set()).add(mis1_id)
+    connections = dict((k, frozenset(v)) for k, v in connections.iteritems())
+
+    return MisTopology(generation, mises, connections, shapes)
+
+
+"""
+    Process-wide holder of the current MisTopology.
+    The back_office_import table is checked at most every CHECK_INTERVAL seconds,
+    if a new import is found, a new snapshot is loaded and replaces the current
+    one. Threads that still hold a reference to the previous snapshot keep on
+    using it, which guarantees that a given trace is computed with consistent data.
+    The check and the load are done without holding the lock: meanwhile, other
+    threads are served the current snapshot.
+    If given, on_reload(previous topology, new topology) is called every time
+    a new import replaces the current snapshot.
+"""
+class MisTopologyCache(object):
+    CHECK_INTERVAL = 5 # In seconds
+
+    def __init__(self, on_reload=None):
+        self._on_reload = on_reload
+        self._topology = None
+        self._last_check = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._reloads = 0
+
+    def get(self, db_session):
+        now = time.time()
+        with self._lock:
+            topology = self._topology
+            if topology is not None and \
+               (now - self._last_check) < self.CHECK_INTERVAL:
+                self._hits += 1
+                return topology
+            # Other threads keep on using the current snapshot until the
+            # next check.
+            self._last_check = now
+
+        generation = get_import_generation(db_session)
+        if topology is not None and topology.generation == generation:
+            with self._lock:
+                self._hits += 1
+            return topology
+
+        new_topology = load_topology(db_session, generation)
+        with self._lock:
+            previous = self._topology
+            # Another thread may have loaded the same or a newer import
+            # in the meantime.
+            if previous is None or \
+               (generation is not None and \
+                (previous.generation is None or generation > previous.generation)):
+                self._topology = new_topology
+                self._reloads += 1
+                logging.info("MIS topology loaded: %s (hits: %s, reloads: %s)",
+                             new_topology, self._hits, self._reloads)
+            else:
+                previous = None
+            topology = self._topology
+
+        if previous is not None and self._on_reload:
+            self._on_reload(previous, topology)
+        return topology
+
+    """
+        Return (number of requests served by current snapshot,
+                number of snapshot loads).
+    """
+    def get_stats(self):
+        with self._lock:
+            return self._hits, self._reloads
@@ -0,0 +1,116 @@
+"""
+    Sending of the notifications of a planner websocket connection.
+
+    Notifications of all the requests of a connection (a single one, or
+    several in session mode) are put in a queue and sent by a single
+    NotificationThread, which counts notifications sent for each request and
+    fills in EndingSearch messages with these counts and the request runtime.
+"""
+import logging, json, threading, traceback
+from datetime import datetime
+from apiisim.common import PlanTripStatusEnum
+from apiisim.common.plan_trip import EndingSearch, PlanTripNotificationResponseType, \
+                                     PlanTripExistenceNotificationResponseType, \
+                                     PlanTripResponse
+from apiisim.planner import PlanTripCancellationResponse
+
+
+def log_error(func):
+    def decorator(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        except Exception as e:
+            logging.error("Class <%s>: %s\n%s", self.__class__.__name__,
+                          e, traceback.format_exc())
+            raise
+
+    return decorator
+
+
+"""
+    Notification of a request that has not been registered with
+    NotificationThread.add_request() (e.g. a rejected request, whose
+    clientRequestId may be the one of a running request). It is sent as is,
+    without any bookkeeping.
+"""
+class UntrackedNotification(object):
+    def __init__(self, notif):
+        self.notif = notif
+
+
+class NotificationThread(threading.Thread):
+    def __init__(self, connection, queue):
+        threading.Thread.__init__(self)
+        self._connection = connection
+        self._queue = queue
+        self._lock = threading.Lock()
+        # Requests of the connection, several of them in session mode:
+        # {request id : [start date, existence notifications sent, notifications sent]}
+        self._requests = {}
+
+    # Called when a request is received, its EndingSearch runtime is computed
+    # from that moment.
+    def add_request(self, request_id):
+        with self._lock:
+            self._requests[request_id] = [datetime.now(), 0, 0]
+
+    # Return [start date, existence notifications sent, notifications sent]
+    # of given request, None if it is not registered (or no longer is).
+    def _get_request(self, request_id, remove=False):
+        with self._lock:
+            if remove:
+                return self._requests.pop(request_id, None)
+            return self._requests.get(request_id, None)
+
+    # Update bookkeeping of the request of notif, which is about to be sent.
+    # Return False if notif must not be sent: notifications of requests that
+    # are not registered (e.g. traces computed after a cancellation) are
+    # dropped.
+    def _update_request(self, notif):
+        if isinstance(notif, EndingSearch):
+            request = self._get_request(notif.RequestId, remove=True)
+            if request is None:
+                return False
+            start_date, existence_notifications_sent, notifications_sent = request
+            notif.ExistenceNotificationsSent = existence_notifications_sent
+            notif.NotificationsSent = notifications_sent
+            notif.Runtime = datetime.now() - start_date
+        elif isinstance(notif, PlanTripNotificationResponseType):
+            request = self._get_request(notif.RequestId)
+            if request is None:
+                return False
+            request[2] += 1
+        elif isinstance(notif, PlanTripExistenceNotificationResponseType):
+            request = self._get_request(notif.RequestId)
+            if request is None:
+                return False
+            request[1] += 1
+        elif isinstance(notif, PlanTripCancellationResponse):
+            self._get_request(notif.RequestId, remove=True)
+        elif isinstance(notif, PlanTripResponse) and notif.Status != PlanTripStatusEnum.OK:
+            self._get_request(notif.clientRequestId, remove=True)
+        return True
+
+    @log_error
+    def run(self):
+        while True:
+            logging.debug("Waiting for notification...")
+            notif = self._queue.get()
+            if notif is None:
+                self._queue.task_done()
+                logging.debug("Notification Thread finished")
+                break
+            if isinstance(notif, UntrackedNotification):
+                notif = notif.notif
+            elif not self._update_request(notif):
+                logging.debug("Notification <%s> of unknown request <%s> dropped",
+                              notif.__class__.__name__, notif.RequestId)
+                self._queue.task_done()
+                continue
+            logging.debug("Sending notification <%s>...", notif.__class__.__name__)
+            self._connection.ws_stream.send_message(json.dumps(notif.marshal()), binary=False)
+            logging.debug("Notification sent")
+            self._queue.task_done()
+
+    def stop(self):
+        self._queue.put(None)
@@ -1,18 +1,20 @@
-from apiisim.planner import MisApi, benchmark, stop_to_trace_stop, \
+from apiisim.planner import MisApi, stop_to_trace_stop, \
                             create_full_notification, NoItineraryFoundException
-from datetime import datetime, timedelta
-from sqlalchemy import or_, and_
-from sqlalchemy.orm import aliased
+from apiisim.planner.trace_graph import find_mis_traces
+from apiisim.planner.coroutines import Return, run_sync
+from apiisim.planner.trace_ranking import trace_lower_bound, max_speed, rank_transfers
+from apiisim.planner.trace_state import StopSet, TraceHop, new_transfer_stop_sets
+from datetime import timedelta
 from apiisim import metabase
 from geoalchemy2 import Geography
 from geoalchemy2.functions import ST_DWithin, GenericFunction
-from geoalchemy2.functions import ST_Intersects
 from apiisim.common.plan_trip import PlanTripExistenceNotificationResponseType, \
                                      ProviderType
 from apiisim.common.mis_plan_summed_up_trip import SummedUpItinerariesRequestType
 from apiisim.common.mis_plan_trip import ItineraryRequestType, multiDeparturesType, \
                                          multiArrivalsType
 from apiisim.common import TransportModeEnum, PlanSearchOptions
+from apiisim.common.metrics import timed, record, monotonic
 import logging
 
 
@@ -28,54 +30,79 @@ class PlanTripCalculator(object):
     # Maximum number of transfers between 2 MIS. We need that limit to have acceptable
     # performance when using MIS that don't support n-m itineraries requests.
     MAX_TRANSFERS = 20
-
-    def __init__(self, planner, params, notif_queue):
+    # Maximum number of transfers between 2 MIS when one of them doesn't
+    # support n-m itineraries requests.
+    MAX_TRANSFERS_SINGLE = 5
+    # If False, first transfers (by id) are used instead of the best ones.
+    GATEWAY_RANKING = True
+
+    # If db_session is given, it is owned by the caller, otherwise the calculator
+    # creates its own session and removes it when deleted. If request_timings
+    # (metrics.RequestTimings) is given, time spent by the calculator is added
+    # to it. If topology (mis_topology.MisTopology) is given, it is used
+    # instead of the current snapshot.
+    def __init__(self, planner, params, notif_queue, db_session=None,
+                 request_timings=None, topology=None):
         self._planner = planner
-        self._db_session = self._planner.create_db_session()
+        self.request_timings = request_timings
+        self._owns_db_session = db_session is None
+        self._db_session = db_session or self._planner.create_db_session()
         self._params = params
         self._notif_queue = notif_queue
+        # Snapshot of MIS data, kept for the whole calculator life. Calculators
+        # computing the trips of a request are given the snapshot its traces
+        # have been computed with, so that all of them use the same data.
+        self._topology = topology or self._planner.get_topology(self._db_session)
+        # {tuple(trace) : lower bound of trip duration}, set by compute_traces()
+        self._trace_lower_bounds = {}
+
+    def get_topology(self):
+        return self._topology
+
+    def _new_mis_api(self, mis_id):
+        return MisApi(self._topology.get_mis(mis_id))
 
 
-    @benchmark
+    """
+        Return the best transfers (transfer_cache.TransferInfo) between
+        mis1_id and mis2_id for this request, see trace_ranking.rank_transfers().
+        At most MAX_TRANSFERS are returned, MAX_TRANSFERS_SINGLE if one of the
+        MIS doesn't support n-m itineraries requests. Without departure and
+        arrival positions, first transfers (by id) are returned.
+    """
+    def _get_gateways(self, mis1_id, mis2_id):
+        transfers = self._planner.get_transfers(self._db_session, self._topology.generation,
+                                                mis1_id, mis2_id)
+        max_transfers = self.MAX_TRANSFERS
+        for mis_id in [mis1_id, mis2_id]:
+            if not self._topology.get_mis(mis_id).multiple_starts_and_arrivals:
+                max_transfers = self.MAX_TRANSFERS_SINGLE
+        departure = getattr(self._params.Departure, "Position", None)
+        arrival = getattr(self._params.Arrival, "Position", None)
+        if self.GATEWAY_RANKING and departure is not None and arrival is not None:
+            ret = rank_transfers(transfers,
+                                 (float(departure.Longitude), float(departure.Latitude)),
+                                 (float(arrival.Longitude), float(arrival.Latitude)),
+                                 max_transfers)
+        else:
+            ret = transfers[:max_transfers]
+        logging.debug("Gateways %s -> %s: %s/%s transfers", mis1_id, mis2_id,
+                      len(ret), len(transfers))
+        return ret
+
+    @timed
     def _get_transfers(self, mis1_id, mis2_id):
         # ([transfer_duration], [stop_mis1], [stop_mis2])
         # To ease further processing (in compute_trip()), stops are returned
         # as TraceStop objects, not as metabase.Stop objects.
+        # Transfers come from a cache shared by all threads, TraceStop objects
+        # are created for each call since they are modified by compute_trip().
         ret = ([], [], [])
-        subq = self._db_session.query(metabase.TransferMis.transfer_id) \
-                                        .filter(or_(and_(metabase.TransferMis.mis1_id==mis1_id,
-                                                         metabase.TransferMis.mis2_id==mis2_id),
-                                                    and_(metabase.TransferMis.mis1_id==mis2_id,
-                                                         metabase.TransferMis.mis2_id==mis1_id))) \
-                                        .filter(metabase.TransferMis.transfer_active==True) \
-                                        .order_by(metabase.TransferMis.transfer_id) \
-                                        .limit(self.MAX_TRANSFERS) \
-                                        .subquery()
-        # logging.debug("transfers_ids : %s", transfers_ids)
-        s1 = aliased(metabase.Stop)
-        s2 = aliased(metabase.Stop)
-
-        results = self._db_session.query(metabase.Transfer, s1, s2) \
-                                  .filter(metabase.Transfer.id == subq.c.transfer_id) \
-                                  .filter(and_(metabase.Transfer.stop1_id == s1.id),
-                                               metabase.Transfer.stop2_id == s2.id) \
-                                  .all()
-        for t, s1, s2 in results:
-            l1 = stop_to_trace_stop(s1)
-            l2 = stop_to_trace_stop(s2)
-            if s1.mis_id == mis1_id: # implies s2.mis_id == mis2_id
-                ret[0].append(timedelta(seconds=t.duration))
-                ret[1].append(l1)
-                ret[2].append(l2)
-            elif s1.mis_id == mis2_id: # implies s2.mis_id == mis1_id
-                ret[0].append(timedelta(seconds=t.duration))
-                ret[1].append(l2)
-                ret[2].append(l1)
-            else:
-                raise Exception("Inconsistency in database, transfer %s is"
-                                "not coherent with its stops %s %s", t, s1, s2)
+        for t in self._get_gateways(mis1_id, mis2_id):
+            ret[0].append(timedelta(seconds=t.duration))
+            ret[1].append(stop_to_trace_stop(t.stop1))
+            ret[2].append(stop_to_trace_stop(t.stop2))
 
-        # logging.debug("ret: len %s len %s\n%s", len(ret[mis1_id]), len(ret[mis2_id]), ret)
         return ret
 
 
@@ -87,34 +114,36 @@ class PlanTripCalculator(object):
         Also ensure that returned MIS are available at given date.
         Note that date must of type 'date', not 'datetime'.
     """
-    @benchmark
+    @timed
     def _get_surrounding_mises(self, position, date):
         ret = set() # ([mis_id])
-        all_mises = self._db_session.query(metabase.Mis).all()
-
-        for mis in all_mises:
-            if self._db_session.query(metabase.Stop.id) \
-                               .filter(metabase.Stop.mis_id == mis.id) \
-                               .filter(
-                                    ST_DWithin(
-                                        metabase.Stop.geog,
-                                        ST_GeogFromText('POINT(%s %s)' \
-                                            % (position.Longitude, position.Latitude)),
-                                        self.SURROUNDING_MISES_MAX_DISTANCE)) \
-                               .count() > 0 \
-               and (mis.start_date <= date <= mis.end_date):
-
-                shape = MisApi(self._db_session, mis.id).get_shape()
-                if shape:
-                    intersect = self._db_session.query(ST_Intersects(
-                                                ST_GeogFromText('POINT(%s %s)' \
-                                                    % (position.Longitude, position.Latitude)),
-                                                ST_GeogFromText(shape))).one()[0]
-                    logging.debug("INTERSECTS <%s>: %s", mis.name, intersect)
-                    if intersect:
-                        ret.add(mis.id)
-                else:
-                    ret.add(mis.id)
+
+        # Single query on stop_geog_gist index, MIS dates and shapes are then
+        # checked on the topology snapshot.
+        results = self._db_session.query(metabase.Stop.mis_id) \
+                                  .filter(
+                                        ST_DWithin(
+                                            metabase.Stop.geog,
+                                            ST_GeogFromText('POINT(%s %s)' \
+                                                % (position.Longitude, position.Latitude)),
+                                            self.SURROUNDING_MISES_MAX_DISTANCE)) \
+                                  .distinct() \
+                                  .all()
+        for (mis_id,) in results:
+            mis = self._topology.get_mis(mis_id)
+            if mis is None:
+                # Stops committed by a back_office import that is not finished
+                # yet, their MIS will be part of the next snapshot.
+                logging.debug("MIS <%s> not in topology %s, ignored", mis_id, self._topology)
+                continue
+            if not (mis.start_date <= date <= mis.end_date):
+                continue
+            if self._topology.mis_shape_contains(mis_id, position.Longitude,
+                                                 position.Latitude):
+                ret.add(mis_id)
+            else:
+                logging.debug("Point (%s %s) is outside <%s> shape",
+                              position.Longitude, position.Latitude, mis.name)
 
         logging.debug("MISes surrounding point (%s %s): %s",
                       position.Longitude, position.Latitude, ret)
@@ -122,48 +151,20 @@ class PlanTripCalculator(object):
 
 
     def _get_mis_modes(self, mis_id):
-        return set([x[0] for x in \
-                    self._db_session.query(metabase.Mode.code) \
-                                    .filter(metabase.MisMode.mis_id == mis_id) \
-                                    .filter(metabase.Mode.id == metabase.MisMode.mode_id) \
-                                    .all()])
+        return set(self._topology.get_mis_modes(mis_id))
 
 
-    @benchmark
     def _get_connected_mises(self, mis_id):
-        s1 = set([x[0] for x in \
-                  self._db_session.query(metabase.MisConnection.mis1_id) \
-                                  .filter(metabase.MisConnection.mis2_id == mis_id) \
-                                  .all()])
-        s2 = set([x[0] for x in \
-                  self._db_session.query(metabase.MisConnection.mis2_id) \
-                                  .filter(metabase.MisConnection.mis1_id == mis_id) \
-                                  .all()])
-        return s1 | s2
-
-
-    @benchmark
+        return set(self._topology.get_connected_mises(mis_id))
+
+
+    @timed
     def _get_mis_traces(self, departure_mises, arrival_mises, max_trace_length):
-        ret = [] # [[mis_id]] each mis_id list is a trace
         if max_trace_length < 1:
             logging.warning("Requesting Mis traces with max_trace_length < 1")
-            return ret
-
-        # Add all Mis in common
-        for mis in (departure_mises & arrival_mises):
-            ret.append([mis])
-        if max_trace_length == 1:
-            return ret
-
-        for mis_id in departure_mises:
-            connected_mises = self._get_connected_mises(mis_id)
-            for subtrace in self._get_mis_traces(connected_mises,
-                                        arrival_mises, max_trace_length - 1):
-                if not mis_id in subtrace:
-                    subtrace.insert(0, mis_id)
-                    ret.append(subtrace)
-
-        return ret
+        return find_mis_traces(self._topology.get_connections(),
+                               departure_mises, arrival_mises, max_trace_length,
+                               transit_mises=self._topology.get_transit_mises())
 
     def _get_trace_transfers(self, mis_trace):
         # {mis1_id : {mis2_id : transfers},
@@ -182,10 +183,8 @@ class PlanTripCalculator(object):
     def _get_providers(self, mis_trace):
         ret = [] # [ProviderType]
         for mis_id in mis_trace:
-            mis_api = MisApi(self._db_session, mis_id)
-            ret.append(ProviderType(
-                            Name=mis_api.get_name(),
-                            Url=mis_api.get_api_url()))
+            mis = self._topology.get_mis(mis_id)
+            ret.append(ProviderType(Name=mis.name, Url=mis.api_url))
         return ret
 
     def _filter_traces(self, traces):
@@ -196,14 +195,14 @@ class PlanTripCalculator(object):
         for t in traces:
             is_valid = True
             for mis_id in t[1:-1]:
-                if not MisApi(self._db_session, mis_id).get_multiple_starts_and_arrivals():
+                if not self._topology.get_mis(mis_id).multiple_starts_and_arrivals:
                     is_valid = False
                     break
             if is_valid:
                 ret.append(t)
         return ret
 
-    @benchmark
+    @timed
     def compute_traces(self):
         # Get Mis near departure and arrival points
         date = (self._params.DepartureTime or self._params.ArrivalTime).date()
@@ -218,155 +217,121 @@ class PlanTripCalculator(object):
         logging.debug("departure_mises %s", departure_mises)
         logging.debug("arrival_mises %s", arrival_mises)
 
-        return self._filter_traces(
+        traces = self._filter_traces(
                         self._get_mis_traces(departure_mises, arrival_mises, self.MAX_TRACE_LENGTH))
+        # Most promising traces first, traces without lower bound last.
+        self._trace_lower_bounds = self._get_trace_lower_bounds(traces)
+        return sorted(traces, key=lambda x: (self._trace_lower_bounds[tuple(x)] is None,
+                                             self._trace_lower_bounds[tuple(x)]))
 
 
-    @benchmark
-    def _departure_at_detailed_trace(self, mis_trace):
-        i = 0
-        ret = []
-        # [
-        #   (
-        #     MisApi,
-        #     [TraceStop], # departures
-        #     [TraceStop], # arrivals
-        #     [TraceStop], # linked_stops (stops linked to arrivals via a transfer)
-        #     [timedelta]  # transfer_durations
-        #   )
-        # ]
+    """
+        Return {tuple(trace) : lower bound (timedelta) of the duration of its
+        trips, None if unknown}, see trace_ranking module.
+    """
+    @timed
+    def _get_trace_lower_bounds(self, traces):
+        ret = {}
+        position = self._params.Departure.Position
+        departure = (float(position.Longitude), float(position.Latitude))
+        position = self._params.Arrival.Position
+        arrival = (float(position.Longitude), float(position.Latitude))
+        requested_modes = None
+        if self._params.modes and not TransportModeEnum.ALL in self._params.modes:
+            requested_modes = set(self._params.modes)
+
+        hops = {} # {(mis1_id, mis2_id) : [(stop1 position, stop2 position, duration)]}
+        # Bounds are computed with the transfers that will actually be used.
+        for trace in traces:
+            speeds = []
+            for mis_id in trace:
+                modes = self._get_mis_modes(mis_id)
+                if requested_modes is not None:
+                    modes &= requested_modes
+                speeds.append(max_speed(modes))
+            trace_hops = []
+            for mis1_id, mis2_id in zip(trace, trace[1:]):
+                if (mis1_id, mis2_id) not in hops:
+                    hops[(mis1_id, mis2_id)] = \
+                        [((t.stop1.long, t.stop1.lat), (t.stop2.long, t.stop2.lat), t.duration)
+                         for t in self._get_gateways(mis1_id, mis2_id)]
+                trace_hops.append(hops[(mis1_id, mis2_id)])
+            ret[tuple(trace)] = trace_lower_bound(departure, arrival, speeds, trace_hops)
+        logging.debug("Trace lower bounds: %s", ret)
+        return ret
+
+    def get_trace_lower_bounds(self):
+        return self._trace_lower_bounds
 
+
+    """
+        Return the linked StopSets of the transfers between each pair of
+        consecutive MIS of given trace, see trace_state module.
+    """
+    def _get_trace_stop_sets(self, mis_trace):
+        return [new_transfer_stop_sets(self._get_transfers(mis1_id, mis2_id))
+                for mis1_id, mis2_id in zip(mis_trace, mis_trace[1:])]
+
+
+    """
+        Return [TraceHop], one per MIS of given trace, in trace order:
+        departures of the first hop are the departure point, arrivals of the
+        last hop are the arrival point, and arrivals of each other hop are
+        linked to departures of the next hop.
+    """
+    @timed
+    def _departure_at_detailed_trace(self, mis_trace):
         if len(mis_trace) < 2:
             raise Exception("mis_trace length must be > 1")
 
-        transfers = self._get_trace_transfers(mis_trace)
-        while True:
-            # Divide trace in chunks of 3 MIS
-            chunk = mis_trace[i:i+3]
-            if not chunk:
-                break
-            logging.debug("CHUNK: %s", chunk)
-
-            trace_start = self._params.Departure if i == 0 else None
-            trace_end = self._params.Arrival if len(mis_trace) <= (i + 3) else None
-            mis1_id = chunk[0]
-            mis2_id = chunk[1] if len(chunk) > 1 else 0
-            mis3_id = chunk[2] if len(chunk) > 2 else 0
-            mis1_api = MisApi(self._db_session, mis1_id) if mis1_id else None
-            mis2_api = MisApi(self._db_session, mis2_id) if mis2_id else None
-            mis3_api = MisApi(self._db_session, mis3_id) if mis3_id else None
-
-            if trace_start:
-                ret = [(mis1_api,
-                        [trace_start],
-                        transfers[mis1_id][mis2_id][1],
-                        transfers[mis1_id][mis2_id][2],
-                        transfers[mis1_id][mis2_id][0])]
-
-            if mis3_id:
-                ret.append(
-                    (mis2_api,
-                     transfers[mis1_id][mis2_id][2],
-                     transfers[mis2_id][mis3_id][1],
-                     transfers[mis2_id][mis3_id][2],
-                     transfers[mis2_id][mis3_id][0]))
-
-                if trace_end:
-                    ret.append(
-                        (mis3_api,
-                         transfers[mis2_id][mis3_id][2],
-                         [trace_end],
-                         None,
-                         None))
-                    break
+        stop_sets = self._get_trace_stop_sets(mis_trace)
+        ret = []
+        for i, mis_id in enumerate(mis_trace):
+            if i == 0:
+                departures = StopSet([self._params.Departure])
             else:
-                if trace_end:
-                    ret.append(
-                        (mis2_api,
-                         transfers[mis1_id][mis2_id][2],
-                         [trace_end],
-                         None,
-                         None))
-                    break
-            i += 1
+                departures = stop_sets[i - 1][1]
+            if i == len(mis_trace) - 1:
+                arrivals = StopSet([self._params.Arrival])
+                linked_stops = None
+            else:
+                arrivals, linked_stops = stop_sets[i]
+            ret.append(TraceHop(self._new_mis_api(mis_id), departures, arrivals,
+                                linked_stops))
 
         return ret
 
 
-    @benchmark
+    """
+        Return [TraceHop], one per MIS of given trace, in reverse trace order
+        (since we process an arrival_at request, we'll do the trip backwards,
+        starting from the arrival MIS, heading to the departure MIS):
+        arrivals of the first hop are the arrival point, departures of the
+        last hop are the departure point, and departures of each other hop
+        are linked to arrivals of the next hop.
+    """
+    @timed
     def _arrival_at_detailed_trace(self, mis_trace):
-        i = 0
-        ret = []
-        # [
-        #   (
-        #     MisApi,
-        #     [TraceStop], # departures
-        #     [TraceStop], # arrivals
-        #     [TraceStop], # linked_stops (stops linked to departures via a transfer)
-        #     [timedelta]  # transfer_durations
-        #   )
-        # ]
-
         if len(mis_trace) < 2:
             raise Exception("mis_trace length must be > 1")
 
-        # Since we process an arrival_at request, we'll do the trip backwards,
-        # starting from the arrival MIS, heading to the departure MIS.
         mis_trace = list(mis_trace)
         mis_trace.reverse()
 
-        transfers = self._get_trace_transfers(mis_trace)
-        while True:
-            # Divide trace in chunks of 3 MIS
-            chunk = mis_trace[i:i+3]
-            if not chunk:
-                break
-            logging.debug("CHUNK: %s", chunk)
-
-            # Again, this is an arrival_at request, so we start from the arrival
-            # point and finish in the departure point.
-            trace_start = self._params.Arrival if i == 0 else None
-            trace_end = self._params.Departure if len(mis_trace) <= (i + 3) else None
-            mis1_id = chunk[0]
-            mis2_id = chunk[1] if len(chunk) > 1 else 0
-            mis3_id = chunk[2] if len(chunk) > 2 else 0
-            mis1_api = MisApi(self._db_session, mis1_id) if mis1_id else None
-            mis2_api = MisApi(self._db_session, mis2_id) if mis2_id else None
-            mis3_api = MisApi(self._db_session, mis3_id) if mis3_id else None
-
-            if trace_start:
-                ret = [(mis1_api,
-                        transfers[mis1_id][mis2_id][1],
-                        [trace_start],
-                        transfers[mis1_id][mis2_id][2],
-                        transfers[mis1_id][mis2_id][0])]
-
-            if mis3_id:
-                ret.append(
-                    (mis2_api,
-                     transfers[mis2_id][mis3_id][1],
-                     transfers[mis1_id][mis2_id][2],
-                     transfers[mis2_id][mis3_id][2],
-                     transfers[mis2_id][mis3_id][0]))
-
-                if trace_end:
-                    ret.append(
-                        (mis3_api,
-                         [trace_end],
-                         transfers[mis2_id][mis3_id][2],
-                         None,
-                         None))
-                    break
+        stop_sets = self._get_trace_stop_sets(mis_trace)
+        ret = []
+        for i, mis_id in enumerate(mis_trace):
+            if i == 0:
+                arrivals = StopSet([self._params.Arrival])
             else:
-                if trace_end:
-                    ret.append(
-                        (mis2_api,
-                         [trace_end],
-                         transfers[mis1_id][mis2_id][2],
-                         None,
-                         None))
-                    break
-            i += 1
+                arrivals = stop_sets[i - 1][1]
+            if i == len(mis_trace) - 1:
+                departures = StopSet([self._params.Departure])
+                linked_stops = None
+            else:
+                departures, linked_stops = stop_sets[i]
+            ret.append(TraceHop(self._new_mis_api(mis_id), departures, arrivals,
+                                linked_stops))
 
         return ret
 
@@ -382,8 +347,8 @@ class PlanTripCalculator(object):
         detailed_request.multiDepartures.Arrival = self._params.Arrival
         detailed_request.DepartureTime = self._params.DepartureTime
         detailed_request.ArrivalTime = self._params.ArrivalTime
-        mis_api = MisApi(self._db_session, mis_id)
-        resp = mis_api.get_itinerary(detailed_request)
+        mis_api = self._new_mis_api(mis_id)
+        resp = yield mis_api.itinerary_call(detailed_request)
         if not resp.DetailedTrip:
             raise NoItineraryFoundException()
         ret.append((mis_api, resp.DetailedTrip))
@@ -398,76 +363,69 @@ class PlanTripCalculator(object):
                     Departure=self._params.Departure, Arrival=self._params.Arrival)
         self._notif_queue.put(notif)
 
-        return ret
+        raise Return(ret)
 
 
     def _generate_trace_id(self, mis_trace):
         return "_".join(map(str, mis_trace))
 
     """
-        Update arrival stops after receiving itinerary results from a MIS.
+        Update arrival stops (StopSet) after receiving itinerary results from
+        a MIS.
             - Arrival time is updated according to trips data.
             - If no itinerary is found to a given arrival stop, this stop (and
-              its linked stops) are removed from the whole "meta-trip".
+              its linked stop) are removed from the whole "meta-trip".
     """
-    def _update_arrivals(self, arrivals, linked_stops, trips):
-        to_del = []
-        for stop in arrivals:
-            found = False
-            for trip in trips:
-                if stop.PlaceTypeId == trip.Arrival.TripStopPlace.id:
-                    stop.arrival_time = trip.Arrival.DateTime
-                    found = True
-                    break
-            if not found:
-                # No itinerary found to this arrival point, so remove this point
-                # from the trip, along with its linked stops.
-                to_del.extend([i for i, x in enumerate(arrivals) if x == stop])
-
-        to_del = set(to_del)
-        for i in sorted(to_del, reverse=True):
-            deleted_stop = arrivals.pop(i)
-            logging.debug("No itinerary found to stop point %s, deleting it", deleted_stop)
-            if linked_stops:
-                deleted_stop = linked_stops.pop(i)
-                logging.debug("Also deleting its linked stop point %s", deleted_stop)
+    def _update_arrivals(self, arrivals, trips):
+        found = {} # {PlaceTypeId : arrival time of first trip to that stop}
+        for trip in trips:
+            found.setdefault(trip.Arrival.TripStopPlace.id, trip.Arrival.DateTime)
+        for stop in arrivals.update_times(arrivals.arrival_times, found):
+            logging.debug("No itinerary found to stop point %s, deleting it", stop)
 
         if not arrivals:
             raise NoItineraryFoundException()
 
 
     """
-        Update departure stops after receiving itinerary results from a MIS.
+        Update departure stops (StopSet) after receiving itinerary results
+        from a MIS.
             - Departure time is updated according to trips data.
             - If no itinerary is found from a given departure stop, this stop
-              (and its linked stops) are removed from the whole "meta-trip".
+              (and its linked stop) are removed from the whole "meta-trip".
     """
-    def _update_departures(self, departures, linked_stops, trips):
-        to_del = []
-        for stop in departures:
-            found = False
-            for trip in trips:
-                if stop.PlaceTypeId == trip.Departure.TripStopPlace.id:
-                    stop.departure_time = trip.Departure.DateTime
-                    found = True
-                    break
-            if not found:
-                # No itinerary found from this departure point, so remove this
-                # point from the "meta-trip", along with its linked stops.
-                to_del.extend([i for i, x in enumerate(departures) if x == stop])
-
-        to_del = set(to_del)
-        for i in sorted(to_del, reverse=True):
-            deleted_stop = departures.pop(i)
-            logging.debug("No itinerary found from stop point %s, deleting it", deleted_stop)
-            if linked_stops:
-                deleted_stop = linked_stops.pop(i)
-                logging.debug("Also deleting its linked stop point %s", deleted_stop)
+    def _update_departures(self, departures, trips):
+        found = {} # {PlaceTypeId : departure time of first trip from that stop}
+        for trip in trips:
+            found.setdefault(trip.Departure.TripStopPlace.id, trip.Departure.DateTime)
+        for stop in departures.update_times(departures.departure_times, found):
+            logging.debug("No itinerary found from stop point %s, deleting it", stop)
 
         if not departures:
             raise NoItineraryFoundException()
 
 
+    """
+        Find stops linked to the stops of given StopSet whose PlaceTypeId is
+        place_id, and set their departure time (if departure is True, to
+        time + transfer duration) or arrival time (time - transfer duration).
+        Return (stop, time) of the linked stop having the earliest one.
+    """
+    def _best_linked_stop(self, stops, place_id, time, departure):
+        linked = stops.linked
+        best = None
+        for i in stops.indexes(place_id):
+            if departure:
+                linked_time = linked.departure_times[i] = time + stops.durations[i]
+            else:
+                linked_time = linked.arrival_times[i] = time - stops.durations[i]
+            if best is None or linked_time < best[1]:
+                best = (linked.stops[i], linked_time)
+        if best is None:
+            raise NoItineraryFoundException()
+        return best
+
+
     def _departure_at_trip(self, detailed_trace, trace_id, providers):
         # Minimum arrival_time to arrival
         best_arrival_time = None
@@ -481,41 +439,39 @@ class PlanTripCalculator(object):
         self._init_request(detailed_request)
 
         # Do all non detailed requests
-        for mis_api, departures, arrivals, linked_stops, transfer_durations in detailed_trace[0:-1]:
-            summed_up_request.departures = departures
-            summed_up_request.arrivals = arrivals
+        for hop in detailed_trace[0:-1]:
+            departures = hop.departures
+            summed_up_request.departures = departures.live_stops()
+            summed_up_request.arrivals = hop.arrivals.live_stops()
             if not summed_up_request.DepartureTime:
                 summed_up_request.DepartureTime = self._params.DepartureTime
             else:
-                summed_up_request.DepartureTime = min([x.arrival_time for x in departures])
-                for d in departures:
-                    d.AccessTime = d.arrival_time - summed_up_request.DepartureTime
+                summed_up_request.DepartureTime = departures.min_time(departures.arrival_times)
+                departures.set_access_times(departures.arrival_times,
+                                            summed_up_request.DepartureTime)
             summed_up_request.ArrivalTime = None
             summed_up_request.options = []
-            resp = mis_api.get_summed_up_itineraries(summed_up_request)
-            self._update_arrivals(arrivals, linked_stops, resp.summedUpTrips)
+            resp = yield hop.mis_api.summed_up_itineraries(summed_up_request)
+            self._update_arrivals(hop.arrivals, resp.summedUpTrips)
 
             # To have linked_stops arrival_time, just add transfer time to request results
-            for a, l, t in zip(arrivals, linked_stops, transfer_durations):
-                l.arrival_time = a.arrival_time + t
+            hop.arrivals.propagate_arrival_times()
 
         # Do non-detailed optimized request (only one, always)
-        mis_api, departures, arrivals, _, _ = detailed_trace[-1]
-        summed_up_request.departures = departures
-        summed_up_request.arrivals = arrivals
-        summed_up_request.DepartureTime = min([x.arrival_time for x in departures])
-        for d in departures:
-            d.AccessTime = d.arrival_time - summed_up_request.DepartureTime
+        hop = detailed_trace[-1]
+        departures = hop.departures
+        summed_up_request.departures = departures.live_stops()
+        summed_up_request.arrivals = hop.arrivals.live_stops()
+        summed_up_request.DepartureTime = departures.min_time(departures.arrival_times)
+        departures.set_access_times(departures.arrival_times, summed_up_request.DepartureTime)
         summed_up_request.ArrivalTime = None
         summed_up_request.options = [PlanSearchOptions.DEPARTURE_ARRIVAL_OPTIMIZED]
-        resp = mis_api.get_summed_up_itineraries(summed_up_request)
-        self._update_departures(departures, detailed_trace[-2][2], resp.summedUpTrips)
+        resp = yield hop.mis_api.summed_up_itineraries(summed_up_request)
+        self._update_departures(departures, resp.summedUpTrips)
         best_arrival_time = min([x.Arrival.DateTime for x in resp.summedUpTrips])
 
         # Substract transfer time from previous request results
-        mis_api, departures, arrivals, linked_stops, transfer_durations = detailed_trace[-2]
-        for a, l, t in zip(arrivals, linked_stops, transfer_durations):
-            a.departure_time = l.departure_time - t
+        departures.propagate_departure_times()
         notif = PlanTripExistenceNotificationResponseType(
                     RequestId=self._params.clientRequestId,
                     ComposedTripId=trace_id,
@@ -529,65 +485,62 @@ class PlanTripCalculator(object):
         # Do arrival_at non-detailed requests
         if len(detailed_trace) > 2:
             for i in reversed(range(1, len(detailed_trace) - 1)):
-                mis_api, departures, arrivals, linked_stops, transfer_durations = detailed_trace[i]
-                summed_up_request.departures = departures
-                summed_up_request.arrivals = arrivals
+                hop = detailed_trace[i]
+                arrivals = hop.arrivals
+                summed_up_request.departures = hop.departures.live_stops()
+                summed_up_request.arrivals = arrivals.live_stops()
                 summed_up_request.DepartureTime = None
-                summed_up_request.ArrivalTime = min([x.departure_time for x in arrivals])
-                for a in arrivals:
-                    a.AccessTime = a.departure_time - summed_up_request.ArrivalTime
+                summed_up_request.ArrivalTime = arrivals.min_time(arrivals.departure_times)
+                arrivals.set_access_times(arrivals.departure_times,
+                                          summed_up_request.ArrivalTime)
                 summed_up_request.options = []
-                resp = mis_api.get_summed_up_itineraries(summed_up_request)
-                self._update_departures(departures, detailed_trace[i-1][2], resp.summedUpTrips)
+                resp = yield hop.mis_api.summed_up_itineraries(summed_up_request)
+                self._update_departures(hop.departures, resp.summedUpTrips)
 
                 # Substract transfer time from previous request results
-                _, _, arrivals, linked_stops, transfer_durations = detailed_trace[i-1]
-                for a, l, t in zip(arrivals, linked_stops, transfer_durations):
-                    a.departure_time = l.departure_time - t
+                hop.departures.propagate_departure_times()
 
         # Do all detailed requests.
         # Best arrival stop from previous request, will become the departure
         # point of the next request.
         prev_stop = None
-        for mis_api, departures, arrivals, linked_stops, transfer_durations in detailed_trace:
+        prev_time = None
+        for hop in detailed_trace:
+            arrivals = hop.arrivals
             detailed_request.ArrivalTime = None
             if not prev_stop:
                 # At first, do an arrival_at request.
-                prev_stop = departures[0]
+                prev_stop = hop.departures.live_stops()[0]
                 detailed_request.DepartureTime = None
-                detailed_request.ArrivalTime = min([x.departure_time for x in arrivals])
-                for a in arrivals:
-                   a.AccessTime = a.departure_time - detailed_request.ArrivalTime
+                detailed_request.ArrivalTime = arrivals.min_time(arrivals.departure_times)
+                arrivals.set_access_times(arrivals.departure_times,
+                                          detailed_request.ArrivalTime)
             else:
                 # All other requests are departure_at requests.
-                detailed_request.DepartureTime = prev_stop.departure_time
+                detailed_request.DepartureTime = prev_time
                 detailed_request.ArrivalTime = None
                 prev_stop.AccessTime = timedelta(seconds=0)
             detailed_request.multiArrivals = multiArrivalsType()
             detailed_request.multiArrivals.Departure = prev_stop
-            detailed_request.multiArrivals.Arrival = list(set(arrivals))
-            resp = mis_api.get_itinerary(detailed_request)
+            detailed_request.multiArrivals.Arrival = list(set(arrivals.live_stops()))
+            resp = yield hop.mis_api.itinerary_call(detailed_request)
             if not resp.DetailedTrip:
                 raise NoItineraryFoundException()
-            ret.append((mis_api, resp.DetailedTrip))
+            ret.append((hop.mis_api, resp.DetailedTrip))
 
-            if not linked_stops:
+            if not hop.linked_stops:
                 # We are at the end of the trace.
                 break
 
             # Request result gives us the best arrival stop, the next step
             # is to find all stops that are linked to this stop via a transfer.
-            best_stops = []
-            for a, l, t in zip(arrivals, linked_stops, transfer_durations):
-                if a.PlaceTypeId == resp.DetailedTrip.Arrival.TripStopPlace.id:
-                    l.departure_time = resp.DetailedTrip.Arrival.DateTime + t
-                    best_stops.append(l)
             # If we find several stops linked to the best arrival stop, choose
             # the one which has best departure_time.
-            best_stops.sort(key=lambda x: x.departure_time)
-            prev_stop = best_stops[0]
+            arrival = resp.DetailedTrip.Arrival
+            prev_stop, prev_time = self._best_linked_stop(arrivals, arrival.TripStopPlace.id,
+                                                          arrival.DateTime, True)
 
-        return ret
+        raise Return(ret)
 
 
     def _arrival_at_trip(self, detailed_trace, trace_id, providers):
@@ -603,42 +556,40 @@ class PlanTripCalculator(object):
         self._init_request(detailed_request)
 
         # Do all non detailed requests
-        for mis_api, departures, arrivals, linked_stops, transfer_durations in detailed_trace[0:-1]:
-            summed_up_request.departures = departures
-            summed_up_request.arrivals = arrivals
+        for hop in detailed_trace[0:-1]:
+            arrivals = hop.arrivals
+            summed_up_request.departures = hop.departures.live_stops()
+            summed_up_request.arrivals = arrivals.live_stops()
             if not summed_up_request.ArrivalTime:
                 summed_up_request.ArrivalTime = self._params.ArrivalTime
             else:
-                summed_up_request.ArrivalTime = min([x.departure_time for x in arrivals])
-                for a in arrivals:
-                    a.AccessTime = a.departure_time - summed_up_request.ArrivalTime
+                summed_up_request.ArrivalTime = arrivals.min_time(arrivals.departure_times)
+                arrivals.set_access_times(arrivals.departure_times,
+                                          summed_up_request.ArrivalTime)
             summed_up_request.DepartureTime = None
             summed_up_request.options = []
-            resp = mis_api.get_summed_up_itineraries(summed_up_request)
-            self._update_departures(departures, linked_stops, resp.summedUpTrips)
+            resp = yield hop.mis_api.summed_up_itineraries(summed_up_request)
+            self._update_departures(hop.departures, resp.summedUpTrips)
 
             # To have linked_stops departure_time, just substract transfer time
             # from request results.
-            for d, l, t in zip(departures, linked_stops, transfer_durations):
-                l.departure_time = d.departure_time - t
+            hop.departures.propagate_departure_times()
 
         # Do non-detailed optimized request (only one, always)
-        mis_api, departures, arrivals, _, _ = detailed_trace[-1]
-        summed_up_request.departures = departures
-        summed_up_request.arrivals = arrivals
-        summed_up_request.ArrivalTime = min([x.departure_time for x in arrivals])
-        for a in arrivals:
-            a.AccessTime = a.departure_time - summed_up_request.ArrivalTime
+        hop = detailed_trace[-1]
+        arrivals = hop.arrivals
+        summed_up_request.departures = hop.departures.live_stops()
+        summed_up_request.arrivals = arrivals.live_stops()
+        summed_up_request.ArrivalTime = arrivals.min_time(arrivals.departure_times)
+        arrivals.set_access_times(arrivals.departure_times, summed_up_request.ArrivalTime)
         summed_up_request.DepartureTime = None
         summed_up_request.options = [PlanSearchOptions.DEPARTURE_ARRIVAL_OPTIMIZED]
-        resp = mis_api.get_summed_up_itineraries(summed_up_request)
-        self._update_arrivals(arrivals, detailed_trace[-2][1], resp.summedUpTrips)
+        resp = yield hop.mis_api.summed_up_itineraries(summed_up_request)
+        self._update_arrivals(arrivals, resp.summedUpTrips)
         best_departure_time = max([x.Departure.DateTime for x in resp.summedUpTrips])
 
         # Add transfer time from previous request results
-        mis_api, departures, arrivals, linked_stops, transfer_durations = detailed_trace[-2]
-        for d, l, t in zip(departures, linked_stops, transfer_durations):
-            d.arrival_time = l.arrival_time + t
+        arrivals.propagate_arrival_times()
         notif = PlanTripExistenceNotificationResponseType(
                     RequestId=self._params.clientRequestId,
                     ComposedTripId=trace_id,
@@ -652,66 +603,64 @@ class PlanTripCalculator(object):
         # Do departure_at non-detailed requests
         if len(detailed_trace) > 2:
             for i in reversed(range(1, len(detailed_trace) - 1)):
-                mis_api, departures, arrivals, _, _ = detailed_trace[i]
-                summed_up_request.departures = departures
-                summed_up_request.arrivals = arrivals
+                hop = detailed_trace[i]
+                departures = hop.departures
+                summed_up_request.departures = departures.live_stops()
+                summed_up_request.arrivals = hop.arrivals.live_stops()
                 summed_up_request.ArrivalTime = None
-                summed_up_request.DepartureTime = min([x.arrival_time for x in departures])
-                for d in departures:
-                    d.AccessTime = d.arrival_time - summed_up_request.DepartureTime
+                summed_up_request.DepartureTime = departures.min_time(departures.arrival_times)
+                departures.set_access_times(departures.arrival_times,
+                                            summed_up_request.DepartureTime)
                 summed_up_request.options = []
-                resp = mis_api.get_summed_up_itineraries(summed_up_request)
-                self._update_arrivals(arrivals, detailed_trace[i-1][1], resp.summedUpTrips)
+                resp = yield hop.mis_api.summed_up_itineraries(summed_up_request)
+                self._update_arrivals(hop.arrivals, resp.summedUpTrips)
 
                 # Add transfer time from previous request results
-                _, departures, _, linked_stops, transfer_durations = detailed_trace[i-1]
-                for d, l, t in zip(departures, linked_stops, transfer_durations):
-                    d.arrival_time = l.arrival_time + t
+                hop.arrivals.propagate_arrival_times()
 
         # Do all detailed requests.
         # Best departure stop from previous request, will become the arrival
         # point of the next request.
         prev_stop = None
-        for mis_api, departures, arrivals, linked_stops, transfer_durations in detailed_trace:
+        prev_time = None
+        for hop in detailed_trace:
+            departures = hop.departures
             detailed_request.DepartureTime = None
             if not prev_stop:
                 # At first, do a departure_at request.
-                prev_stop = arrivals[0]
+                prev_stop = hop.arrivals.live_stops()[0]
                 detailed_request.ArrivalTime = None
-                detailed_request.DepartureTime = min([x.arrival_time for x in departures])
-                for d in departures:
-                   d.AccessTime = d.arrival_time - detailed_request.DepartureTime
+                detailed_request.DepartureTime = departures.min_time(departures.arrival_times)
+                departures.set_access_times(departures.arrival_times,
+                                            detailed_request.DepartureTime)
             else:
                 # All other requests are arrival_at requests.
-                detailed_request.ArrivalTime = prev_stop.arrival_time
+                detailed_request.ArrivalTime = prev_time
                 detailed_request.DepartureTime = None
                 prev_stop.AccessTime = timedelta(seconds=0)
             detailed_request.multiDepartures = multiDeparturesType()
-            detailed_request.multiDepartures.Departure = list(set(departures))
+            detailed_request.multiDepartures.Departure = list(set(departures.live_stops()))
             detailed_request.multiDepartures.Arrival = prev_stop
-            resp = mis_api.get_itinerary(detailed_request)
+            resp = yield hop.mis_api.itinerary_call(detailed_request)
             if not resp.DetailedTrip:
                 raise NoItineraryFoundException()
-            ret.append((mis_api, resp.DetailedTrip))
+            ret.append((hop.mis_api, resp.DetailedTrip))
 
-            if not linked_stops:
+            if not hop.linked_stops:
                 # We are at the end of the trace.
                 break
 
             # Request result gives us the best departure stop, the next step
             # is to find all stops that are linked to this stop via a transfer.
-            best_stops = []
-            for d, l, t in zip(departures, linked_stops, transfer_durations):
-                if d.PlaceTypeId == resp.DetailedTrip.Departure.TripStopPlace.id:
-                    l.arrival_time = resp.DetailedTrip.Departure.DateTime - t
-                    best_stops.append(l)
             # If we find several stops linked to the best departure stop, choose
             # the one which has best arrival_time.
-            best_stops.sort(key=lambda x: x.arrival_time)
-            prev_stop = best_stops[0]
+            departure = resp.DetailedTrip.Departure
+            prev_stop, prev_time = self._best_linked_stop(departures,
+                                                          departure.TripStopPlace.id,
+                                                          departure.DateTime, False)
 
         ret.reverse()
-        return ret
+        raise Return(ret)
 
 
     def _init_request(self, request):
@@ -722,18 +671,33 @@ class PlanTripCalculator(object):
         request.Language = self._params.Language
 
 
-    @benchmark
-    def compute_trip(self, mis_trace):
-        start_date = datetime.now()
+    # If cancel_token is given, computation stops as soon as it is cancelled,
+    # raising CancelledError. coalescer is a coalescing.RequestCoalescer shared
+    # by traces of the same request.
+    def compute_trip(self, mis_trace, cancel_token=None, coalescer=None):
+        return run_sync(self.compute_trip_coroutine(mis_trace),
+                        lambda call: self._run_call(call, cancel_token, coalescer))
+
+    def _run_call(self, call, cancel_token, coalescer):
+        start = monotonic()
+        ret = call.run(cancel_token, coalescer)
+        record("mis_call", monotonic() - start, self.request_timings)
+        return ret
+
+
+    """
+        Coroutine computing the best trip for given trace. MIS requests are
+        yielded as MisCall objects, see coroutines module.
+    """
+    def compute_trip_coroutine(self, mis_trace):
+        start = monotonic()
         if not mis_trace:
             raise Exception("Empty mis_trace")
 
         # Check that first and last MIS support departure/arrival points with
         # geographic coordinates.
         for mis_id in [mis_trace[0], mis_trace[-1]]:
-            if not self._db_session.query(metabase.Mis.geographic_position_compliant) \
-                                   .filter_by(id=mis_id) \
-                                   .one()[0]:
+            if not self._topology.get_mis(mis_id).geographic_position_compliant:
                 raise Exception("First or last Mis is not geographic_position_compliant")
 
         trace_id = self._generate_trace_id(mis_trace)
@@ -741,22 +705,25 @@ class PlanTripCalculator(object):
         # If there is only one MIS in the trace, just do a detailed request on the
         # given MIS.
         if len(mis_trace) == 1:
-            ret = self._single_mis_trip(mis_trace[0], trace_id, providers)
+            ret = yield self._single_mis_trip(mis_trace[0], trace_id, providers)
         else:
             if self._params.DepartureTime:
                 detailed_trace = self._departure_at_detailed_trace(mis_trace)
-                ret = self._departure_at_trip(detailed_trace, trace_id, providers)
+                ret = yield self._departure_at_trip(detailed_trace, trace_id, providers)
             else:
                 detailed_trace = self._arrival_at_detailed_trace(mis_trace)
-                ret = self._arrival_at_trip(detailed_trace, trace_id, providers)
+                ret = yield self._arrival_at_trip(detailed_trace, trace_id, providers)
 
-        notif = create_full_notification(self._params.clientRequestId, trace_id, ret, datetime.now() - start_date)
+        runtime = monotonic() - start
+        record("compute_trip", runtime, self.request_timings)
+        notif = create_full_notification(self._params.clientRequestId, trace_id, ret,
+                                         timedelta(seconds=runtime))
         self._notif_queue.put(notif)
 
-        return ret
+        raise Return(ret)
 
 
     def __del__(self):
         logging.debug("Deleting PlanTripCalculator instance")
-        if self._db_session:
+        if self._db_session and self._owns_db_session:
             self._planner.remove_db_session(self._db_session)
@@ -0,0 +1,87 @@
+"""
+    MIS trace enumeration.
+
+    MIS and their connections form an undirected graph given as an adjacency
+    list ({mis_id : iterable of connected mis_id}). A trace is a simple path in
+    this graph, going from a departure MIS to an arrival MIS.
+"""
+
+
+"""
+    Return {mis_id : number of connections needed to reach an arrival MIS}
+    for all MIS that can reach an arrival MIS in less than max_depth connections.
+    MIS that are in the middle of the path must be in transit_mises (if given).
+"""
+def _arrival_distances(connections, arrival_mises, max_depth, transit_mises):
+    ret = dict((x, 0) for x in arrival_mises)
+    frontier = sorted(arrival_mises)
+    depth = 0
+    while frontier and depth < max_depth:
+        depth += 1
+        next_frontier = []
+        for mis_id in frontier:
+            if depth > 1 and transit_mises is not None \
+               and mis_id not in transit_mises:
+                # mis_id would be in the middle of the trace.
+                continue
+            for m in connections.get(mis_id, ()):
+                if m not in ret:
+                    ret[m] = depth
+                    next_frontier.append(m)
+        frontier = next_frontier
+    return ret
+
+
+"""
+    Return all traces ([[mis_id]]) that start from a MIS in departure_mises,
+    end in a MIS in arrival_mises and contain at most max_trace_length MIS.
+    Traces never contain the same MIS twice, each trace is returned once.
+
+    The graph is walked breadth-first, so traces are sorted by length (and
+    lexicographically for a given length). Partial traces that cannot reach
+    an arrival MIS within max_trace_length are never extended, which keeps
+    the cost proportional to the number of returned traces.
+
+    If transit_mises is given, only MIS belonging to it can be in the middle of
+    a trace (i.e. not the first or last MIS of the trace).
+    If max_traces is greater than 0, stop after finding max_traces traces (the
+    shortest ones).
+"""
+def find_mis_traces(connections, departure_mises, arrival_mises, max_trace_length,
+                    transit_mises=None, max_traces=0):
+    ret = [] # [[mis_id]]
+    if max_trace_length < 1:
+        return ret
+
+    arrival_mises = frozenset(arrival_mises)
+    distances = _arrival_distances(connections, arrival_mises,
+                                   max_trace_length - 1, transit_mises)
+
+    # Partial traces of current length
+    level = [(x,) for x in sorted(departure_mises) if x in distances]
+    length = 1
+    while level:
+        for trace in level:
+            if trace[-1] in arrival_mises:
+                ret.append(list(trace))
+                if len(ret) == max_traces:
+                    return ret
+
+        if length == max_trace_length:
+            break
+
+        next_level = []
+        for trace in level:
+            last = trace[-1]
+            # Last MIS will be in the middle of the trace.
+            if transit_mises is not None and length > 1 and last not in transit_mises:
+                continue
+            for m in sorted(connections.get(last, ())):
+                d = distances.get(m, None)
+                if d is None or length + 1 + d > max_trace_length or m in trace:
+                    continue
+                next_level.append(trace + (m,))
+        level = next_level
+        length += 1
+
+    return ret
@@ -0,0 +1,146 @@
+"""
+    Best-first scheduling of MIS traces.
+
+    A lower bound of the duration of any trip following a given trace is
+    computed from great-circle distances: from the departure point to a
+    transfer of the first MIS pair, from there to a transfer of the next pair,
+    and so on until the arrival point, each part being covered at the maximum
+    speed of the modes of the MIS it is in, plus transfer durations.
+    Traces are then computed in increasing lower bound order, and traces that
+    cannot beat enough of the trips already found are dropped.
+
+    Transfers between 2 MIS (gateways) are ranked as well, so that only the
+    best ones are sent to MIS: the ones with the shortest transfer duration
+    and the smallest detour from the departure-arrival corridor.
+
+    Trips are compared using their "score": for "departure at" requests, the
+    time between the requested departure time and the trip arrival; for
+    "arrival at" requests, the time between the trip departure and the
+    requested arrival time. A trace lower bound is also a lower bound of the
+    score of its trips.
+"""
+import bisect
+from datetime import timedelta
+from apiisim.common import TransportModeEnum
+from apiisim.planner.geo import haversine
+
+
+# Maximum speed of each mode, in meters per second
+MAX_SPEEDS = {
+    TransportModeEnum.BUS : 30,
+    TransportModeEnum.TROLLEYBUS : 20,
+    TransportModeEnum.TRAM : 20,
+    TransportModeEnum.COACH : 37,
+    TransportModeEnum.RAIL : 90,
+    TransportModeEnum.INTERCITYRAIL : 90,
+    TransportModeEnum.URBANRAIL : 45,
+    TransportModeEnum.METRO : 25,
+    TransportModeEnum.AIR : 270,
+    TransportModeEnum.WATER : 25,
+    TransportModeEnum.CABLE : 12,
+    TransportModeEnum.FUNICULAR : 12,
+    TransportModeEnum.TAXI : 40,
+    TransportModeEnum.BIKE : 12,
+    TransportModeEnum.CAR : 40,
+}
+DEFAULT_MAX_SPEED = max(MAX_SPEEDS.values())
+# Haversine distances may be slightly longer than distances on the ellipsoid.
+DISTANCE_FACTOR = 0.99
+# Speed (in meters per second) used to convert a gateway detour to a duration
+DETOUR_SPEED = 10
+
+
+"""
+    Maximum speed (in meters per second) of given modes, DEFAULT_MAX_SPEED if
+    modes is empty or contains TransportModeEnum.ALL.
+"""
+def max_speed(modes):
+    if not modes or TransportModeEnum.ALL in modes:
+        return DEFAULT_MAX_SPEED
+    return max([MAX_SPEEDS.get(x, DEFAULT_MAX_SPEED) for x in modes])
+
+
+def _travel_time(position1, position2, speed):
+    return DISTANCE_FACTOR * haversine(position1[0], position1[1],
+                                       position2[0], position2[1]) / speed
+
+
+"""
+    Return lower bound (as a timedelta) of the duration of a trip from
+    departure to arrival ((lon, lat) positions) following a trace of n MIS.
+        - speeds: [maximum speed in each MIS of the trace], n items.
+        - hops: [[(stop1 position, stop2 position, transfer duration in seconds)]],
+          transfers between each pair of consecutive MIS, n - 1 items.
+    Return None if a MIS pair has no transfer.
+"""
+def trace_lower_bound(departure, arrival, speeds, hops):
+    # [(position, lower bound of time needed to reach it)]
+    reached = [(departure, 0.0)]
+    for speed, transfers in zip(speeds, hops):
+        if not transfers:
+            return None
+        next_reached = []
+        for stop1, stop2, duration in transfers:
+            best = min([t + _travel_time(p, stop1, speed) for p, t in reached])
+            next_reached.append((stop2, best + duration))
+        reached = next_reached
+    best = min([t + _travel_time(p, arrival, speeds[-1]) for p, t in reached])
+    return timedelta(seconds=best)
+
+
+"""
+    Return the max_transfers best transfers (transfer_cache.TransferInfo) of
+    given transfers between 2 MIS, departure and arrival being the (lon, lat)
+    positions of the requested trip. A transfer is scored by its duration plus
+    the time needed to cover its detour (distance from the departure to stop1
+    plus distance from stop2 to the arrival, minus the direct distance) at
+    DETOUR_SPEED. Transfers with the same score keep their order.
+"""
+def rank_transfers(transfers, departure, arrival, max_transfers):
+    if len(transfers) <= max_transfers:
+        return tuple(transfers)
+    direct = haversine(departure[0], departure[1], arrival[0], arrival[1])
+    def score(t):
+        detour = haversine(departure[0], departure[1], t.stop1.long, t.stop1.lat) + \
+                 haversine(t.stop2.long, t.stop2.lat, arrival[0], arrival[1]) - direct
+        return t.duration + detour / DETOUR_SPEED
+    return tuple(sorted(transfers, key=score)[:max_transfers])
+
+
+"""
+    Score (timedelta) of a trip computed by PlanTripCalculator.compute_trip(),
+    the lower the better.
+"""
+def trip_score(params, trip):
+    if params.DepartureTime:
+        return trip[-1][1].Arrival.DateTime - params.DepartureTime
+    return params.ArrivalTime - trip[0][1].Departure.DateTime
+
+
+"""
+    Decide which traces of a request are not worth computing anymore.
+    lower_bounds is a {tuple(trace) : timedelta or None} dict. Once at least
+    min_trips trips have a score lower than the lower bound of a trace, this
+    trace is dropped. Traces with an unknown (None) lower bound are never
+    dropped, a min_trips of 0 disables pruning.
+    Not thread-safe, calls are serialized by the executor running the traces.
+"""
+class TracePruner(object):
+    DEFAULT_MIN_TRIPS = 3
+
+    def __init__(self, lower_bounds, min_trips=DEFAULT_MIN_TRIPS):
+        self._lower_bounds = lower_bounds
+        self._min_trips = min_trips
+        self._scores = [] # min_trips best scores, in increasing order
+
+    def add_trip(self, score):
+        if self._min_trips <= 0:
+            return
+        bisect.insort(self._scores, score)
+        del self._scores[self._min_trips:]
+
+    def is_hopeless(self, trace):
+        if self._min_trips <= 0 or len(self._scores) < self._min_trips:
+            return False
+        bound = self._lower_bounds.get(tuple(trace), None)
+        return bound is not None and self._scores[-1] < bound
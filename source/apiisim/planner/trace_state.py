@@ -0,0 +1,133 @@
+"""
+    State of a trace being computed by PlanTripCalculator.
+
+    A trace of n MIS is split in n hops, one per MIS, each of them having a
+    set of departure stops and a set of arrival stops (StopSet). Between two
+    consecutive MIS, arrival stops of the first hop and departure stops of
+    the second one are the two sides of the same transfers: stop i of one
+    side is linked to stop i of the other side by transfer i. Both sides
+    share the transfer durations and the liveness of each transfer, so that
+    removing a stop (no itinerary found to or from it) removes its linked
+    stop as well, in constant time.
+
+    Stops are indexed by PlaceTypeId, and their arrival and departure times
+    are kept in arrays parallel to the stops.
+"""
+
+
+class _Liveness(object):
+    def __init__(self, size):
+        self.alive = [True] * size
+        self.count = size
+
+
+class StopSet(object):
+    def __init__(self, stops, durations=None, liveness=None):
+        self.stops = stops # [TraceStop or LocationContextType]
+        self.arrival_times = [None] * len(stops) # [datetime]
+        self.departure_times = [None] * len(stops) # [datetime]
+        # Durations of transfers to linked stops, None if not linked.
+        self.durations = durations # [timedelta]
+        self.linked = None # StopSet on the other side of transfers
+        self._liveness = liveness or _Liveness(len(stops))
+        self._index = {} # {PlaceTypeId : [index]}
+        for i, stop in enumerate(stops):
+            self._index.setdefault(stop.PlaceTypeId, []).append(i)
+
+    def __len__(self):
+        return self._liveness.count
+
+    def __repr__(self):
+        return "<StopSet(%s)>" % self.live_stops()
+
+    def live_indexes(self):
+        alive = self._liveness.alive
+        return [i for i in range(len(self.stops)) if alive[i]]
+
+    def live_stops(self):
+        alive = self._liveness.alive
+        return [x for i, x in enumerate(self.stops) if alive[i]]
+
+    # Return indexes of live stops having given PlaceTypeId.
+    def indexes(self, place_id):
+        alive = self._liveness.alive
+        return [i for i in self._index.get(place_id, []) if alive[i]]
+
+    # Remove stop i, along with its linked stop.
+    def remove(self, i):
+        if self._liveness.alive[i]:
+            self._liveness.alive[i] = False
+            self._liveness.count -= 1
+
+    # Return the earliest of given times (arrival_times or departure_times)
+    # of live stops.
+    def min_time(self, times):
+        return min([times[i] for i in self.live_indexes()])
+
+    # Set AccessTime of live stops to their time (in given times) minus
+    # reference.
+    def set_access_times(self, times, reference):
+        for i in self.live_indexes():
+            self.stops[i].AccessTime = times[i] - reference
+
+    """
+        found is a {PlaceTypeId : datetime} dict: times (arrival_times or
+        departure_times) of live stops are set from it, stops that are not
+        in found are removed, along with their linked stops. Return removed
+        stops.
+    """
+    def update_times(self, times, found):
+        removed = []
+        for i in self.live_indexes():
+            time = found.get(self.stops[i].PlaceTypeId, None)
+            if time is None:
+                self.remove(i)
+                removed.append(self.stops[i])
+            else:
+                times[i] = time
+        return removed
+
+    # Arrival time of linked stops is the arrival time of their stop plus the
+    # transfer duration.
+    def propagate_arrival_times(self):
+        for i in self.live_indexes():
+            self.linked.arrival_times[i] = self.arrival_times[i] + self.durations[i]
+
+    # Departure time of linked stops is the departure time of their stop
+    # minus the transfer duration.
+    def propagate_departure_times(self):
+        for i in self.live_indexes():
+            self.linked.departure_times[i] = self.departure_times[i] - self.durations[i]
+
+
+"""
+    Return the 2 linked StopSets of transfers ([timedelta], [stop in first
+    MIS], [stop in second MIS]), see PlanTripCalculator._get_transfers().
+"""
+def new_transfer_stop_sets(transfers):
+    durations, stops1, stops2 = transfers
+    liveness = _Liveness(len(durations))
+    side1 = StopSet(stops1, durations, liveness)
+    side2 = StopSet(stops2, durations, liveness)
+    side1.linked = side2
+    side2.linked = side1
+    return side1, side2
+
+
+"""
+    Part of a trace covered by one MIS. linked_stops are the stops linked by
+    transfers to the stops of this hop that lead to the next hop (arrivals
+    for departure_at requests, departures for arrival_at requests), None for
+    the last hop.
+"""
+class TraceHop(object):
+    def __init__(self, mis_api, departures, arrivals, linked_stops):
+        self.mis_api = mis_api
+        self.departures = departures # StopSet
+        self.arrivals = arrivals # StopSet
+        self.linked_stops = linked_stops # StopSet or None
+
+    def __repr__(self):
+        return "<TraceHop(%s, departures=%s, arrivals=%s, linked_stops=%s)>" \
+               % (self.mis_api.get_name() if self.mis_api else None,
+                  self.departures, self.arrivals, self.linked_stops)
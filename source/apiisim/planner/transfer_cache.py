@@ -0,0 +1,97 @@
+"""
+    Cache of transfers between 2 MIS.
+
+    Transfers only change when the back_office runs, so they are loaded once
+    per MIS pair and per back_office import (the generation of the current
+    MisTopology), and shared between all threads.
+    Entries are stored as tuples, which are both compact and immutable: every
+    caller builds its own TraceStop objects from them, since TraceStop objects
+    are modified during trip computation.
+"""
+import logging, threading
+from collections import namedtuple
+from apiisim import metabase
+from apiisim.common.cache import LruCache
+
+
+# Attribute names match those of metabase.Stop, so that StopInfo objects can be
+# given to stop_to_trace_stop().
+StopInfo = namedtuple("StopInfo", ["code", "lat", "long"])
+
+# Transfer between 2 MIS, stop1 belonging to the first MIS of the pair, stop2
+# to the second one. Duration is in seconds.
+TransferInfo = namedtuple("TransferInfo", ["duration", "stop1", "stop2"])
+
+
+"""
+    Return active transfers between mis1_id and mis2_id, as a tuple of
+    TransferInfo, ordered by transfer id and limited to max_transfers (if given).
+    transfer_mis stores transfers in both orientations, so this is a single
+    scan of its (mis1_id, mis2_id, ...) covering index.
+"""
+def load_transfers(db_session, mis1_id, mis2_id, max_transfers=None):
+    tm = metabase.TransferMis
+    query = db_session.query(tm.duration,
+                             tm.stop1_code, tm.stop1_lat, tm.stop1_long,
+                             tm.stop2_code, tm.stop2_lat, tm.stop2_long) \
+                      .filter(tm.mis1_id == mis1_id) \
+                      .filter(tm.mis2_id == mis2_id) \
+                      .filter(tm.transfer_active == True) \
+                      .order_by(tm.transfer_id)
+    if max_transfers is not None:
+        query = query.limit(max_transfers)
+    results = query.all()
+    return tuple(TransferInfo(duration,
+                              StopInfo(s1_code, s1_lat, s1_long),
+                              StopInfo(s2_code, s2_lat, s2_long))
+                 for duration, s1_code, s1_lat, s1_long, s2_code, s2_lat, s2_long in results)
+
+
+"""
+    Return transfers of given MIS pair with stops swapped, i.e. transfers from
+    mis2 to mis1 given transfers from mis1 to mis2.
+"""
+def reverse_transfers(transfers):
+    return tuple(TransferInfo(x.duration, x.stop2, x.stop1) for x in transfers)
+
+
+class TransferCache(object):
+    MAX_SIZE = 10000 # Maximum number of cached MIS pairs
+
+    def __init__(self, max_size=MAX_SIZE):
+        self._cache = LruCache(max_size)
+        self._generation = None
+        self._lock = threading.Lock()
+
+    """
+        Return tuple of all TransferInfo from mis1_id to mis2_id, generation
+        being the id of the back_office import transfers must come from.
+    """
+    def get(self, db_session, generation, mis1_id, mis2_id):
+        with self._lock:
+            # Only a newer generation clears the cache: threads still working
+            # with a previous one must not make it go back and forth.
+            if generation is not None and \
+               (self._generation is None or generation > self._generation):
+                # Previous entries will never be used again, free them.
+                # If another thread is still working with a previous
+                # generation, it will keep on working properly, its entries
+                # being identified by their generation.
+                if self._generation is not None:
+                    logging.info("New back_office import (%s), clearing transfer cache",
+                                 generation)
+                    self._cache.clear()
+                self._generation = generation
+
+        # Only one orientation is stored, the other one is computed.
+        key = (generation, min(mis1_id, mis2_id), max(mis1_id, mis2_id))
+        transfers = self._cache.get(key)
+        if transfers is None:
+            transfers = load_transfers(db_session, key[1], key[2])
+            self._cache.put(key, transfers)
+        if mis1_id > mis2_id:
+            transfers = reverse_transfers(transfers)
+        return transfers
+
+    def get_stats(self):
+        return self._cache.get_stats()
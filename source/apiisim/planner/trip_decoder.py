@@ -0,0 +1,224 @@
+"""
+    Decoding of detailed trips returned by MIS translators.
+
+    Trips, sections and steps are built as lightweight objects with
+    __slots__ instead of generateDS objects: they have the same attributes
+    (so that they can be marshalled with the same field specs), but cost
+    less to create and hold. Dates and durations are parsed with
+    parse_datetime() and xsd_duration_to_timedelta(), which use precompiled
+    patterns.
+"""
+from apiisim.common import TypeOfPlaceEnum, parse_datetime, xsd_duration_to_timedelta
+
+
+# Constructors take the same keyword arguments as generateDS ones, attributes
+# not given being None.
+class _Slotted(object):
+    __slots__ = ()
+
+    def __repr__(self):
+        return "<%s(%s)>" % (self.__class__.__name__,
+                             ", ".join(["%s=%r" % (x, getattr(self, x))
+                                        for x in self.__slots__]))
+
+
+class Position(_Slotted):
+    __slots__ = ("Latitude", "Longitude")
+
+    def __init__(self, Latitude=None, Longitude=None):
+        self.Latitude = Latitude
+        self.Longitude = Longitude
+
+
+class TripStopPlace(_Slotted):
+    __slots__ = ("id", "Position", "Name", "CityCode", "CityName", "TypeOfPlaceRef")
+
+    def __init__(self, id=None, Position=None, Name=None, CityCode=None, CityName=None,
+                 TypeOfPlaceRef=None):
+        self.id = id
+        self.Position = Position
+        self.Name = Name
+        self.CityCode = CityCode
+        self.CityName = CityName
+        self.TypeOfPlaceRef = TypeOfPlaceRef
+
+
+class EndPoint(_Slotted):
+    __slots__ = ("TripStopPlace", "DateTime")
+
+    def __init__(self, TripStopPlace=None, DateTime=None):
+        self.TripStopPlace = TripStopPlace
+        self.DateTime = DateTime
+
+
+class StepEndPoint(_Slotted):
+    __slots__ = ("TripStopPlace", "DateTime", "PassThrough")
+
+    def __init__(self, TripStopPlace=None, DateTime=None, PassThrough=None):
+        self.TripStopPlace = TripStopPlace
+        self.DateTime = DateTime
+        self.PassThrough = PassThrough
+
+
+class Step(_Slotted):
+    __slots__ = ("id", "Departure", "Arrival", "Duration")
+
+    def __init__(self, id=None, Departure=None, Arrival=None, Duration=None):
+        self.id = id
+        self.Departure = Departure
+        self.Arrival = Arrival
+        self.Duration = Duration
+
+
+class PTNetwork(_Slotted):
+    __slots__ = ("id", "Name", "RegistrationNumber")
+
+    def __init__(self, id=None, Name=None, RegistrationNumber=None):
+        self.id = id
+        self.Name = Name
+        self.RegistrationNumber = RegistrationNumber
+
+
+class Line(_Slotted):
+    __slots__ = ("id", "Name", "Number", "PublishedName", "RegistrationNumber")
+
+    def __init__(self, id=None, Name=None, Number=None, PublishedName=None,
+                 RegistrationNumber=None):
+        self.id = id
+        self.Name = Name
+        self.Number = Number
+        self.PublishedName = PublishedName
+        self.RegistrationNumber = RegistrationNumber
+
+
+class PTRide(_Slotted):
+    __slots__ = ("PublicTransportMode", "Departure", "Arrival", "Duration", "Distance",
+                 "PTNetwork", "Line", "StopHeadSign", "steps")
+
+    def __init__(self, PublicTransportMode=None, Departure=None, Arrival=None,
+                 Duration=None, Distance=None, PTNetwork=None, Line=None,
+                 StopHeadSign=None, steps=None):
+        self.PublicTransportMode = PublicTransportMode
+        self.Departure = Departure
+        self.Arrival = Arrival
+        self.Duration = Duration
+        self.Distance = Distance
+        self.PTNetwork = PTNetwork
+        self.Line = Line
+        self.StopHeadSign = StopHeadSign
+        self.steps = steps
+
+
+class Leg(_Slotted):
+    __slots__ = ("SelfDriveMode", "Departure", "Arrival", "Duration")
+
+    def __init__(self, SelfDriveMode=None, Departure=None, Arrival=None, Duration=None):
+        self.SelfDriveMode = SelfDriveMode
+        self.Departure = Departure
+        self.Arrival = Arrival
+        self.Duration = Duration
+
+
+class Section(_Slotted):
+    __slots__ = ("PartialTripId", "PTRide", "Leg")
+
+    def __init__(self, PartialTripId=None, PTRide=None, Leg=None):
+        self.PartialTripId = PartialTripId
+        self.PTRide = PTRide
+        self.Leg = Leg
+
+
+class Trip(_Slotted):
+    __slots__ = ("id", "Departure", "Arrival", "Duration", "Distance", "Disrupted",
+                 "InterchangeNumber", "sections")
+
+    def __init__(self, id=None, Departure=None, Arrival=None, Duration=None,
+                 Distance=None, Disrupted=None, InterchangeNumber=None, sections=None):
+        self.id = id
+        self.Departure = Departure
+        self.Arrival = Arrival
+        self.Duration = Duration
+        self.Distance = Distance
+        self.Disrupted = Disrupted
+        self.InterchangeNumber = InterchangeNumber
+        self.sections = sections
+
+
+def decode_end_point(point, step_end_point=False):
+    p = point["TripStopPlace"]
+    position = p.get("Position", None)
+    if position is not None:
+        position = Position(Latitude=position["Latitude"],
+                            Longitude=position["Longitude"])
+    place = TripStopPlace(id=p["id"], Position=position, Name=p.get("Name", None),
+                          CityCode=p.get("CityCode", None),
+                          CityName=p.get("CityName", None),
+                          TypeOfPlaceRef=p.get("TypeOfPlaceRef",
+                                               TypeOfPlaceEnum.LOCATION))
+    if step_end_point:
+        return StepEndPoint(TripStopPlace=place,
+                            DateTime=parse_datetime(point["DateTime"]),
+                            PassThrough=point.get("PassThrough", False))
+    return EndPoint(TripStopPlace=place, DateTime=parse_datetime(point["DateTime"]))
+
+
+def decode_steps(steps):
+    return [Step(id=step["id"],
+                 Departure=decode_end_point(step["Departure"], step_end_point=True),
+                 Arrival=decode_end_point(step["Arrival"], step_end_point=True),
+                 Duration=xsd_duration_to_timedelta(step["Duration"]))
+            for step in steps]
+
+
+def decode_sections(sections):
+    ret = []
+    for section in sections:
+        ptr = None
+        leg = None
+        if "PTRide" in section:
+            p = section["PTRide"]
+            line = None
+            if "Line" in p:
+                l = p["Line"]
+                line = Line(id=l["id"], Name=l["Name"], Number=l.get("Number", None),
+                            PublishedName=l.get("PublishedName", None),
+                            RegistrationNumber=l.get("RegistrationNumber", None))
+            network = None
+            if "PTNetwork" in p:
+                n = p["PTNetwork"]
+                network = PTNetwork(id=n["id"], Name=n["Name"],
+                                    RegistrationNumber=n.get("RegistrationNumber", None))
+            ptr = PTRide(PublicTransportMode=p["PublicTransportMode"],
+                         Departure=decode_end_point(p["Departure"]),
+                         Arrival=decode_end_point(p["Arrival"]),
+                         Duration=xsd_duration_to_timedelta(p["Duration"]),
+                         Distance=p.get("Distance", None),
+                         PTNetwork=network, Line=line,
+                         StopHeadSign=p.get("StopHeadSign", None),
+                         steps=decode_steps(p["steps"]))
+        elif "Leg" in section:
+            l = section["Leg"]
+            leg = Leg(SelfDriveMode=l["SelfDriveMode"],
+                      Departure=decode_end_point(l["Departure"]),
+                      Arrival=decode_end_point(l["Arrival"]),
+                      Duration=xsd_duration_to_timedelta(l["Duration"]))
+        ret.append(Section(PartialTripId=section.get("PartialTripId", None),
+                           PTRide=ptr, Leg=leg))
+    return ret
+
+
+"""
+    Return Trip decoded from the DetailedTrip of a MIS translator itinerary
+    response (JSON object), None if trip is empty.
+"""
+def decode_detailed_trip(trip):
+    if not trip:
+        return None
+
+    return Trip(Departure=decode_end_point(trip["Departure"]),
+                Arrival=decode_end_point(trip["Arrival"]),
+                Duration=xsd_duration_to_timedelta(trip["Duration"]),
+                Distance=trip.get("Distance", 0),
+                Disrupted=trip.get("Disrupted", False),
+                InterchangeNumber=trip.get("InterchangeNumber", 0),
+                sections=decode_sections(trip["sections"]))
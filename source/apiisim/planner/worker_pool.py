@@ -0,0 +1,240 @@
+"""
+    Process-wide pool of threads computing trips.
+
+    Every request submits its traces as a JobGroup. Worker threads pick jobs
+    from groups in a round-robin fashion, so that a request with many traces
+    cannot starve other requests, and a group never has more than its
+    max_workers jobs running at the same time.
+    Each worker thread owns a database session, reused for all the jobs it
+    runs, so that the number of threads and database connections does not
+    depend on the number of clients.
+"""
+import logging, threading, traceback
+from collections import deque
+from functools import partial
+from apiisim.common.cancellation import CancelToken
+from apiisim.planner.coalescing import RequestCoalescer
+from apiisim.planner.plan_trip_calculator import PlanTripCalculator
+from apiisim.planner.trace_ranking import trip_score
+
+
+"""
+    Traces of a given request, waiting to be computed. If pruner (a
+    trace_ranking.TracePruner) is given, pending traces that cannot beat trips
+    already computed are dropped. If request_timings (a metrics.RequestTimings)
+    is given, time spent computing traces is added to it. If topology (a
+    mis_topology.MisTopology) is given, all traces are computed with it.
+"""
+class JobGroup(object):
+    def __init__(self, params, traces, notif_queue, max_workers, pruner=None,
+                 request_timings=None, topology=None):
+        self.params = params
+        # Snapshot traces have been computed with, None to use the current one.
+        self.topology = topology
+        self.notif_queue = notif_queue
+        self.max_workers = max(1, max_workers)
+        # Following attributes are only modified by the executor running
+        # the group (with WorkerPool lock held, or from AsyncEngine loop thread).
+        self.pending = deque(traces)
+        self.running = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.dropped = 0 # Traces never computed because of cancellation
+        self.pruned = 0 # Traces never computed because they could not win
+        self.pruner = pruner
+        self.request_timings = request_timings
+        self._finished = threading.Event()
+        # Cancelled by cancel(), executors register their callbacks on it.
+        self.cancel_token = CancelToken()
+        # Identical MIS requests of different traces are only sent once.
+        self.coalescer = RequestCoalescer()
+
+    """
+        Stop computing traces: pending traces are dropped and MIS requests in
+        flight are aborted. Can be called from any thread.
+    """
+    def cancel(self):
+        self.cancel_token.cancel()
+
+    def is_cancelled(self):
+        return self.cancel_token.cancelled
+
+    # Called by the executor when a trip has been computed, drops hopeless
+    # pending traces.
+    def add_trip(self, trip):
+        if self.pruner is None or not trip:
+            return
+        try:
+            self.pruner.add_trip(trip_score(self.params, trip))
+        except Exception as e:
+            logging.warning("Could not compute trip score: %s", e)
+            return
+        pending = deque([x for x in self.pending if not self.pruner.is_hopeless(x)])
+        self.pruned += len(self.pending) - len(pending)
+        self.pending = pending
+
+    def is_finished(self):
+        return self._finished.is_set()
+
+    # Wait until all traces have been computed.
+    def wait(self, timeout=None):
+        self._finished.wait(timeout)
+        return self._finished.is_set()
+
+    def _set_finished(self):
+        self._finished.set()
+
+    def __repr__(self):
+        return "<JobGroup(request_id='%s', pending=%s, running=%s)>" % \
+               (self.params.clientRequestId, len(self.pending), self.running)
+
+
+"""
+    Return (group, trace) for the next trace to compute, (None, None) if all
+    groups already run their maximum number of jobs. groups is a deque of
+    JobGroup that have pending traces, rotated so that groups are served in a
+    round-robin fashion. Groups with no more pending traces are removed.
+"""
+def pop_next_job(groups):
+    for _ in range(len(groups)):
+        group = groups.popleft()
+        groups.append(group)
+        if group.running < group.max_workers:
+            trace = group.pending.popleft()
+            group.running += 1
+            if not group.pending:
+                groups.remove(group)
+            return group, trace
+    return None, None
+
+
+class WorkerPool(object):
+    DEFAULT_SIZE = 16
+    # Default maximum number of traces of a given request computed at the same time
+    DEFAULT_MAX_WORKERS_PER_REQUEST = 4
+
+    def __init__(self, planner, size=DEFAULT_SIZE,
+                 max_workers_per_request=DEFAULT_MAX_WORKERS_PER_REQUEST):
+        self._planner = planner
+        self._size = max(1, size)
+        self._max_workers_per_request = max(1, max_workers_per_request)
+        self._cond = threading.Condition()
+        # Groups that still have pending jobs, in round-robin order.
+        self._groups = deque()
+        self._threads = []
+        self._stopped = False
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            for i in range(self._size):
+                t = threading.Thread(target=self._worker_loop,
+                                     name="PlannerWorker-%s" % i)
+                t.daemon = True
+                self._threads.append(t)
+                t.start()
+        logging.info("<WorkerPool> %s worker threads started", self._size)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    """
+        Submit traces of given request, return the corresponding JobGroup.
+        Traces are computed in the given order. Only the first params.MaxTrips
+        traces are computed (all of them if MaxTrips is 0), and at most
+        max_workers_per_request of them at the same time. topology is the
+        MisTopology traces have been computed with.
+    """
+    def submit(self, params, traces, notif_queue, pruner=None, request_timings=None,
+               topology=None):
+        if params.MaxTrips:
+            traces = traces[:params.MaxTrips]
+        max_workers = min(self._max_workers_per_request, len(traces) or 1)
+        group = JobGroup(params, traces, notif_queue, max_workers, pruner, request_timings,
+                         topology)
+        with self._cond:
+            if not group.pending:
+                group._set_finished()
+                return group
+            self._groups.append(group)
+            self._cond.notify_all()
+        group.cancel_token.add_callback(partial(self._cancel, group))
+        return group
+
+    # Drop pending traces of given group. Running ones are aborted by the
+    # cancel token given to PlanTripCalculator.compute_trip().
+    def _cancel(self, group):
+        with self._cond:
+            group.dropped += len(group.pending)
+            group.pending.clear()
+            if group in self._groups:
+                self._groups.remove(group)
+            if group.running == 0:
+                group._set_finished()
+
+    def get_stats(self):
+        with self._cond:
+            return {"size" : self._size,
+                    "requests" : len(self._groups),
+                    "pending" : sum([len(x.pending) for x in self._groups])}
+
+    # Must be called with self._cond acquired.
+    def _next_job(self):
+        return pop_next_job(self._groups)
+
+    def _job_done(self, group, success, trip=None):
+        with self._cond:
+            group.running -= 1
+            if success:
+                group.succeeded += 1
+                group.add_trip(trip)
+                if not group.pending and group in self._groups:
+                    self._groups.remove(group)
+            else:
+                group.failed += 1
+            if not group.pending and group.running == 0:
+                group._set_finished()
+            else:
+                # group may now start another job.
+                self._cond.notify_all()
+
+    def _run_job(self, group, trace, db_session):
+        calculator = PlanTripCalculator(self._planner, group.params,
+                                        group.notif_queue, db_session,
+                                        group.request_timings, group.topology)
+        return calculator.compute_trip(trace, group.cancel_token, group.coalescer)
+
+    def _worker_loop(self):
+        db_session = self._planner.create_db_session()
+        try:
+            while True:
+                with self._cond:
+                    group, trace = self._next_job()
+                    while group is None:
+                        if self._stopped:
+                            return
+                        self._cond.wait()
+                        group, trace = self._next_job()
+                success = False
+                trip = None
+                try:
+                    trip = self._run_job(group, trace, db_session)
+                    success = True
+                except Exception as e:
+                    if group.is_cancelled():
+                        logging.debug("compute_trip(%s) cancelled: %s", trace, e)
+                    else:
+                        logging.error("compute_trip(%s): %s\n%s", trace, e,
+                                      traceback.format_exc())
+                finally:
+                    # Release database connection until next job.
+                    db_session.close()
+                    self._job_done(group, success, trip)
+        finally:
+            self._planner.remove_db_session(db_session)
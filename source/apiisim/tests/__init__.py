@@ -1,4 +1,4 @@
-import random, os, tempfile, subprocess
+import random, os, tempfile, subprocess, shutil
 import unittest, time
 from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
@@ -15,6 +15,9 @@ USER_NAME = "test_user"
 ADMIN_NAME = "postgres"
 USER_PASS = "test_user"
 ADMIN_PASS = "postgres"
+# If this environment variable is set, calculate_and_check() replaces
+# reference dumps with the dumps of the database it has computed.
+UPDATE_REF_DUMPS_VAR = "APIISIM_UPDATE_REF_DUMPS"
 
 CREATE_DB_CONF = \
 "DB_NAME=%s\n" \
@@ -69,11 +72,12 @@ def disconnect_db(db_session):
     db_session.bind.dispose()
 
 
-def launch_mis_translator(conf_file=""):
+def launch_mis_translator(conf_file="", args=[]):
     cmd = ['python', MIS_TRANSLATOR]
     if conf_file:
         cmd.append("--config")
         cmd.append(conf_file)
+    cmd.extend(args)
     process = subprocess.Popen(cmd)
     time.sleep(3)
     return process
@@ -131,6 +135,11 @@ def calculate_and_check(conf_file, ref_dump_file, db_name=DB_NAME,
     os.environ["PGPASSWORD"] = admin_password
     subprocess.call(['pg_dump', '-U', admin_name, '-h', 'localhost', '-f',
                      current_dump_file, db_name])
+    if os.environ.get(UPDATE_REF_DUMPS_VAR, ""):
+        # Reference dumps are regenerated instead of being checked.
+        shutil.copyfile(current_dump_file, ref_dump_file)
+        logging.info("Reference dump <%s> updated", ref_dump_file)
+        return True
     # We don't use diff here because pg_dump dumps data in any order,
     # we therefore need to sort dumps before comparing them.
     with open(current_dump_file, 'r') as f:
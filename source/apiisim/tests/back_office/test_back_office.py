@@ -710,6 +710,9 @@ back_office several times, each time with a different maximum distance between
 stops (to calculate transfers). For each different setting, we generate a dump
 of the resulting database and compare it to a reference dump. If they don't match,
 we exit the test and consider it as failed.
+Reference dumps must be regenerated whenever the schema changes, by running this
+test with the APIISIM_UPDATE_REF_DUMPS environment variable set (on the oldest
+supported PostgreSQL version).
 """
 class TestBackOfficeChangeTransferMaxDistance(unittest.TestCase):
 
@@ -0,0 +1,179 @@
+# -*- coding: utf8 -*-
+
+"""
+    Benchmark marshalling of large ComposedTrip notifications.
+
+    Detailed trips with a given number of sections (one PTRide every other
+    section, with a given number of steps, and walking legs in between) are
+    parsed as the planner does, combined into a PlanTripNotificationResponseType
+    and marshalled, both with the compiled serializers of
+    apiisim.common.marshalling and with the former flask_restful.marshal based
+    implementation. Both JSON outputs are checked to be identical.
+"""
+from apiisim.common.marshalling import marshal, plan_trip_notification_response_type, \
+                                       DATE_FORMAT
+from apiisim.planner import create_full_notification
+from apiisim.planner.trip_decoder import decode_detailed_trip
+from flask_restful import marshal as flask_marshal
+from datetime import datetime, timedelta
+from random import Random
+from time import time
+import argparse, json
+
+
+def get_cmd_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sections", default="2,10,50",
+                        help="Comma-separated numbers of sections per MIS trip")
+    parser.add_argument("--steps", default="5,20,100",
+                        help="Comma-separated numbers of steps per PTRide")
+    parser.add_argument("--mis", type=int, default=3,
+                        help="Number of MIS trips in the composed trip")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+
+    return parser.parse_args()
+
+
+"""
+    Former apiisim.common.marshalling.marshal().
+"""
+def legacy_marshal(obj, fields):
+    if isinstance(obj, list):
+        return [legacy_marshal(x, fields) for x in obj]
+
+    ret = flask_marshal(obj, fields)
+    items = ret.iteritems()
+    for k, v in items:
+        if v is None:
+            del ret[k]
+    return ret
+
+
+class FakeMisApi(object):
+    def __init__(self, name):
+        self._name = name
+
+    def get_name(self):
+        return self._name
+
+    def get_api_url(self):
+        return "http://%s/v0/" % self._name
+
+
+def _duration(seconds):
+    return "PT%dS" % seconds
+
+
+class TripBuilder(object):
+    def __init__(self, rand):
+        self._rand = rand
+        self._time = datetime(2014, 6, 1, 8, 0, 0)
+        self._stop_id = 0
+
+    def end_point(self, step_end_point=False):
+        self._stop_id += 1
+        ret = {"TripStopPlace" : {
+                    "id" : "stop_%s" % self._stop_id,
+                    "Name" : u"Arrêt %s" % self._stop_id,
+                    "CityCode" : "%05d" % self._rand.randint(0, 99999),
+                    "CityName" : u"Ville",
+                    "TypeOfPlaceRef" : "QUAY",
+                    "Position" : {"Latitude" : 45 + self._rand.random(),
+                                  "Longitude" : 4 + self._rand.random()}},
+               "DateTime" : self._time.strftime(DATE_FORMAT)}
+        if step_end_point:
+            ret["PassThrough"] = False
+        return ret
+
+    def _advance(self, seconds):
+        self._time += timedelta(seconds=seconds)
+
+    def step(self, i):
+        departure = self.end_point(True)
+        duration = self._rand.randint(30, 300)
+        self._advance(duration)
+        return {"id" : "step_%s" % i,
+                "Departure" : departure,
+                "Arrival" : self.end_point(True),
+                "Duration" : _duration(duration)}
+
+    def pt_ride(self, nb_steps):
+        departure = self.end_point()
+        start = self._time
+        steps = [self.step(i) for i in range(nb_steps)]
+        return {"PublicTransportMode" : "BUS",
+                "Departure" : departure,
+                "Arrival" : self.end_point(),
+                "Duration" : _duration((self._time - start).total_seconds()),
+                "Distance" : self._rand.randint(100, 10000),
+                "Line" : {"id" : "line_1", "Name" : "Line 1", "Number" : "1"},
+                "PTNetwork" : {"id" : "network_1", "Name" : "Network"},
+                "StopHeadSign" : "Terminus",
+                "steps" : steps}
+
+    def leg(self):
+        departure = self.end_point()
+        duration = self._rand.randint(60, 600)
+        self._advance(duration)
+        return {"SelfDriveMode" : "foot",
+                "Departure" : departure,
+                "Arrival" : self.end_point(),
+                "Duration" : _duration(duration)}
+
+    def trip(self, nb_sections, nb_steps):
+        start = self._time
+        sections = []
+        for i in range(nb_sections):
+            if i % 2:
+                sections.append({"Leg" : self.leg()})
+            else:
+                sections.append({"PTRide" : self.pt_ride(nb_steps)})
+        return {"Departure" : sections[0].values()[0]["Departure"],
+                "Arrival" : sections[-1].values()[0]["Arrival"],
+                "Duration" : _duration((self._time - start).total_seconds()),
+                "Distance" : 0,
+                "InterchangeNumber" : nb_sections / 2,
+                "sections" : sections}
+
+
+def new_notification(rand, nb_mis, nb_sections, nb_steps):
+    builder = TripBuilder(rand)
+    full_trip = [(FakeMisApi("mis_%s" % i),
+                  decode_detailed_trip(builder.trip(nb_sections, nb_steps)))
+                 for i in range(nb_mis)]
+    return create_full_notification("request_1", "trace_1", full_trip,
+                                    timedelta(seconds=2))
+
+
+def _time_per_call(func, iterations):
+    start = time()
+    for _ in range(iterations):
+        func()
+    return (time() - start) * 1000 / iterations
+
+
+def run(args):
+    rand = Random(args.seed)
+    sizes = [(int(x), int(y)) for x in args.sections.split(",")
+                               for y in args.steps.split(",")]
+    spec = plan_trip_notification_response_type
+
+    print "%9s %6s %10s %16s %16s %8s" % ("SECTIONS", "STEPS", "JSON (kB)",
+                                           "COMPILED (ms)", "LEGACY (ms)", "SPEEDUP")
+    for nb_sections, nb_steps in sizes:
+        notif = new_notification(rand, args.mis, nb_sections, nb_steps)
+        compiled_json = json.dumps(marshal(notif, spec))
+        if compiled_json != json.dumps(legacy_marshal(notif, spec)):
+            raise Exception("Output mismatch for %s sections, %s steps" % \
+                            (nb_sections, nb_steps))
+
+        compiled = _time_per_call(lambda: marshal(notif, spec), args.iterations)
+        legacy = _time_per_call(lambda: legacy_marshal(notif, spec), args.iterations)
+        print "%9s %6s %10.1f %16.3f %16.3f %8s" % \
+              (nb_sections, nb_steps, len(compiled_json) / 1024.0, compiled, legacy,
+               "%.1fx" % (legacy / compiled) if compiled else "-")
+
+
+if __name__ == '__main__':
+    run(get_cmd_args())
@@ -0,0 +1,144 @@
+# -*- coding: utf8 -*-
+
+"""
+    Benchmark MIS trace enumeration on synthetic MIS graphs.
+
+    MIS are randomly placed on a square and connected to their nearest
+    neighbours, which roughly mimics how MIS connections are computed by the
+    back_office (MIS are connected when they have stops close to each other).
+    For each graph size and maximum trace length, we compare the breadth-first
+    enumeration used by the planner with the former recursive implementation
+    and check that both return the same traces.
+"""
+from apiisim.planner.trace_graph import find_mis_traces
+from random import Random
+from time import time
+import argparse
+
+
+def get_cmd_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10,25,50,100,200",
+                        help="Comma-separated numbers of MIS")
+    parser.add_argument("--max-trace-lengths", default="2,3,4,5",
+                        help="Comma-separated maximum trace lengths")
+    parser.add_argument("--degree", type=int, default=4,
+                        help="Number of nearest neighbours connected to each MIS")
+    parser.add_argument("--transit-ratio", type=float, default=0.7,
+                        help="Ratio of MIS supporting n-m itineraries requests")
+    parser.add_argument("--requests", type=int, default=20,
+                        help="Number of departure/arrival pairs per graph")
+    parser.add_argument("--legacy-timeout", type=float, default=10,
+                        help="Skip legacy implementation once a run took longer "
+                             "than this (in seconds)")
+    parser.add_argument("--seed", type=int, default=0)
+
+    return parser.parse_args()
+
+
+def new_graph(rand, nb_mises, degree, transit_ratio):
+    positions = dict((x, (rand.random(), rand.random())) for x in range(1, nb_mises + 1))
+    connections = dict((x, set()) for x in positions)
+    for mis_id, (x, y) in positions.iteritems():
+        neighbours = sorted([m for m in positions if m != mis_id],
+                            key=lambda m: (positions[m][0] - x) ** 2 + (positions[m][1] - y) ** 2)
+        for m in neighbours[:degree]:
+            connections[mis_id].add(m)
+            connections[m].add(mis_id)
+    transit_mises = set([x for x in positions if rand.random() < transit_ratio])
+
+    return positions, connections, transit_mises
+
+
+"""
+    Former PlanTripCalculator._get_mis_traces() followed by
+    PlanTripCalculator._filter_traces(), working on an adjacency list instead
+    of the database. lookups[0] is incremented for every connection lookup,
+    each of them used to cost 2 SQL queries.
+"""
+def legacy_mis_traces(connections, departure_mises, arrival_mises, max_trace_length,
+                      lookups):
+    ret = []
+    if max_trace_length < 1:
+        return ret
+
+    for mis in (departure_mises & arrival_mises):
+        ret.append([mis])
+    if max_trace_length == 1:
+        return ret
+
+    for mis_id in departure_mises:
+        lookups[0] += 1
+        for subtrace in legacy_mis_traces(connections, set(connections[mis_id]),
+                                          arrival_mises, max_trace_length - 1,
+                                          lookups):
+            if not mis_id in subtrace:
+                subtrace.insert(0, mis_id)
+                ret.append(subtrace)
+
+    return ret
+
+def legacy_filter_traces(traces, transit_mises):
+    return [t for t in traces if all([x in transit_mises for x in t[1:-1]])]
+
+
+# Departure and arrival are usually covered by 1 to 3 MIS.
+def new_request(rand, positions):
+    mis_ids = sorted(positions.keys())
+    departure_mises = set(rand.sample(mis_ids, rand.randint(1, min(3, len(mis_ids)))))
+    arrival_mises = set(rand.sample(mis_ids, rand.randint(1, min(3, len(mis_ids)))))
+    return departure_mises, arrival_mises
+
+
+def run(args):
+    rand = Random(args.seed)
+    sizes = [int(x) for x in args.sizes.split(",")]
+    max_trace_lengths = [int(x) for x in args.max_trace_lengths.split(",")]
+
+    print "%6s %6s %10s %14s %16s %8s %16s" % ("MIS", "LENGTH", "TRACES",
+                                                 "BFS (ms/req)", "LEGACY (ms/req)",
+                                                 "SPEEDUP", "LEGACY SQL/req")
+    for nb_mises in sizes:
+        positions, connections, transit_mises = new_graph(rand, nb_mises, args.degree,
+                                                          args.transit_ratio)
+        requests = [new_request(rand, positions) for _ in range(args.requests)]
+        legacy_enabled = True
+        for max_trace_length in max_trace_lengths:
+            nb_traces = 0
+            start = time()
+            results = []
+            for departure_mises, arrival_mises in requests:
+                traces = find_mis_traces(connections, departure_mises, arrival_mises,
+                                         max_trace_length, transit_mises)
+                nb_traces += len(traces)
+                results.append(traces)
+            bfs_duration = (time() - start) * 1000 / len(requests)
+
+            legacy_duration = None
+            lookups = [0]
+            if legacy_enabled:
+                start = time()
+                for (departure_mises, arrival_mises), traces in zip(requests, results):
+                    legacy = legacy_filter_traces(
+                                legacy_mis_traces(connections, departure_mises,
+                                                  arrival_mises, max_trace_length,
+                                                  lookups),
+                                transit_mises)
+                    if sorted(legacy) != sorted(traces):
+                        raise Exception("Traces mismatch for %s -> %s" % \
+                                        (departure_mises, arrival_mises))
+                legacy_duration = (time() - start) * 1000 / len(requests)
+                if legacy_duration * len(requests) > args.legacy_timeout * 1000:
+                    legacy_enabled = False
+
+            print "%6s %6s %10s %14.3f %16s %8s %16s" % \
+                  (nb_mises, max_trace_length, nb_traces, bfs_duration,
+                   "%.3f" % legacy_duration if legacy_duration is not None else "-",
+                   "%.1fx" % (legacy_duration / bfs_duration) \
+                        if legacy_duration is not None and bfs_duration else "-",
+                   "%.1f" % (2.0 * lookups[0] / len(requests)) \
+                        if legacy_duration is not None else "-")
+
+
+if __name__ == '__main__':
+    run(get_cmd_args())
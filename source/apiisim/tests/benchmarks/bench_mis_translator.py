@@ -0,0 +1,165 @@
+# -*- coding: utf8 -*-
+
+"""
+    Benchmark mis_translator serving modes against a stub MIS.
+
+    For every serving mode, a mis_translator is launched with the stubs
+    configuration, and a given number of client threads send summed-up
+    itineraries requests (n-m, with random positions) to a stub MIS through
+    keep-alive connections. We report throughput and latency percentiles.
+
+    Modes are either "dev" (Flask development server, one process with a
+    thread per request) or WORKERSxTHREADS (gunicorn, WORKERS processes of
+    THREADS threads each, gunicorn must be installed).
+
+    A PostgreSQL server is needed, as stub MIS APIs store their stops in a
+    database.
+"""
+from apiisim import tests
+from apiisim.common import TransportModeEnum, AlgorithmEnum
+from apiisim.common.marshalling import DATE_FORMAT
+from apiisim.common.metrics import Histogram, monotonic
+from datetime import datetime, date, timedelta
+from random import Random
+import argparse, httplib2, json, os, Queue, threading, time
+
+
+STUBS_CONF = os.path.dirname(os.path.realpath(__file__)) + "/../../mis_translator/stubs.conf"
+
+
+def get_cmd_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", default="dev,1x8,4x8",
+                        help="Comma-separated serving modes: dev or WORKERSxTHREADS")
+    parser.add_argument("--mis", default="stub_pays_de_la_loire_light",
+                        help="Name of the stub MIS requested")
+    parser.add_argument("--nm-size", type=int, default=3,
+                        help="Number of departures and arrivals per request")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16,
+                        help="Number of client threads")
+    parser.add_argument("--port", type=int, default=5100)
+    parser.add_argument("--config", default=STUBS_CONF,
+                        help="mis_translator configuration file")
+    parser.add_argument("--seed", type=int, default=0)
+
+    return parser.parse_args()
+
+
+def new_location(rand):
+    return {"AccessTime" : "PT0S",
+            "Position" : {"Latitude" : 47 + rand.random(),
+                          "Longitude" : -2 + rand.random() * 2}}
+
+
+def new_request(rand, nm_size):
+    date_time = datetime.combine(date.today(), datetime.min.time()) \
+                + timedelta(hours=8, minutes=rand.randint(0, 600))
+    return {"id" : "bench",
+            "DepartureTime" : date_time.strftime(DATE_FORMAT),
+            "departures" : [new_location(rand) for _ in range(nm_size)],
+            "arrivals" : [new_location(rand) for _ in range(nm_size)],
+            "Algorithm" : AlgorithmEnum.CLASSIC,
+            "modes" : [TransportModeEnum.ALL]}
+
+
+def mode_args(mode, port):
+    args = ["--bind", "127.0.0.1:%s" % port]
+    if mode != "dev":
+        workers, _, threads = mode.partition("x")
+        args += ["--workers", workers, "--threads", threads or "1"]
+    return args
+
+
+# Wait until translator answers requests, return False on timeout.
+def wait_ready(url, timeout=60):
+    start = time.time()
+    http = httplib2.Http()
+    while time.time() - start < timeout:
+        try:
+            resp, _ = http.request(url + "/capabilities", "GET")
+            if resp.status == 200:
+                return True
+        except Exception:
+            pass
+        time.sleep(0.5)
+    return False
+
+
+class Results(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.succeeded = 0
+        self.failed = 0
+        self.latency = Histogram()
+
+
+def run_requests(url, requests, concurrency):
+    results = Results()
+    queue = Queue.Queue()
+    for x in requests:
+        queue.put(json.dumps(x))
+    headers = {'Content-type': 'application/json'}
+
+    def worker():
+        # One keep-alive connection per client thread.
+        http = httplib2.Http()
+        while True:
+            try:
+                body = queue.get_nowait()
+            except Queue.Empty:
+                return
+            start = monotonic()
+            try:
+                resp, _ = http.request(url + "/summed_up_itineraries", "POST",
+                                       headers=headers, body=body)
+                success = resp.status == 200
+            except Exception:
+                success = False
+            with results.lock:
+                if success:
+                    results.succeeded += 1
+                    results.latency.add(monotonic() - start)
+                else:
+                    results.failed += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, concurrency))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def _ms(value):
+    return "%.1f" % (value * 1000) if value is not None else "-"
+
+
+def run(args):
+    url = "http://127.0.0.1:%s/%s/v0" % (args.port, args.mis)
+
+    print "%8s %8s %8s %10s %10s %10s %10s" % ("MODE", "OK", "FAILED", "REQ/S",
+                                               "P50 (ms)", "P95 (ms)", "P99 (ms)")
+    for mode in args.modes.split(","):
+        rand = Random(args.seed)
+        requests = [new_request(rand, args.nm_size) for _ in range(args.requests)]
+        process = tests.launch_mis_translator(args.config, mode_args(mode, args.port))
+        try:
+            if not wait_ready(url):
+                raise Exception("mis_translator (%s) did not start" % mode)
+            # Warm up every process and connection.
+            run_requests(url, requests[:args.concurrency], args.concurrency)
+            start = monotonic()
+            results = run_requests(url, requests, args.concurrency)
+            duration = monotonic() - start
+        finally:
+            tests.terminate_mis_translator(process)
+        print "%8s %8s %8s %10.1f %10s %10s %10s" % \
+              (mode, results.succeeded, results.failed,
+               results.succeeded / duration if duration else 0,
+               _ms(results.latency.percentile(50)), _ms(results.latency.percentile(95)),
+               _ms(results.latency.percentile(99)))
+
+
+if __name__ == '__main__':
+    run(get_cmd_args())
@@ -0,0 +1,465 @@
+# -*- coding: utf8 -*-
+
+"""
+    Benchmark PlanTripCalculator against in-process stub MIS.
+
+    No Apache, mod_python or MIS translator is needed: a metabase is seeded
+    with synthetic MIS chains (A - B - C), whose API URLs point to a stub MIS
+    HTTP server running in this process. The stub answers summed-up and
+    detailed itineraries requests with "as the crow flies" trips, after a
+    configurable latency.
+
+    Each chain has a given number of transfers between consecutive MIS (the
+    n-m size of the requests sent to MIS). Requests going from A to A, B and
+    C give traces of length 1, 2 and 3. For each trace length and n-m size,
+    we report throughput, per-trace latency percentiles and the number of MIS
+    requests per composed trip.
+
+    A PostgreSQL server is needed, as for the planner unit tests.
+"""
+from apiisim import tests, metabase
+from apiisim.planner import Planner, MisApi, TraceStop
+from apiisim.planner.plan_trip_calculator import PlanTripCalculator
+from apiisim.planner.coalescing import RequestCoalescer
+from apiisim.planner.geo import haversine
+from apiisim.common import TransportModeEnum, AlgorithmEnum, PlanSearchOptions, \
+                           StatusCodeEnum, xsd_duration_to_timedelta, \
+                           timedelta_to_xsd_duration
+from apiisim.common.plan_trip import PlanTripRequestType, LocationStructure
+from apiisim.common.marshalling import DATE_FORMAT
+from apiisim.common.metrics import Histogram, monotonic
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from datetime import datetime, date, timedelta
+from random import Random
+import SocketServer
+import argparse, json, logging, math, Queue, threading, time
+
+
+DB_NAME = "bench_planner_db"
+# Distance between the centers of 2 consecutive MIS of a chain, in degrees
+MIS_SPACING = 0.1
+# Distance between 2 chains, in degrees
+CHAIN_SPACING = 0.5
+# Stub MIS trips speed, in meters per second
+STUB_SPEED = 10
+
+
+def get_cmd_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nm-sizes", default="1,5,20",
+                        help="Comma-separated numbers of transfers between 2 MIS")
+    parser.add_argument("--trace-lengths", default="1,2,3",
+                        help="Comma-separated trace lengths (1 to 3)")
+    parser.add_argument("--latency", default="exp:20",
+                        help="Stub MIS latency distribution, in milliseconds: "
+                             "const:MS, uniform:MIN,MAX, exp:MEAN or "
+                             "lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--requests", type=int, default=20,
+                        help="Number of PlanTrip requests per trace length and n-m size")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="Number of requests computed at the same time")
+    parser.add_argument("--arrival-at", action="store_true",
+                        help="Send arrival_at requests instead of departure_at ones")
+    parser.add_argument("--summed-up-cache", action="store_true",
+                        help="Keep the summed-up itineraries cache enabled")
+    parser.add_argument("--keep-db", action="store_true",
+                        help="Do not drop the database once finished")
+    parser.add_argument("--seed", type=int, default=0)
+
+    return parser.parse_args()
+
+
+"""
+    Return function returning a random latency (in seconds) given a Random
+    object, see --latency.
+"""
+def parse_latency(spec):
+    kind, _, values = spec.partition(":")
+    values = [float(x) for x in values.split(",") if x]
+    if kind == "const":
+        return lambda rand: values[0] / 1000
+    if kind == "uniform":
+        return lambda rand: rand.uniform(values[0], values[1]) / 1000
+    if kind == "exp":
+        return lambda rand: rand.expovariate(1000 / values[0]) if values[0] else 0
+    if kind == "lognormal":
+        return lambda rand: rand.lognormvariate(math.log(values[0]), values[1]) / 1000
+    raise ValueError("Invalid latency distribution: %s" % spec)
+
+
+################################################################################
+# Stub MIS
+
+def _position(location):
+    return (location["Position"]["Longitude"], location["Position"]["Latitude"])
+
+def _location_id(location):
+    return location.get("PlaceTypeId", None) or "%s;%s" % _position(location)
+
+def _access_time(location):
+    access_time = location.get("AccessTime", None)
+    return xsd_duration_to_timedelta(access_time) if access_time else timedelta()
+
+def _duration(departure, arrival):
+    return timedelta(seconds=int(haversine(*(_position(departure) + _position(arrival))) \
+                                 / STUB_SPEED) + 60)
+
+def _end_point(location, date_time):
+    return {"TripStopPlace" : {"id" : _location_id(location),
+                               "Position" : location["Position"],
+                               "TypeOfPlaceRef" : "LOCATION"},
+            "DateTime" : date_time.strftime(DATE_FORMAT)}
+
+
+"""
+    Best trip from one of departures to one of arrivals, returned as
+    (departure, arrival, departure time, arrival time).
+    Departure at requests: a trip from d leaves at departure_time plus d access
+    time, the trip with the earliest arrival is the best one.
+    Arrival at requests: a trip to a arrives at arrival_time plus a access
+    time, the trip with the latest departure is the best one.
+"""
+def best_trip(departures, arrivals, departure_time, arrival_time):
+    trips = []
+    for d in departures:
+        for a in arrivals:
+            duration = _duration(d, a)
+            if departure_time:
+                start = departure_time + _access_time(d)
+                trips.append((start + duration, d, a, start, start + duration))
+            else:
+                end = arrival_time + _access_time(a)
+                trips.append((-(end - duration - datetime.min).total_seconds(),
+                              d, a, end - duration, end))
+    return min(trips, key=lambda x: x[0])[1:]
+
+
+def summed_up_itineraries(request):
+    departure_time = request.get("DepartureTime", None)
+    arrival_time = request.get("ArrivalTime", None)
+    departure_time = departure_time and datetime.strptime(departure_time, DATE_FORMAT)
+    arrival_time = arrival_time and datetime.strptime(arrival_time, DATE_FORMAT)
+    departures = request["departures"]
+    arrivals = request["arrivals"]
+    if PlanSearchOptions.DEPARTURE_ARRIVAL_OPTIMIZED in (request.get("options", None) or []):
+        pairs = [([d], [a]) for d in departures for a in arrivals]
+    elif departure_time:
+        pairs = [(departures, [a]) for a in arrivals]
+    else:
+        pairs = [([d], arrivals) for d in departures]
+
+    trips = []
+    for d, a in pairs:
+        d, a, start, end = best_trip(d, a, departure_time, arrival_time)
+        trips.append({"Departure" : _end_point(d, start),
+                      "Arrival" : _end_point(a, end),
+                      "InterchangeCount" : 0,
+                      "InterchangeDuration" : 0})
+    return {"SummedUpItinerariesResponseType" :
+                {"RequestId" : request.get("id", None) or "",
+                 "Status" : {"Code" : StatusCodeEnum.OK},
+                 "summedUpTrips" : trips}}
+
+
+def itineraries(request):
+    departure_time = request.get("DepartureTime", None)
+    arrival_time = request.get("ArrivalTime", None)
+    departure_time = departure_time and datetime.strptime(departure_time, DATE_FORMAT)
+    arrival_time = arrival_time and datetime.strptime(arrival_time, DATE_FORMAT)
+    if "multiDepartures" in request:
+        departures = request["multiDepartures"]["Departure"]
+        arrivals = [request["multiDepartures"]["Arrival"]]
+    else:
+        departures = [request["multiArrivals"]["Departure"]]
+        arrivals = request["multiArrivals"]["Arrival"]
+
+    d, a, start, end = best_trip(departures, arrivals, departure_time, arrival_time)
+    duration = timedelta_to_xsd_duration(end - start)
+    distance = int(haversine(*(_position(d) + _position(a))))
+    departure = _end_point(d, start)
+    arrival = _end_point(a, end)
+    section = {"PTRide" : {"PublicTransportMode" : "BUS",
+                           "Line" : {"id" : "line", "Name" : "Line"},
+                           "PTNetwork" : {"id" : "network", "Name" : "Network"},
+                           "Departure" : departure,
+                           "Arrival" : arrival,
+                           "Duration" : duration,
+                           "Distance" : distance,
+                           "steps" : [{"id" : "step",
+                                       "Departure" : departure,
+                                       "Arrival" : arrival,
+                                       "Duration" : duration}]}}
+    return {"ItineraryResponseType" :
+                {"RequestId" : request.get("id", None) or "",
+                 "Status" : {"Code" : StatusCodeEnum.OK},
+                 "DetailedTrip" : {"Departure" : departure,
+                                   "Arrival" : arrival,
+                                   "Duration" : duration,
+                                   "Distance" : distance,
+                                   "InterchangeNumber" : 0,
+                                   "sections" : [section]}}}
+
+
+class StubMisHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    RESOURCES = {"summed_up_itineraries" : summed_up_itineraries,
+                 "itineraries" : itineraries}
+
+    def do_POST(self):
+        resource = self.path.rstrip("/").split("/")[-1]
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.add_request(resource)
+        time.sleep(self.server.latency(self.server.rand))
+        body = json.dumps(self.RESOURCES[resource](request))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubMisServer(SocketServer.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, latency, seed):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), StubMisHandler)
+        self.latency = latency
+        self.rand = Random(seed)
+        self._lock = threading.Lock()
+        self._requests = {} # {resource : number of requests received}
+
+    def add_request(self, resource):
+        with self._lock:
+            self._requests[resource] = self._requests.get(resource, 0) + 1
+
+    # Return and reset {resource : number of requests received}
+    def pop_requests(self):
+        with self._lock:
+            ret = self._requests
+            self._requests = {}
+        return ret
+
+    def get_url(self):
+        return "http://%s:%s" % self.server_address
+
+
+################################################################################
+# Metabase
+
+def chain_position(chain, mis_index):
+    return (mis_index * MIS_SPACING, 45 + chain * CHAIN_SPACING)
+
+
+"""
+    Add a chain of 3 MIS supporting n-m requests (named <prefix>_A, _B and
+    _C), each having a stop at its center, and nm_size transfers between
+    consecutive MIS. Transfers are spread along the border between both MIS,
+    in the middle of them.
+"""
+def add_chain(db_session, chain, nm_size, api_url):
+    today = date.today()
+    prefix = "nm%s" % nm_size
+    mises = []
+    for i, letter in enumerate("ABC"):
+        name = "%s_%s" % (prefix, letter)
+        mis = metabase.Mis(name=name, api_url="%s/%s" % (api_url, name), api_key="",
+                           start_date=today - timedelta(days=365),
+                           end_date=today + timedelta(days=365),
+                           geographic_position_compliant=True,
+                           multiple_starts_and_arrivals=1)
+        db_session.add(mis)
+        db_session.flush()
+        lon, lat = chain_position(chain, i)
+        db_session.add(metabase.Stop(code="%s_center" % name, mis_id=mis.id, name="",
+                                     lat=lat, long=lon))
+        mises.append(mis)
+    db_session.flush()
+
+    for i, (mis1, mis2) in enumerate(zip(mises, mises[1:])):
+        db_session.add(metabase.MisConnection(mis1_id=mis1.id, mis2_id=mis2.id))
+        lon = chain_position(chain, i)[0] + MIS_SPACING / 2
+        for j in range(nm_size):
+            lat = chain_position(chain, i)[1] - 0.05 + 0.1 * j / max(1, nm_size - 1)
+            stop1 = metabase.Stop(code="%s_%s" % (mis1.name, j), mis_id=mis1.id,
+                                  name="", lat=lat, long=lon - 0.0005)
+            stop2 = metabase.Stop(code="%s_%s" % (mis2.name, j), mis_id=mis2.id,
+                                  name="", lat=lat, long=lon + 0.0005)
+            db_session.add(stop1)
+            db_session.add(stop2)
+            db_session.flush()
+            db_session.add(metabase.Transfer(stop1_id=stop1.id, stop2_id=stop2.id,
+                                             distance=80, duration=60 + j % 5 * 30,
+                                             active=True, modification_state="auto"))
+    db_session.flush()
+
+
+def seed_db(nm_sizes, api_url):
+    try:
+        tests.drop_db(DB_NAME)
+    except:
+        pass
+    tests.create_db(DB_NAME)
+    db_session = tests.connect_db(DB_NAME)
+    try:
+        for chain, nm_size in enumerate(nm_sizes):
+            add_chain(db_session, chain, nm_size, api_url)
+        db_session.execute("REFRESH MATERIALIZED VIEW transfer_mis")
+        db_session.commit()
+    finally:
+        tests.disconnect_db(db_session)
+
+
+################################################################################
+# Benchmark
+
+def new_request(rand, chain, trace_length, arrival_at):
+    request = PlanTripRequestType()
+    request.clientRequestId = "bench"
+    request.MaxTrips = 0
+    request.Algorithm = AlgorithmEnum.CLASSIC
+    request.modes = [TransportModeEnum.ALL]
+    request.selfDriveConditions = []
+    request.AccessibilityConstraint = False
+    request.Language = ""
+    # Departure and arrival are close to the center stops.
+    lon, lat = chain_position(chain, 0)
+    request.Departure = TraceStop(Position=LocationStructure(Longitude=lon + 0.001,
+                                                             Latitude=lat),
+                                  AccessTime=timedelta())
+    lon, lat = chain_position(chain, trace_length - 1)
+    request.Arrival = TraceStop(Position=LocationStructure(Longitude=lon - 0.001,
+                                                           Latitude=lat + 0.001),
+                                AccessTime=timedelta())
+    date_time = datetime.combine(date.today(), datetime.min.time()) \
+                + timedelta(hours=8, minutes=rand.randint(0, 600))
+    if arrival_at:
+        request.ArrivalTime = date_time
+    else:
+        request.DepartureTime = date_time
+    return request
+
+
+class Results(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.traces = 0
+        self.trips = 0
+        self.failed = 0
+        self.mis_calls = 0 # MIS calls asked for by the calculator
+        self.trace_latency = Histogram()
+        self.compute_traces_latency = Histogram()
+
+
+def run_request(planner, request, results):
+    start = monotonic()
+    calculator = PlanTripCalculator(planner, request, Queue.Queue())
+    traces = calculator.compute_traces()
+    compute_traces_duration = monotonic() - start
+    coalescer = RequestCoalescer()
+    latencies = []
+    failed = 0
+    for trace in traces:
+        start = monotonic()
+        try:
+            calculator.compute_trip(trace, coalescer=coalescer)
+            latencies.append(monotonic() - start)
+        except Exception as e:
+            logging.debug("compute_trip(%s): %s", trace, e)
+            failed += 1
+    with results.lock:
+        results.compute_traces_latency.add(compute_traces_duration)
+        results.traces += len(traces)
+        results.trips += len(latencies)
+        results.failed += failed
+        results.mis_calls += coalescer.get_stats()["calls"]
+        for x in latencies:
+            results.trace_latency.add(x)
+
+
+def run_requests(planner, requests, concurrency):
+    results = Results()
+    queue = Queue.Queue()
+    for x in requests:
+        queue.put(x)
+
+    def worker():
+        while True:
+            try:
+                request = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                run_request(planner, request, results)
+            except Exception as e:
+                logging.error("Request failed: %s", e, exc_info=True)
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, concurrency))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def _ms(value):
+    return "%.1f" % (value * 1000) if value is not None else "-"
+
+
+def run(args):
+    rand = Random(args.seed)
+    nm_sizes = [int(x) for x in args.nm_sizes.split(",")]
+    trace_lengths = [int(x) for x in args.trace_lengths.split(",")]
+    if not all([1 <= x <= PlanTripCalculator.MAX_TRACE_LENGTH for x in trace_lengths]):
+        raise ValueError("Trace lengths must be between 1 and %s" %
+                         PlanTripCalculator.MAX_TRACE_LENGTH)
+    if not args.summed_up_cache:
+        MisApi.configure_summed_up_cache(0, 0, MisApi.SUMMED_UP_CACHE_TIME_BUCKET)
+
+    server = StubMisServer(parse_latency(args.latency), args.seed)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    seed_db(nm_sizes, server.get_url())
+    planner = Planner("postgresql+psycopg2://%s:%s@localhost/%s" % \
+                      (tests.ADMIN_NAME, tests.ADMIN_PASS, DB_NAME))
+    try:
+        print "%6s %4s %6s %6s %6s %9s %9s %9s %9s %11s %10s" % \
+              ("LENGTH", "N-M", "TRACES", "TRIPS", "FAILED", "TRIPS/S", "P50 (ms)",
+               "P95 (ms)", "P99 (ms)", "TRACES (ms)", "MIS/TRIP")
+        for chain, nm_size in enumerate(nm_sizes):
+            for trace_length in trace_lengths:
+                requests = [new_request(rand, chain, trace_length, args.arrival_at)
+                            for _ in range(args.requests)]
+                server.pop_requests()
+                start = monotonic()
+                results = run_requests(planner, requests, args.concurrency)
+                duration = monotonic() - start
+                sent = sum(server.pop_requests().values())
+                latency = results.trace_latency
+                print "%6s %4s %6s %6s %6s %9.1f %9s %9s %9s %11s %10s" % \
+                      (trace_length, nm_size, results.traces, results.trips,
+                       results.failed, results.trips / duration,
+                       _ms(latency.percentile(50)), _ms(latency.percentile(95)),
+                       _ms(latency.percentile(99)),
+                       _ms(results.compute_traces_latency.percentile(50)),
+                       "%.2f (%.2f)" % (float(sent) / results.trips,
+                                        float(results.mis_calls) / results.trips) \
+                            if results.trips else "-")
+        print "MIS/TRIP: MIS requests received by stub MIS per composed trip " \
+              "(MIS calls made by the calculator, before coalescing)"
+    finally:
+        server.shutdown()
+        del planner
+        if not args.keep_db:
+            tests.drop_db(DB_NAME)
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.WARNING)
+    run(get_cmd_args())
@@ -0,0 +1,187 @@
+# -*- coding: utf8 -*-
+
+"""
+    Benchmark decoding of detailed trips returned by MIS translators.
+
+    Trips with a given number of sections and steps (see bench_marshalling)
+    are decoded into slotted objects by apiisim.planner.trip_decoder, and
+    into generateDS objects by the former parse_detailed_trip(), which parsed
+    dates with datetime.strptime() and durations with a regex compiled on
+    every call. Both results are checked to marshal identically.
+"""
+from apiisim.common import TypeOfPlaceEnum
+from apiisim.common.marshalling import marshal, trip_type, DATE_FORMAT
+from apiisim.common.mis_plan_trip import LineType, PTNetworkType
+from apiisim.common.plan_trip import StepEndPointType, EndPointType, TripStopPlaceType, \
+                                     LocationStructure, TripType, StepType, PTRideType, \
+                                     LegType, SectionType
+from apiisim.planner.trip_decoder import decode_detailed_trip
+from bench_marshalling import TripBuilder
+from datetime import datetime, timedelta
+from random import Random
+from time import time
+import argparse, json, re
+
+
+def get_cmd_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sections", default="1,5,20",
+                        help="Comma-separated numbers of sections per trip")
+    parser.add_argument("--steps", default="10,100,500",
+                        help="Comma-separated numbers of steps per PTRide")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+
+    return parser.parse_args()
+
+
+################################################################################
+# Former apiisim.planner parsing functions
+
+def legacy_xsd_duration_to_timedelta(duration):
+    regex  = re.compile('P(?:(?P<years>\d+)Y)?(?:(?P<months>\d+)M)?'
+                        '(?:(?P<days>\d+)D)?(?:T(?:(?P<hours>\d+)H)?(?:(?P<minutes>\d+)M)?'
+                        '(?:(?P<seconds>\d+)S)?)?')
+    duration = regex.match(duration).groupdict(0)
+    delta = timedelta(days=int(duration['days']) + (int(duration['months']) * 30) \
+                           + (int(duration['years']) * 365),
+                      hours=int(duration['hours']),
+                      minutes=int(duration['minutes']),
+                      seconds=int(duration['seconds']))
+
+    return delta
+
+
+def legacy_parse_end_point(point, step_end_point=False):
+    if step_end_point:
+        ret = StepEndPointType()
+        ret.PassThrough = point.get("PassThrough", False)
+    else:
+        ret = EndPointType()
+
+    place = TripStopPlaceType()
+    p = point["TripStopPlace"]
+    place.id = p["id"]
+    place.Name = p.get("Name", None)
+    place.CityCode = p.get("CityCode", None)
+    place.CityName = p.get("CityName", None)
+    place.TypeOfPlaceRef = p.get("TypeOfPlaceRef", TypeOfPlaceEnum.LOCATION)
+    if "Position" in p:
+        place.Position = LocationStructure(
+                            Latitude=p["Position"]["Latitude"],
+                            Longitude=p["Position"]["Longitude"])
+
+    ret.TripStopPlace = place
+    ret.DateTime = datetime.strptime(point["DateTime"], DATE_FORMAT)
+    return ret
+
+
+def legacy_parse_detailed_trip(trip):
+    if not trip:
+        return None
+
+    ret = TripType()
+
+    ret.Departure = legacy_parse_end_point(trip["Departure"])
+    ret.Arrival = legacy_parse_end_point(trip["Arrival"])
+    ret.Duration = legacy_xsd_duration_to_timedelta(trip["Duration"])
+    ret.Distance = trip.get("Distance", 0)
+    ret.Disrupted = trip.get("Disrupted", False)
+    ret.InterchangeNumber = trip.get("InterchangeNumber", 0)
+    ret.sections = legacy_parse_sections(trip["sections"])
+
+    return ret
+
+
+def legacy_parse_steps(steps):
+    ret = [] # [StepType]
+    for step in steps:
+        ret.append(
+                StepType(
+                    id=step["id"],
+                    Departure=legacy_parse_end_point(step["Departure"], step_end_point=True),
+                    Arrival=legacy_parse_end_point(step["Arrival"], step_end_point=True),
+                    Duration=legacy_xsd_duration_to_timedelta(step["Duration"])))
+    return ret
+
+
+def legacy_parse_sections(sections):
+    ret = []
+    for section in sections:
+        ptr = None
+        leg = None
+        if "PTRide" in section:
+            p = section["PTRide"]
+            ptr = PTRideType()
+
+            if "Line" in p:
+                line = LineType()
+                line.id = p["Line"]["id"]
+                line.Name = p["Line"]["Name"]
+                line.Number = p["Line"].get("Number", None)
+                line.PublishedName = p["Line"].get("PublishedName", None)
+                line.RegistrationNumber = p["Line"].get("RegistrationNumber", None)
+                ptr.Line = line
+
+            if "PTNetwork" in p:
+                network = PTNetworkType()
+                network.id = p["PTNetwork"]["id"]
+                network.Name = p["PTNetwork"]["Name"]
+                network.RegistrationNumber = p["PTNetwork"].get("RegistrationNumber", None)
+                ptr.PTNetwork = network
+
+            ptr.PublicTransportMode = p["PublicTransportMode"]
+            ptr.Departure = legacy_parse_end_point(p["Departure"])
+            ptr.Arrival = legacy_parse_end_point(p["Arrival"])
+            ptr.Duration = legacy_xsd_duration_to_timedelta(p["Duration"])
+            ptr.Distance = p.get("Distance", None)
+            ptr.StopHeadSign = p.get("StopHeadSign", None)
+            ptr.steps = legacy_parse_steps(p["steps"])
+        elif "Leg" in section:
+            l = section["Leg"]
+            leg = LegType()
+            leg.SelfDriveMode = l["SelfDriveMode"]
+            leg.Departure = legacy_parse_end_point(l["Departure"])
+            leg.Arrival = legacy_parse_end_point(l["Arrival"])
+            leg.Duration = legacy_xsd_duration_to_timedelta(l["Duration"])
+
+        ret.append(SectionType(
+                        PartialTripId=section.get("PartialTripId", None),
+                        PTRide=ptr, Leg=leg))
+
+    return ret
+
+################################################################################
+
+
+def _time_per_call(func, iterations):
+    start = time()
+    for _ in range(iterations):
+        func()
+    return (time() - start) * 1000 / iterations
+
+
+def run(args):
+    rand = Random(args.seed)
+    sizes = [(int(x), int(y)) for x in args.sections.split(",")
+                               for y in args.steps.split(",")]
+
+    print "%9s %6s %12s %14s %14s %8s" % ("SECTIONS", "STEPS", "TOTAL STEPS",
+                                           "DECODER (ms)", "LEGACY (ms)", "SPEEDUP")
+    for nb_sections, nb_steps in sizes:
+        # Decoded from JSON, as MIS responses are.
+        trip = json.loads(json.dumps(TripBuilder(rand).trip(nb_sections, nb_steps)))
+        if json.dumps(marshal(decode_detailed_trip(trip), trip_type)) != \
+           json.dumps(marshal(legacy_parse_detailed_trip(trip), trip_type)):
+            raise Exception("Trip mismatch for %s sections, %s steps" % \
+                            (nb_sections, nb_steps))
+
+        decoder = _time_per_call(lambda: decode_detailed_trip(trip), args.iterations)
+        legacy = _time_per_call(lambda: legacy_parse_detailed_trip(trip), args.iterations)
+        print "%9s %6s %12s %14.3f %14.3f %8s" % \
+              (nb_sections, nb_steps, ((nb_sections + 1) / 2) * nb_steps, decoder,
+               legacy, "%.1fx" % (legacy / decoder) if decoder else "-")
+
+
+if __name__ == '__main__':
+    run(get_cmd_args())
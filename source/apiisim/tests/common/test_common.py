@@ -0,0 +1,239 @@
+import unittest, time, json, threading
+from datetime import datetime, timedelta
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from flask_restful import marshal as flask_marshal
+from apiisim.common.cache import LruCache
+from apiisim.common.metrics import Metrics, Histogram, RequestTimings, timed, monotonic, \
+                                   metrics
+from apiisim.common.marshalling import marshal, compile_fields, plan_trip_request_type, \
+                                       summed_up_trip_type, NonNullNested, _Float
+from apiisim.common.plan_trip import PlanTripRequestType, EndPointType, LocationPointType, \
+                                     LocationStructure
+from apiisim.common.mis_plan_summed_up_trip import SummedUpTripType, TripStopPlaceType
+from apiisim.common.http_pool import HttpConnectionPool
+from apiisim.common.cancellation import CancelToken, CancelledError
+
+
+class TestLruCache(unittest.TestCase):
+    def testEviction(self):
+        cache = LruCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEquals(cache.get("a"), 1)
+        cache.put("c", 3) # "b" is the least recently used entry
+        self.assertEquals(cache.get("b"), None)
+        self.assertEquals(cache.get("a"), 1)
+        self.assertEquals(cache.get("c"), 3)
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.get_stats(), (3, 1))
+        cache.clear()
+        self.assertEquals(cache.get("a", 0), 0)
+
+    def testExpiration(self):
+        cache = LruCache(2, ttl=0.05)
+        cache.put("a", 1)
+        self.assertEquals(cache.get("a"), 1)
+        time.sleep(0.06)
+        self.assertEquals(cache.get("a"), None)
+        self.assertEquals(len(cache), 0)
+        self.assertEquals(cache.get_stats(), (1, 1))
+
+    def testPurge(self):
+        cache = LruCache(10)
+        for key in [("mis1", 1), ("mis1", 2), ("mis2", 1)]:
+            cache.put(key, 0)
+        self.assertEquals(cache.purge(lambda x: x[0] == "mis1"), 2)
+        self.assertEquals(cache.get(("mis1", 1)), None)
+        self.assertEquals(cache.get(("mis2", 1)), 0)
+
+
+class TestMetrics(unittest.TestCase):
+    def testMonotonic(self):
+        previous = monotonic()
+        for _ in range(1000):
+            now = monotonic()
+            self.assertTrue(now >= previous)
+            previous = now
+
+    def testHistogram(self):
+        histogram = Histogram()
+        self.assertEquals(histogram.percentile(50), None)
+        for i in range(1, 101):
+            histogram.add(i / 1000.0)
+        self.assertEquals(histogram.count, 100)
+        self.assertAlmostEquals(histogram.total, 5.05)
+        self.assertEquals((histogram.min, histogram.max), (0.001, 0.1))
+        for percent, expected in [(50, 0.05), (95, 0.095), (99, 0.099)]:
+            value = histogram.percentile(percent)
+            self.assertTrue(abs(value - expected) / expected < 0.05, (percent, value))
+        self.assertEquals(histogram.percentile(100), 0.1)
+
+    def testMetrics(self):
+        m = Metrics()
+        m.record("a", 0.002)
+        m.record("a", 0.004)
+        m.record("b", 1)
+        snapshot = m.snapshot()
+        self.assertEquals(sorted(snapshot.keys()), ["a", "b"])
+        self.assertEquals(snapshot["a"]["count"], 2)
+        self.assertAlmostEquals(snapshot["a"]["mean"], 0.003)
+        self.assertEquals(snapshot["b"]["p99"], 1)
+        self.assertTrue(m.format().startswith("b: count=1"))
+        m.reset()
+        self.assertEquals(m.snapshot(), {})
+
+    def testTimed(self):
+        class Calculator(object):
+            def __init__(self, request_timings):
+                self.request_timings = request_timings
+
+            @timed
+            def _test_metrics_compute(self, x):
+                return x * 2
+
+        timings = RequestTimings()
+        count = metrics.snapshot().get("_test_metrics_compute", {}).get("count", 0)
+        self.assertEquals(Calculator(timings)._test_metrics_compute(2), 4)
+        self.assertEquals(Calculator(None)._test_metrics_compute(3), 6)
+        self.assertEquals(metrics.snapshot()["_test_metrics_compute"]["count"], count + 2)
+        self.assertEquals(timings.get()["_test_metrics_compute"][0], 1)
+        self.assertTrue(timings.format().startswith("_test_metrics_compute=1/"))
+
+
+class TestMarshalling(unittest.TestCase):
+    def _check(self, obj, spec):
+        expected = flask_marshal(obj, spec)
+        self.assertEquals(json.dumps(compile_fields(spec)(obj)), json.dumps(expected))
+        for item in expected if isinstance(expected, list) else [expected]:
+            for k, v in item.items():
+                if v is None:
+                    del item[k]
+        self.assertEquals(json.dumps(marshal(obj, spec)), json.dumps(expected))
+
+    def _location(self, longitude, latitude):
+        return LocationPointType(AccessTime=timedelta(seconds=100),
+                                 Position=LocationStructure(Longitude=longitude,
+                                                            Latitude=latitude))
+
+    def testPlanTripRequest(self):
+        request = PlanTripRequestType()
+        request.clientRequestId = u"req\xe9"
+        request.Departure = self._location(2.3, 48.8)
+        request.Arrival = self._location(2.4, 48.9)
+        request.Arrival.Position = None
+        request.DepartureTime = datetime(2014, 6, 1, 8, 30)
+        request.modes = ["BUS", "TRAM"]
+        self._check(request, plan_trip_request_type)
+        self._check([request, PlanTripRequestType()], plan_trip_request_type)
+
+    def testSummedUpTrip(self):
+        departure = EndPointType()
+        departure.TripStopPlace = TripStopPlaceType(id="stop1", Name="Stop 1")
+        departure.DateTime = datetime(2014, 6, 1, 8, 30)
+        trip = SummedUpTripType(Departure=departure, Arrival=None,
+                                InterchangeCount=2)
+        self._check(trip, summed_up_trip_type)
+        # Dicts are marshalled as well.
+        self._check({"InterchangeCount" : 1, "Arrival" : None}, summed_up_trip_type)
+
+    def testCompiledOnce(self):
+        spec = {"a" : NonNullNested({"b" : _Float})}
+        self.assertTrue(compile_fields(spec) is compile_fields(spec))
+        self._check({"a" : {"b" : "1.5"}}, spec)
+
+
+class TestHttpConnectionPool(unittest.TestCase):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            if self.path == "/slow":
+                time.sleep(2)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            if self.path == "/close":
+                self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    def setUp(self):
+        self._server = HTTPServer(("localhost", 0), self.Handler)
+        self._server_thread = threading.Thread(target=self._server.serve_forever)
+        self._server_thread.daemon = True
+        self._server_thread.start()
+        self._url = "http://localhost:%s" % self._server.server_port
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def testReuse(self):
+        pool = HttpConnectionPool()
+        for i in range(3):
+            resp, content = pool.request(self._url + "/echo", "POST", body="data%s" % i)
+            self.assertEquals(resp.status, 200)
+            self.assertEquals(content, "data%s" % i)
+        stats = pool.get_stats()
+        self.assertEquals((stats["opened"], stats["reused"], stats["idle"]), (1, 2, 1))
+
+        # Server closes connection, it must not be given back to the pool.
+        pool.request(self._url + "/close", "POST", body="data")
+        pool.request(self._url + "/echo", "POST", body="data")
+        stats = pool.get_stats()
+        self.assertEquals((stats["opened"], stats["reused"], stats["idle"]), (2, 3, 1))
+        pool.clear()
+
+    def testCancel(self):
+        pool = HttpConnectionPool()
+        token = CancelToken()
+        timer = threading.Timer(0.1, token.cancel)
+        timer.start()
+        start = time.time()
+        self.assertRaises(CancelledError, pool.request, self._url + "/slow", "POST",
+                          body="data", cancel_token=token)
+        # Request must be aborted without waiting for the response.
+        self.assertTrue(time.time() - start < 1)
+        self.assertEquals(pool.get_stats()["idle"], 0)
+        # Token is already cancelled, nothing is sent.
+        self.assertRaises(CancelledError, pool.request, self._url + "/echo", "POST",
+                          body="data", cancel_token=token)
+        self.assertEquals(pool.get_stats()["opened"], 1)
+        timer.join()
+
+    def testCancelWaiting(self):
+        pool = HttpConnectionPool(max_per_host=1)
+        slow = threading.Thread(target=pool.request, args=(self._url + "/slow", "POST"),
+                                kwargs={"body" : "data"})
+        slow.start()
+        time.sleep(0.1)
+        token = CancelToken()
+        timer = threading.Timer(0.1, token.cancel)
+        timer.start()
+        start = time.time()
+        # The only connection is in use, cancellation must not wait for it.
+        self.assertRaises(CancelledError, pool.request, self._url + "/echo", "POST",
+                          body="data", cancel_token=token)
+        self.assertTrue(time.time() - start < 1)
+        timer.join()
+        slow.join()
+        resp, content = pool.request(self._url + "/echo", "POST", body="data")
+        self.assertEquals(content, "data")
+        self.assertEquals(pool.get_stats()["opened"], 1)
+        pool.clear()
+
+    def testIdleEviction(self):
+        pool = HttpConnectionPool(idle_timeout=0)
+        pool.request(self._url + "/echo", "POST", body="data")
+        time.sleep(0.01)
+        pool.request(self._url + "/echo", "POST", body="data")
+        stats = pool.get_stats()
+        self.assertEquals((stats["opened"], stats["reused"], stats["evicted"]), (2, 0, 1))
+        pool.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,434 @@
+import unittest, json, urlparse, threading, time
+from datetime import datetime, timedelta
+from apiisim.mis_translator import resources
+from apiisim.mis_translator.mis_api import navitia
+from apiisim.common.mis_plan_trip import LocationContextType, LocationStructure
+from apiisim.common.fan_out import FanOutExecutor
+
+
+def _shift(date_time, minutes):
+    return (datetime.strptime(date_time, navitia.DATE_FORMAT)
+            + timedelta(minutes=minutes)).strftime(navitia.DATE_FORMAT)
+
+
+# Default journey: leaves 10 minutes after the requested departure time
+# (arrives 10 minutes before the arrival time) and lasts 30 minutes.
+def _default_journeys(params):
+    if params.get("datetime_represents", "departure") == "arrival":
+        arrival = _shift(params["datetime"], -10)
+        departure = _shift(arrival, -30)
+    else:
+        departure = _shift(params["datetime"], 10)
+        arrival = _shift(departure, 30)
+    return [{"departure_date_time" : departure, "arrival_date_time" : arrival}]
+
+
+class _FakeNavitiaApi(navitia.MisApi):
+    # journeys(params) returns journeys of the request with given parameters.
+    def __init__(self, api_key="", journeys=_default_journeys):
+        super(_FakeNavitiaApi, self).__init__(None, api_key)
+        self.urls = []
+        self.params = []
+        self.journeys = journeys
+
+    def _send_request(self, url):
+        self.urls.append(url)
+        params = dict([(k, v[0]) for k, v in
+                       urlparse.parse_qs(urlparse.urlparse(url).query).items()])
+        self.params.append(params)
+        journeys = self.journeys(params)
+        for x in journeys:
+            x.setdefault("id", len(self.urls))
+        return None, json.dumps({"journeys" : journeys})
+
+
+class TestNavitiaJourneysCache(unittest.TestCase):
+    def setUp(self):
+        _FakeNavitiaApi.configure_journeys_cache(10, 60, 600)
+
+    def tearDown(self):
+        _FakeNavitiaApi.configure_journeys_cache(navitia.MisApi.JOURNEYS_CACHE_SIZE,
+                                                 navitia.MisApi.JOURNEYS_CACHE_TTL,
+                                                 navitia.MisApi.JOURNEYS_CACHE_TIME_BUCKET)
+
+    def testCache(self):
+        api = _FakeNavitiaApi()
+        params = {"from" : "stop_area:1", "to" : "stop_area:2",
+                  "datetime" : "20140601T080000", "datetime_represents" : "departure",
+                  "first_section_mode[]" : ["walking", "bike"]}
+        self.assertEquals([x["id"] for x in api._journeys_request(params)], [1])
+        # Same parameters, list values in another order, datetime in the same
+        # bucket.
+        self.assertEquals([x["id"] for x in api._journeys_request(
+                                dict(params, datetime="20140601T080500",
+                                     **{"first_section_mode[]" : ["bike", "walking"]}))],
+                          [1])
+        self.assertEquals(len(api.urls), 1)
+
+        # Another bucket, other parameters, another API key.
+        api._journeys_request(dict(params, datetime="20140601T081000"))
+        api._journeys_request(dict(params, to="stop_area:3"))
+        other_api = _FakeNavitiaApi("key")
+        other_api._journeys_request(params)
+        self.assertEquals((len(api.urls), len(other_api.urls)), (3, 1))
+
+        stats = _FakeNavitiaApi.get_journeys_cache_stats()
+        self.assertEquals((stats["hits"], stats["misses"], stats["size"]), (1, 4, 4))
+        self.assertAlmostEquals(stats["hit_rate"], 1.0 / 5)
+
+    def testDatetime(self):
+        _FakeNavitiaApi.configure_journeys_cache(10, 60, 600)
+        def journeys(params):
+            if params["datetime"] == "20140601T080959":
+                return [{"departure_date_time" : "20140601T073000",
+                         "arrival_date_time" : "20140601T080050"},
+                        {"departure_date_time" : "20140601T072000",
+                         "arrival_date_time" : "20140601T075900"}]
+            if params["datetime"] == "20140601T080000":
+                return [{"departure_date_time" : "20140601T080010",
+                         "arrival_date_time" : "20140601T083000"},
+                        {"departure_date_time" : "20140601T080200",
+                         "arrival_date_time" : "20140601T084000"}]
+            return _default_journeys(params)
+        api = _FakeNavitiaApi(journeys=journeys)
+        params = {"from" : "stop_area:1", "to" : "stop_area:2",
+                  "datetime" : "20140601T080045", "datetime_represents" : "departure"}
+
+        # Navitia is asked for the beginning of the bucket, one of the journeys
+        # found leaves before the requested time: a better one may exist,
+        # Navitia is asked for the requested time.
+        journeys = api._journeys_request(params)
+        self.assertEquals([x["datetime"] for x in api.params],
+                          ["20140601T080000", "20140601T080045"])
+        self.assertEquals([x["departure_date_time"] for x in journeys], ["20140601T081045"])
+
+        # All cached journeys leave after the requested time.
+        journeys = api._journeys_request(dict(params, datetime="20140601T080005"))
+        self.assertEquals([x["departure_date_time"] for x in journeys],
+                          ["20140601T080010", "20140601T080200"])
+        self.assertEquals(len(api.urls), 2)
+
+        # Arrival time: end of the bucket, one of the journeys found arrives
+        # after the requested time.
+        arrival_params = dict(params, datetime="20140601T080020",
+                              datetime_represents="arrival")
+        journeys = api._journeys_request(arrival_params)
+        self.assertEquals([x["datetime"] for x in api.params[2:]],
+                          ["20140601T080959", "20140601T080020"])
+        self.assertEquals([x["arrival_date_time"] for x in journeys], ["20140601T075020"])
+        journeys = api._journeys_request(dict(arrival_params, datetime="20140601T080100"))
+        self.assertEquals([x["arrival_date_time"] for x in journeys],
+                          ["20140601T080050", "20140601T075900"])
+        self.assertEquals(len(api.urls), 4)
+
+        # Detailed itineraries are not cached.
+        nb_urls = len(api.urls)
+        api._journeys_request(params, use_cache=False)
+        self.assertEquals(api.params[-1]["datetime"], "20140601T080045")
+        self.assertEquals(len(api.urls), nb_urls + 1)
+
+    def testDisabled(self):
+        _FakeNavitiaApi.configure_journeys_cache(0, 60, 60)
+        api = _FakeNavitiaApi()
+        params = {"from" : "stop_area:1", "datetime" : "20140601T080000"}
+        api._journeys_request(params)
+        api._journeys_request(params)
+        self.assertEquals(len(api.urls), 2)
+        self.assertEquals(_FakeNavitiaApi.get_journeys_cache_stats()["misses"], 0)
+
+
+def _location(place_id):
+    if place_id:
+        return LocationContextType(PlaceTypeId=place_id, AccessTime=timedelta(0))
+    return LocationContextType(PlaceTypeId=None,
+                               Position=LocationStructure(Longitude=2.35, Latitude=48.85),
+                               AccessTime=timedelta(0))
+
+
+def _stop_point(stop_point_id, stop_area_id):
+    return {"id" : stop_point_id, "embedded_type" : "stop_point",
+            "stop_point" : {"id" : stop_point_id, "stop_area" : {"id" : stop_area_id}}}
+
+
+class TestNavitiaOneToMany(unittest.TestCase):
+    def setUp(self):
+        _FakeNavitiaApi.configure_journeys_cache(0, 60, 60)
+        navitia._one_to_many_unsupported.clear()
+        self.departure_time = datetime(2014, 6, 1, 8)
+
+    def tearDown(self):
+        _FakeNavitiaApi.configure_journeys_cache(navitia.MisApi.JOURNEYS_CACHE_SIZE,
+                                                 navitia.MisApi.JOURNEYS_CACHE_TTL,
+                                                 navitia.MisApi.JOURNEYS_CACHE_TIME_BUCKET)
+        navitia._one_to_many_unsupported.clear()
+
+    def _journey(self, side, place, with_sections=True):
+        ret = {"departure_date_time" : "20140601T081000",
+               "arrival_date_time" : "20140601T084000",
+               side : place}
+        if with_sections:
+            other_side = "from" if side == "to" else "to"
+            ret["sections"] = [{"type" : "public_transport", side : place,
+                                other_side : {"id" : "stop_area:O"}}]
+        return ret
+
+    def testDepartureTime(self):
+        journeys = [
+            # Stop point of a requested stop area.
+            self._journey("to", _stop_point("stop_point:B1", "stop_area:B")),
+            # Requested stop point, without sections.
+            self._journey("to", _stop_point("stop_point:C", "stop_area:C"), False),
+            # Not requested.
+            self._journey("to", {"id" : "stop_area:X", "embedded_type" : "stop_area"})]
+        api = _FakeNavitiaApi(journeys=lambda params: journeys)
+        departures = [_location("stop_area:A")]
+        arrivals = [_location("stop_area:B"), _location("stop_point:C"),
+                    _location("stop_area:D")]
+
+        ret = api._get_journeys({}, departures, arrivals, self.departure_time, None)
+        self.assertEquals(len(api.urls), 1)
+        self.assertEquals(api.params[0]["from"], "stop_area:A")
+        self.assertTrue("to" not in api.params[0])
+        self.assertEquals([(d, a) for d, a, _ in ret],
+                          [(departures[0], arrivals[0]), (departures[0], arrivals[1])])
+
+        # Arrival place ids are those of the request.
+        j = ret[0][2]
+        self.assertEquals(j["to"]["id"], "stop_area:B")
+        self.assertEquals(j["sections"][-1]["to"]["id"], "stop_area:B")
+        self.assertEquals(j["sections"][-1]["from"]["id"], "stop_area:O")
+        self.assertEquals(journeys[0]["to"]["id"], "stop_point:B1")
+        self.assertEquals(journeys[0]["sections"][-1]["to"]["id"], "stop_point:B1")
+        j = ret[1][2]
+        self.assertEquals(j["to"]["id"], "stop_point:C")
+        self.assertTrue("sections" not in j)
+        self.assertEquals(navitia.journey_transfer_duration(dict(j, durations={"walking" : 30})),
+                          30)
+
+    def testArrivalTime(self):
+        journeys = [self._journey("from", _stop_point("stop_point:B1", "stop_area:B"))]
+        # Sections only.
+        del journeys[0]["from"]
+        api = _FakeNavitiaApi(journeys=lambda params: journeys)
+        departures = [_location("stop_area:B"), _location("stop_area:C")]
+        arrivals = [_location("stop_area:A")]
+
+        ret = api._get_journeys({}, departures, arrivals, None, self.departure_time)
+        self.assertEquals(len(api.urls), 1)
+        self.assertEquals(api.params[0]["to"], "stop_area:A")
+        self.assertEquals(api.params[0]["datetime_represents"], "arrival")
+        self.assertTrue("from" not in api.params[0])
+        self.assertEquals([(d, a) for d, a, _ in ret], [(departures[0], arrivals[0])])
+        self.assertEquals(ret[0][2]["sections"][0]["from"]["id"], "stop_area:B")
+
+    def testPairwise(self):
+        api = _FakeNavitiaApi()
+        # A position can't be matched with journeys places.
+        departures = [_location("stop_area:A")]
+        arrivals = [_location("stop_area:B"), _location(None)]
+        ret = api._get_journeys({}, departures, arrivals, self.departure_time, None)
+        # Pairwise requests are sent concurrently.
+        self.assertEquals(sorted([(p["from"], p["to"]) for p in api.params]),
+                          [("stop_area:A", "2.35;48.85"), ("stop_area:A", "stop_area:B")])
+        self.assertEquals([(d, a) for d, a, _ in ret],
+                          [(departures[0], arrivals[0]), (departures[0], arrivals[1])])
+
+        # Arrival time with a single departure point.
+        api = _FakeNavitiaApi()
+        api._get_journeys({}, departures, arrivals[:1], None, self.departure_time)
+        self.assertEquals(len(api.urls), 1)
+        self.assertTrue("to" in api.params[0])
+
+    def testFallback(self):
+        def journeys(params):
+            if "to" not in params:
+                raise navitia.MisApiBadRequestException("bad request", error_id)
+            return _default_journeys(params)
+        api = _FakeNavitiaApi(journeys=journeys)
+        departures = [_location("stop_area:A")]
+        arrivals = [_location("stop_area:B"), _location("stop_area:C")]
+
+        # The request failed, pairwise requests are used for that request only.
+        error_id = "unknown_object"
+        ret = api._get_journeys({}, departures, arrivals, self.departure_time, None)
+        self.assertEquals([(d, a) for d, a, _ in ret],
+                          [(departures[0], arrivals[0]), (departures[0], arrivals[1])])
+        self.assertEquals(len(api.urls), 3)
+        self.assertEquals(navitia._one_to_many_unsupported, set())
+
+        # The coverage doesn't support one-to-many requests, they are not sent
+        # anymore.
+        error_id = navitia.ONE_TO_MANY_UNSUPPORTED_ERRORS[0]
+        api._get_journeys({}, departures, arrivals, self.departure_time, None)
+        self.assertEquals(len(api.urls), 6)
+        ret = api._get_journeys({}, departures, arrivals, self.departure_time, None)
+        self.assertEquals(len(ret), 2)
+        self.assertEquals(len(api.urls), 8)
+        self.assertTrue(all(["to" in p for p in api.params[-2:]]))
+
+
+class TestMisApiPool(unittest.TestCase):
+    class FakeMisApi(object):
+        def __init__(self, config, api_key=""):
+            self.api_key = api_key
+            self.resets = 0
+            self.reset_error = None
+            self.error = None
+
+        def reset(self):
+            self.resets += 1
+            if self.reset_error:
+                raise self.reset_error
+
+        def get_capabilities(self):
+            if self.error:
+                raise self.error
+            return None
+
+    class FakeRequest(object):
+        headers = {}
+        url = ""
+        json = None
+
+    class FakeRequestProcessor(resources.RequestProcessor):
+        class Response(object):
+            pass
+
+        def _new_response(self):
+            return self.Response()
+
+        def _mis_request(self, params):
+            self._mis.get_capabilities()
+
+        def _marshal_response(self):
+            return {}
+
+    def setUp(self):
+        resources.mis_api_mapping["fake"] = self.FakeMisApi
+        self._pool = resources.mis_api_pool
+
+    def tearDown(self):
+        del resources.mis_api_mapping["fake"]
+        resources.mis_api_pool = self._pool
+
+    def testReuse(self):
+        pool = resources.MisApiPool(max_idle=2, max_keys=2)
+        self.assertEquals(pool.acquire("unknown"), None)
+
+        mis1 = pool.acquire("fake", "key1")
+        mis2 = pool.acquire("fake", "key1")
+        self.assertTrue(mis1 is not mis2)
+        self.assertEquals(mis1.api_key, "key1")
+        pool.release("fake", "key1", mis1)
+        self.assertTrue(pool.acquire("fake", "key1") is mis1)
+        # Objects are not shared between API keys.
+        self.assertTrue(pool.acquire("fake", "key2") not in [mis1, mis2])
+
+        # At most max_idle idle objects per key.
+        mis3 = pool.acquire("fake", "key1")
+        for x in [mis1, mis2, mis3]:
+            pool.release("fake", "key1", x)
+        self.assertEquals(pool.get_stats(), {"created" : 4, "reused" : 1, "idle" : 2})
+
+        # At most max_keys keys, least recently used ones are dropped.
+        pool.release("fake", "key2", pool.acquire("fake", "key2"))
+        pool.release("fake", "key3", pool.acquire("fake", "key3"))
+        self.assertEquals(pool.get_stats()["idle"], 2)
+        self.assertTrue(pool.acquire("fake", "key1") not in [mis1, mis2, mis3])
+
+    def testReset(self):
+        pool = resources.MisApiPool()
+        mis = pool.acquire("fake")
+        pool.release("fake", "", mis)
+        self.assertEquals(mis.resets, 1)
+        self.assertTrue(pool.acquire("fake") is mis)
+        # reset() failed, object is dropped.
+        mis.reset_error = ValueError("reset failed")
+        pool.release("fake", "", mis)
+        self.assertEquals(mis.resets, 2)
+        self.assertTrue(pool.acquire("fake") is not mis)
+
+        # Objects that are not reusable are dropped.
+        mis = pool.acquire("fake")
+        pool.release("fake", "", mis, reusable=False)
+        self.assertEquals(pool.get_stats()["idle"], 0)
+
+    def testRequestErrors(self):
+        pool = resources.mis_api_pool = resources.MisApiPool()
+
+        def process(error):
+            processor = self.FakeRequestProcessor("fake", self.FakeRequest())
+            mis = processor._mis
+            mis.error = error
+            resp = processor.process()
+            return resp.status_code, pool.acquire("fake") is mis
+
+        # A MIS error doesn't make the object unusable.
+        self.assertEquals(process(None), (200, True))
+        self.assertEquals(process(resources.MisApiBadRequestException("error")),
+                          (500, True))
+        self.assertEquals(process(ValueError("unexpected error")), (500, False))
+
+
+class TestFanOutExecutor(unittest.TestCase):
+    def setUp(self):
+        self._lock = threading.Lock()
+        self._running = {} # {key : [running, max running]}
+
+    def tearDown(self):
+        self._executor.stop()
+
+    def _call(self, key, i, delay):
+        with self._lock:
+            counts = self._running.setdefault(key, [0, 0])
+            counts[0] += 1
+            counts[1] = max(counts)
+        time.sleep(delay)
+        with self._lock:
+            counts[0] -= 1
+        if i < 0:
+            raise ValueError(i)
+        return i * 10
+
+    def testMap(self):
+        self._executor = FanOutExecutor(size=8, max_per_key=4)
+        # Results are in the order of arguments, whatever the completion order.
+        start = time.time()
+        results = self._executor.map("a", self._call,
+                                     [("a", i, 0.1 - i * 0.01) for i in range(8)])
+        self.assertEquals(results, [i * 10 for i in range(8)])
+        # 2 rounds of 4 calls.
+        self.assertTrue(time.time() - start < 0.4)
+        self.assertEquals(self._running["a"], [0, 4])
+        self.assertEquals(self._executor.map("a", self._call, []), [])
+
+    def testMaxPerKey(self):
+        self._executor = FanOutExecutor(size=4, max_per_key=2)
+        results = {}
+        def run(key):
+            results[key] = self._executor.map(key, self._call,
+                                              [(key, i, 0.02) for i in range(6)])
+        threads = [threading.Thread(target=run, args=(x,)) for x in ["a", "b"]]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(results, {"a" : [i * 10 for i in range(6)],
+                                    "b" : [i * 10 for i in range(6)]})
+        self.assertEquals(self._running, {"a" : [0, 2], "b" : [0, 2]})
+        self.assertEquals(self._executor.get_stats()["running"], 0)
+
+    def testFailure(self):
+        self._executor = FanOutExecutor(size=2, max_per_key=2)
+        args = [("a", 0, 0.05), ("a", -1, 0.05), ("a", -2, 0), ("a", 3, 0)]
+        # Error of the failed call with the lowest index is raised.
+        try:
+            self._executor.map("a", self._call, args)
+            self.fail("No exception raised")
+        except ValueError as e:
+            self.assertEquals(e.args, (-1,))
+        self.assertEquals(self._executor.map("a", self._call, [("a", 1, 0)]), [10])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,37 @@
-import sys, os, unittest, Queue, logging
-from apiisim import tests
-from apiisim.planner import TraceStop, Planner
+import sys, os, unittest, Queue, logging, threading, time, json
+from apiisim import tests, metabase
+from apiisim.planner import TraceStop, Planner, MisApi, on_topology_reload, \
+                            NoItineraryFoundException
 from apiisim.planner.plan_trip_calculator import PlanTripCalculator
+from apiisim.planner.trace_graph import find_mis_traces
+from apiisim.planner.geo import parse_wkt_polygon, polygon_contains, haversine
+from apiisim.planner.trace_ranking import trace_lower_bound, max_speed, TracePruner, \
+                                          MAX_SPEEDS, rank_transfers
+from apiisim.planner import transfer_cache
+from apiisim.planner.transfer_cache import TransferInfo, StopInfo, TransferCache
+from apiisim.planner import mis_topology
+from apiisim.planner.mis_topology import MisTopology, MisTopologyCache, MisInfo
+from apiisim.planner.trace_state import StopSet, new_transfer_stop_sets
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import SocketServer
+from apiisim.planner import worker_pool
+from apiisim.planner.worker_pool import WorkerPool, JobGroup
+from apiisim.planner.coalescing import RequestCoalescer
+from apiisim.planner.coroutines import Return, Task, run_sync
+from apiisim.planner.event_loop import EventLoop, AsyncHttpClient, HttpCancelledError
 from apiisim.common.plan_trip import PlanTripRequestType, EndPointType, \
                                      LocationPointType, LocationPointType, \
-                                     LocationStructure
-from apiisim.common.mis_plan_summed_up_trip import SummedUpTripType, TripStopPlaceType
+                                     LocationStructure, EndingSearch, PlanTripResponse, \
+                                     PlanTripNotificationResponseType, \
+                                     PlanTripExistenceNotificationResponseType
+from apiisim.planner import PlanTripCancellationResponse
+from apiisim.planner.notifications import NotificationThread, UntrackedNotification
+from apiisim.common.mis_plan_summed_up_trip import SummedUpTripType, TripStopPlaceType, \
+                                                   SummedUpItinerariesRequestType, \
+                                                   SummedUpItinerariesResponseType
+from apiisim.common.marshalling import marshal, trip_type
+from apiisim.common import parse_datetime, xsd_duration_to_timedelta, PlanTripStatusEnum
+from apiisim.planner.trip_decoder import decode_detailed_trip
 from datetime import timedelta, datetime, date as date_type
 from itertools import permutations
 
@@ -46,19 +72,25 @@ class TestPlanner(unittest.TestCase):
             logging.debug(res)
             for j in range(0, i):
                 k = j + 1
-                self.assertEquals(res[j][0].get_name(), "mis%s" % k)
+                hop = res[j]
+                self.assertEquals(hop.mis_api.get_name(), "mis%s" % k)
                 if j == 0:
-                    self.assertEquals(res[j][1][0].PlaceTypeId, "departure")
-                    self.assertEquals(res[j][2][0].PlaceTypeId, "stop_code%s0" % k)
-                    self.assertEquals(res[j][3][0].PlaceTypeId, "stop_code%s0" % (k + 1))
+                    self.assertEquals(hop.departures.stops[0].PlaceTypeId, "departure")
+                    self.assertEquals(hop.arrivals.stops[0].PlaceTypeId, "stop_code%s0" % k)
+                    self.assertEquals(hop.linked_stops.stops[0].PlaceTypeId,
+                                      "stop_code%s0" % (k + 1))
                 elif j == (i - 1):
-                    self.assertEquals(res[j][1][0].PlaceTypeId, "stop_code%s0" % k)
-                    self.assertEquals(res[j][2][0].PlaceTypeId, "arrival")
-                    self.assertEquals(res[j][3], None)
+                    self.assertEquals(hop.departures.stops[0].PlaceTypeId, "stop_code%s0" % k)
+                    self.assertEquals(hop.arrivals.stops[0].PlaceTypeId, "arrival")
+                    self.assertEquals(hop.linked_stops, None)
                 else:
-                    self.assertEquals(res[j][1][0].PlaceTypeId, "stop_code%s0" % k)
-                    self.assertEquals(res[j][2][0].PlaceTypeId, "stop_code%s1" % k)
-                    self.assertEquals(res[j][3][0].PlaceTypeId, "stop_code%s0" % (k + 1))
+                    self.assertEquals(hop.departures.stops[0].PlaceTypeId, "stop_code%s0" % k)
+                    self.assertEquals(hop.arrivals.stops[0].PlaceTypeId, "stop_code%s1" % k)
+                    self.assertEquals(hop.linked_stops.stops[0].PlaceTypeId,
+                                      "stop_code%s0" % (k + 1))
+                if j > 0:
+                    # Departures are the stops linked to previous arrivals.
+                    self.assertTrue(hop.departures is res[j - 1].linked_stops)
 
 
     def testArrivalAtDetailedTrace(self):
@@ -72,25 +104,33 @@ class TestPlanner(unittest.TestCase):
             logging.debug(res)
             k = i
             for j in range(0, i):
-                self.assertEquals(res[j][0].get_name(), "mis%s" % k)
+                hop = res[j]
+                self.assertEquals(hop.mis_api.get_name(), "mis%s" % k)
                 if j == (i - 1):
-                    self.assertEquals(res[j][1][0].PlaceTypeId, "departure")
-                    self.assertEquals(res[j][2][0].PlaceTypeId, "stop_code%s0" % k)
-                    self.assertEquals(res[j][3], None)
+                    self.assertEquals(hop.departures.stops[0].PlaceTypeId, "departure")
+                    self.assertEquals(hop.arrivals.stops[0].PlaceTypeId, "stop_code%s0" % k)
+                    self.assertEquals(hop.linked_stops, None)
                 elif j == 0:
-                    self.assertEquals(res[j][1][0].PlaceTypeId, "stop_code%s0" % k)
-                    self.assertEquals(res[j][2][0].PlaceTypeId, "arrival")
+                    self.assertEquals(hop.departures.stops[0].PlaceTypeId, "stop_code%s0" % k)
+                    self.assertEquals(hop.arrivals.stops[0].PlaceTypeId, "arrival")
                     if k <= 2:
-                        self.assertEquals(res[j][3][0].PlaceTypeId, "stop_code%s0" % (k - 1))
+                        self.assertEquals(hop.linked_stops.stops[0].PlaceTypeId,
+                                          "stop_code%s0" % (k - 1))
                     else:
-                        self.assertEquals(res[j][3][0].PlaceTypeId, "stop_code%s1" % (k - 1))
+                        self.assertEquals(hop.linked_stops.stops[0].PlaceTypeId,
+                                          "stop_code%s1" % (k - 1))
                 else:
-                    self.assertEquals(res[j][1][0].PlaceTypeId, "stop_code%s0" % k)
-                    self.assertEquals(res[j][2][0].PlaceTypeId, "stop_code%s1" % k)
+                    self.assertEquals(hop.departures.stops[0].PlaceTypeId, "stop_code%s0" % k)
+                    self.assertEquals(hop.arrivals.stops[0].PlaceTypeId, "stop_code%s1" % k)
                     if k <= 2:
-                        self.assertEquals(res[j][3][0].PlaceTypeId, "stop_code%s0" % (k - 1))
+                        self.assertEquals(hop.linked_stops.stops[0].PlaceTypeId,
+                                          "stop_code%s0" % (k - 1))
                     else:
-                        self.assertEquals(res[j][3][0].PlaceTypeId, "stop_code%s1" % (k - 1))
+                        self.assertEquals(hop.linked_stops.stops[0].PlaceTypeId,
+                                          "stop_code%s1" % (k - 1))
+                if j > 0:
+                    # Arrivals are the stops linked to previous departures.
+                    self.assertTrue(hop.arrivals is res[j - 1].linked_stops)
                 k -= 1
 
     def testFilterTraces(self):
@@ -227,6 +267,12 @@ class TestPlanner(unittest.TestCase):
         position = LocationStructure(Longitude=0, Latitude=0)
         self.assertEquals(calculator._get_surrounding_mises(position, date), set([1, 2, 3]))
 
+        # Stops of MIS that are not in the topology snapshot yet are ignored.
+        topology = calculator._topology
+        calculator._topology = MisTopology(topology.generation,
+                                           {1 : topology.get_mis(1)}, {})
+        self.assertEquals(calculator._get_surrounding_mises(position, date), set([1]))
+
 
     def testGetMisModes(self):
         request = PlanTripRequestType()
@@ -238,6 +284,57 @@ class TestPlanner(unittest.TestCase):
         self.assertEquals(calculator._get_mis_modes(5), set(["bus", "tram", "funicular"]))
         self.assertEquals(calculator._get_mis_modes(6), set([]))
 
+    def testTopologyCache(self):
+        db_session = self._planner.create_db_session()
+        topology = self._planner.get_topology(db_session)
+        self.assertEquals(topology.generation, None)
+        self.assertEquals(topology.get_mis(3).name, "mis3")
+        self.assertEquals(topology.get_mis(3).multiple_starts_and_arrivals, 1)
+        self.assertTrue(self._planner.get_topology(db_session) is topology)
+        self.assertEquals(self._planner._topology_cache.get_stats(), (1, 1))
+
+        # A new back_office import must lead to a new snapshot, previous one
+        # being left untouched.
+        db_session.add(metabase.BackOfficeImport(start_date=datetime.now(),
+                                                 end_date=datetime.now(),
+                                                 result="success"))
+        db_session.query(metabase.Mis).filter_by(id=3).update({"name" : "new_mis3"})
+        db_session.commit()
+        self._planner._topology_cache.CHECK_INTERVAL = 0
+        new_topology = self._planner.get_topology(db_session)
+        self.assertNotEquals(new_topology.generation, None)
+        self.assertEquals(new_topology.get_mis(3).name, "new_mis3")
+        self.assertEquals(topology.get_mis(3).name, "mis3")
+        self.assertEquals(self._planner._topology_cache.get_stats(), (1, 2))
+        self._planner.remove_db_session(db_session)
+
+    def testTransferCache(self):
+        request = PlanTripRequestType()
+        calculator = PlanTripCalculator(self._planner, request, Queue.Queue())
+        transfers1 = calculator._get_transfers(3, 4)
+        transfers2 = calculator._get_transfers(4, 3)
+        self.assertEquals(self._planner._transfer_cache.get_stats(), (1, 1))
+        self.assertEquals([x.PlaceTypeId for x in transfers1[1]],
+                          [x.PlaceTypeId for x in transfers2[2]])
+
+        # Each call returns its own TraceStop objects.
+        transfers1[1][0].PlaceTypeId = "modified"
+        transfers = calculator._get_transfers(3, 4)
+        self.assertEquals(transfers[1][0].PlaceTypeId, "stop_code31")
+        self.assertEquals(self._planner._transfer_cache.get_stats(), (2, 1))
+
+        # New import, transfers must be reloaded.
+        db_session = self._planner.create_db_session()
+        db_session.add(metabase.BackOfficeImport(start_date=datetime.now(),
+                                                 end_date=datetime.now(),
+                                                 result="success"))
+        db_session.commit()
+        self._planner.remove_db_session(db_session)
+        self._planner._topology_cache.CHECK_INTERVAL = 0
+        calculator = PlanTripCalculator(self._planner, request, Queue.Queue())
+        calculator._get_transfers(3, 4)
+        self.assertEquals(self._planner._transfer_cache.get_stats(), (2, 2))
+
     def testGetConnectedMises(self):
         request = PlanTripRequestType()
         calculator = PlanTripCalculator(self._planner, request, Queue.Queue())
@@ -317,15 +414,16 @@ class TestPlanner(unittest.TestCase):
                                 TripStopPlace=TripStopPlaceType(id="3"),
                                 DateTime=datetime(year=2014, month=2, day=21))),
         ]
-        calculator._update_departures(departures, linked_stops, trips)
+        linked_stops, departures = new_transfer_stop_sets(
+                                    ([timedelta(minutes=5)] * 4, linked_stops, departures))
+        calculator._update_departures(departures, trips)
         self.assertEquals(len(departures), 2)
-        self.assertEquals(departures[0].PlaceTypeId, "1")
-        self.assertEquals(departures[0].departure_time, datetime(year=2014, month=2, day=1))
-        self.assertEquals(departures[1].PlaceTypeId, "3")
-        self.assertEquals(departures[1].departure_time, datetime(year=2014, month=2, day=21))
+        self.assertEquals([x.PlaceTypeId for x in departures.live_stops()], ["1", "3"])
+        self.assertEquals(departures.live_indexes(), [0, 2])
+        self.assertEquals(departures.departure_times[0], datetime(year=2014, month=2, day=1))
+        self.assertEquals(departures.departure_times[2], datetime(year=2014, month=2, day=21))
         self.assertEquals(len(linked_stops), 2)
-        self.assertEquals(linked_stops[0].PlaceTypeId, "l1")
-        self.assertEquals(linked_stops[1].PlaceTypeId, "l3")
+        self.assertEquals([x.PlaceTypeId for x in linked_stops.live_stops()], ["l1", "l3"])
 
     def testUpdateArrivals(self):
         request = PlanTripRequestType()
@@ -356,15 +454,24 @@ class TestPlanner(unittest.TestCase):
                                 TripStopPlace=TripStopPlaceType(id="43"),
                                 DateTime=datetime(year=2014, month=2, day=4))),
         ]
-        calculator._update_arrivals(arrivals, linked_stops, trips)
+        arrivals, linked_stops = new_transfer_stop_sets(
+                                    ([timedelta(minutes=5)] * 4, arrivals, linked_stops))
+        calculator._update_arrivals(arrivals, trips)
         self.assertEquals(len(arrivals), 2)
-        self.assertEquals(arrivals[0].PlaceTypeId, "1")
-        self.assertEquals(arrivals[0].arrival_time, datetime(year=2014, month=2, day=1))
-        self.assertEquals(arrivals[1].PlaceTypeId, "4")
-        self.assertEquals(arrivals[1].arrival_time, datetime(year=2014, month=2, day=26))
+        self.assertEquals([x.PlaceTypeId for x in arrivals.live_stops()], ["1", "4"])
+        self.assertEquals(arrivals.live_indexes(), [0, 3])
+        self.assertEquals(arrivals.arrival_times[0], datetime(year=2014, month=2, day=1))
+        self.assertEquals(arrivals.arrival_times[3], datetime(year=2014, month=2, day=26))
         self.assertEquals(len(linked_stops), 2)
-        self.assertEquals(linked_stops[0].PlaceTypeId, "l1")
-        self.assertEquals(linked_stops[1].PlaceTypeId, "l4")
+        self.assertEquals([x.PlaceTypeId for x in linked_stops.live_stops()], ["l1", "l4"])
+        # Removed stops are also removed for the whole trip.
+        trips = [SummedUpTripType(
+                    Arrival=EndPointType(TripStopPlace=TripStopPlaceType(id="4"),
+                                         DateTime=datetime(year=2014, month=2, day=26)))]
+        calculator._update_arrivals(arrivals, trips)
+        self.assertEquals([x.PlaceTypeId for x in linked_stops.live_stops()], ["l4"])
+        self.assertRaises(NoItineraryFoundException, calculator._update_arrivals,
+                          arrivals, trips[:0])
 
     def tearDown(self):
         # Force planner deletion to reset SQLAlchemy connection pool. Otherwise, 
@@ -374,5 +481,833 @@ class TestPlanner(unittest.TestCase):
         tests.drop_db()
 
 
+class TestMisTraces(unittest.TestCase):
+    # 1 - 2 - 3
+    # |       |
+    # 4 ----- 5 - 6
+    CONNECTIONS = {1 : [2, 4], 2 : [1, 3], 3 : [2, 5], 4 : [1, 5],
+                   5 : [3, 4, 6], 6 : [5]}
+
+    def testOrderedByLength(self):
+        self.assertEquals(find_mis_traces(self.CONNECTIONS, set([1, 2]), set([3, 5]), 3),
+                          [[2, 3], [1, 2, 3], [1, 4, 5], [2, 3, 5]])
+        self.assertEquals(find_mis_traces(self.CONNECTIONS, set([1]), set([1, 6]), 5),
+                          [[1], [1, 4, 5, 6], [1, 2, 3, 5, 6]])
+
+    def testMaxTraceLength(self):
+        self.assertEquals(find_mis_traces(self.CONNECTIONS, set([1]), set([6]), 3), [])
+        self.assertEquals(find_mis_traces(self.CONNECTIONS, set([1]), set([6]), 0), [])
+        self.assertEquals(find_mis_traces(self.CONNECTIONS, set([1]), set([3]), 10),
+                          [[1, 2, 3], [1, 4, 5, 3]])
+
+    def testTransitMises(self):
+        self.assertEquals(find_mis_traces(self.CONNECTIONS, set([1]), set([3]), 4,
+                                          transit_mises=set([4, 5])),
+                          [[1, 4, 5, 3]])
+        self.assertEquals(find_mis_traces(self.CONNECTIONS, set([1, 2]), set([2, 3]), 4,
+                                          transit_mises=set()),
+                          [[2], [1, 2], [2, 3]])
+
+    def testMaxTraces(self):
+        self.assertEquals(find_mis_traces(self.CONNECTIONS, set([1, 2]), set([3, 5]), 3,
+                                          max_traces=2),
+                          [[2, 3], [1, 2, 3]])
+
+    def testNoDuplicates(self):
+        connections = dict((x, [y for y in range(1, 7) if y != x]) for x in range(1, 7))
+        traces = find_mis_traces(connections, set(range(1, 7)), set(range(1, 7)), 4)
+        self.assertEquals(len(traces), len(set([tuple(x) for x in traces])))
+        self.assertEquals(len(traces), 6 + 6 * 5 + 6 * 5 * 4 + 6 * 5 * 4 * 3)
+
+
+class TestTransferCache(unittest.TestCase):
+    def setUp(self):
+        self._loaded = []
+        self._load_transfers = transfer_cache.load_transfers
+        transfer_cache.load_transfers = self._load
+
+    def tearDown(self):
+        transfer_cache.load_transfers = self._load_transfers
+
+    def _load(self, db_session, mis1_id, mis2_id, max_transfers=None):
+        self._loaded.append((mis1_id, mis2_id))
+        return (TransferInfo(60, StopInfo("s%s" % mis1_id, 0, 0),
+                             StopInfo("s%s" % mis2_id, 0, 0)),)
+
+    def testGenerations(self):
+        cache = TransferCache()
+        self.assertEquals(cache.get(None, 1, 2, 1)[0].stop1.code, "s2")
+        cache.get(None, 1, 1, 2)
+        cache.get(None, 1, 1, 3)
+        self.assertEquals(self._loaded, [(1, 2), (1, 3)])
+
+        # New generation: cache is cleared once.
+        cache.get(None, 2, 1, 2)
+        self.assertEquals(len(cache._cache), 1)
+        # A thread still working with the previous generation doesn't clear
+        # entries of the new one.
+        cache.get(None, 1, 1, 2)
+        cache.get(None, 1, 1, 3)
+        self.assertEquals(len(cache._cache), 3)
+        cache.get(None, 2, 1, 2)
+        self.assertEquals(len(self._loaded), 5)
+        self.assertEquals(len(cache._cache), 3)
+
+
+class TestWorkerPool(unittest.TestCase):
+    class FakePlanner(object):
+        class FakeSession(object):
+            def close(self):
+                pass
+
+        def create_db_session(self):
+            return self.FakeSession()
+
+        def remove_db_session(self, db_session):
+            pass
+
+    # Record maximum number of jobs of each request running at the same time.
+    class RecordingPool(WorkerPool):
+        def __init__(self, *args, **kwargs):
+            WorkerPool.__init__(self, *args, **kwargs)
+            self.lock = threading.Lock()
+            self.running = {}
+            self.max_running = {}
+            self.done = []
+
+        def _run_job(self, group, trace, db_session):
+            request_id = group.params.clientRequestId
+            with self.lock:
+                self.running[request_id] = self.running.get(request_id, 0) + 1
+                self.max_running[request_id] = max(self.max_running.get(request_id, 0),
+                                                   self.running[request_id])
+            time.sleep(0.01)
+            with self.lock:
+                self.running[request_id] -= 1
+                self.done.append((request_id, trace))
+            if trace == "fail":
+                raise Exception("Job failed")
+
+    def new_params(self, request_id, max_trips=0):
+        ret = PlanTripRequestType()
+        ret.clientRequestId = request_id
+        ret.MaxTrips = max_trips
+        return ret
+
+    def testSubmit(self):
+        pool = self.RecordingPool(self.FakePlanner(), size=4, max_workers_per_request=2)
+        pool.start()
+        group1 = pool.submit(self.new_params("r1"), range(10), Queue.Queue())
+        group2 = pool.submit(self.new_params("r2", max_trips=3), range(10) + ["fail"],
+                             Queue.Queue())
+        group3 = pool.submit(self.new_params("r3"), [], Queue.Queue())
+        group4 = pool.submit(self.new_params("r4"), ["fail", 1], Queue.Queue())
+        for g in [group1, group2, group3, group4]:
+            self.assertTrue(g.wait(10))
+        pool.stop()
+
+        self.assertEquals(sorted([x for r, x in pool.done if r == "r1"]), range(10))
+        # Only MaxTrips traces are computed.
+        self.assertEquals(sorted([x for r, x in pool.done if r == "r2"]), range(3))
+        self.assertEquals((group4.succeeded, group4.failed), (1, 1))
+        self.assertEquals(group3.succeeded, 0)
+        for request_id, max_running in pool.max_running.iteritems():
+            self.assertTrue(max_running <= 2)
+        # r2 jobs must not wait for all r1 jobs to be done.
+        self.assertTrue(pool.done.index(("r2", 2)) < pool.done.index(("r1", 9)))
+
+    def testCancel(self):
+        pool = self.RecordingPool(self.FakePlanner(), size=2, max_workers_per_request=1)
+        pool.start()
+        group1 = pool.submit(self.new_params("r1"), range(100), Queue.Queue())
+        group2 = pool.submit(self.new_params("r2"), range(3), Queue.Queue())
+        time.sleep(0.05)
+        group1.cancel()
+        self.assertTrue(group1.wait(1))
+        self.assertTrue(group2.wait(10))
+        pool.stop()
+
+        # Pending traces are dropped, running ones are not counted twice.
+        self.assertTrue(group1.dropped > 0)
+        self.assertEquals(group1.succeeded + group1.failed + group1.dropped, 100)
+        self.assertEquals(group2.succeeded, 3)
+        # Cancelling again has no effect.
+        group1.cancel()
+
+    def testTopology(self):
+        topology = MisTopology(1, {}, {})
+        planner = self.FakePlanner()
+        # The current snapshot must not be used.
+        planner.get_topology = None
+        topologies = []
+        class FakeCalculator(PlanTripCalculator):
+            def compute_trip(self, trace, cancel_token=None, coalescer=None):
+                topologies.append(self.get_topology())
+        calculator_class = worker_pool.PlanTripCalculator
+        worker_pool.PlanTripCalculator = FakeCalculator
+        try:
+            pool = WorkerPool(planner, size=2)
+            pool.start()
+            group = pool.submit(self.new_params("r1"), range(3), Queue.Queue(),
+                                topology=topology)
+            self.assertTrue(group.wait(10))
+            pool.stop()
+        finally:
+            worker_pool.PlanTripCalculator = calculator_class
+
+        # All traces of the request are computed with its snapshot.
+        self.assertEquals(group.succeeded, 3)
+        self.assertEquals(len(topologies), 3)
+        self.assertTrue(all([x is topology for x in topologies]))
+
+
+class TestTripDecoder(unittest.TestCase):
+    def testParseDatetime(self):
+        for s in ["2014-06-01T08:30:00", "2014-6-1T8:30:00"]:
+            self.assertEquals(parse_datetime(s), datetime.strptime(s, "%Y-%m-%dT%H:%M:%S"))
+        for s in ["2014-13-01T08:30:00", "2014-06-01 08:30:00"]:
+            self.assertRaises(ValueError, parse_datetime, s)
+
+    def testXsdDuration(self):
+        self.assertEquals(xsd_duration_to_timedelta("PT10S"), timedelta(seconds=10))
+        self.assertEquals(xsd_duration_to_timedelta("P1DT2H3M4S"),
+                          timedelta(days=1, hours=2, minutes=3, seconds=4))
+
+    def testDecodeDetailedTrip(self):
+        def end_point(stop_id, time):
+            return {"TripStopPlace" : {"id" : stop_id, "Name" : stop_id,
+                                       "Position" : {"Latitude" : 45.1, "Longitude" : 4.2}},
+                    "DateTime" : time}
+        ptr = {"PublicTransportMode" : "BUS",
+               "Departure" : end_point("a", "2014-06-01T08:00:00"),
+               "Arrival" : end_point("b", "2014-06-01T08:10:00"),
+               "Duration" : "PT10M", "Line" : {"id" : "l1", "Name" : "Line 1"},
+               "steps" : [{"id" : "s1", "Duration" : "PT10M",
+                           "Departure" : end_point("a", "2014-06-01T08:00:00"),
+                           "Arrival" : end_point("b", "2014-06-01T08:10:00")}]}
+        leg = {"SelfDriveMode" : "foot", "Duration" : "PT5M",
+               "Departure" : end_point("b", "2014-06-01T08:10:00"),
+               "Arrival" : end_point("c", "2014-06-01T08:15:00")}
+        trip = decode_detailed_trip({"Departure" : ptr["Departure"],
+                                     "Arrival" : leg["Arrival"],
+                                     "Duration" : "PT15M",
+                                     "sections" : [{"PTRide" : ptr}, {"Leg" : leg}]})
+        self.assertEquals(trip.Duration, timedelta(minutes=15))
+        self.assertEquals(trip.InterchangeNumber, 0)
+        self.assertEquals(trip.Arrival.TripStopPlace.id, "c")
+        self.assertEquals(trip.Arrival.DateTime, datetime(2014, 6, 1, 8, 15))
+        step = trip.sections[0].PTRide.steps[0]
+        self.assertEquals(step.Departure.PassThrough, False)
+        self.assertEquals(step.Arrival.TripStopPlace.Position.Latitude, 45.1)
+        self.assertEquals(trip.sections[0].PTRide.PTNetwork, None)
+        self.assertEquals(trip.sections[1].PTRide, None)
+        self.assertEquals(trip.sections[1].Leg.SelfDriveMode, "foot")
+        marshalled = marshal(trip, trip_type)
+        self.assertEquals(marshalled["Duration"], "PT15M0S")
+        self.assertEquals(marshalled["sections"][0]["PTRide"]["steps"][0]["id"], "s1")
+        self.assertEquals(decode_detailed_trip(None), None)
+
+
+class TestRequestCoalescer(unittest.TestCase):
+    def testRun(self):
+        coalescer = RequestCoalescer()
+        lock = threading.Lock()
+        sent = []
+        def send(key):
+            with lock:
+                sent.append(key)
+            time.sleep(0.05)
+            return 200, "content%s" % key
+
+        results = []
+        def run(key):
+            results.append(coalescer.run(key, lambda: send(key)))
+        threads = [threading.Thread(target=run, args=(i % 2,)) for i in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(sorted(sent), [0, 1])
+        self.assertEquals(sorted(results), [(200, "content0")] * 3 + [(200, "content1")] * 3)
+
+        # Responses are kept for subsequent calls.
+        self.assertEquals(coalescer.run(0, lambda: send(2)), (200, "content0"))
+        self.assertEquals(len(sent), 2)
+        stats = coalescer.get_stats()
+        self.assertEquals((stats["calls"], stats["sent"]), (7, 2))
+        self.assertAlmostEquals(stats["dedup_ratio"], 5.0 / 7)
+
+    def testFailure(self):
+        coalescer = RequestCoalescer()
+        def fail():
+            raise ValueError()
+        self.assertRaises(ValueError, coalescer.run, "key", fail)
+        # Failed requests are sent again.
+        self.assertEquals(coalescer.run("key", lambda: (200, "")), (200, ""))
+        self.assertEquals(coalescer.get_stats()["sent"], 2)
+
+
+class TestCoroutines(unittest.TestCase):
+    def add(self, a, b):
+        result = yield ("add", a, b)
+        raise Return(result)
+
+    def compute(self):
+        x = yield self.add(1, 2)
+        y = yield self.add(x, 3)
+        try:
+            yield ("fail",)
+        except ValueError:
+            y += 10
+        raise Return(y)
+
+    def execute(self, operation):
+        if operation[0] == "fail":
+            raise ValueError()
+        return operation[1] + operation[2]
+
+    def testRunSync(self):
+        self.assertEquals(run_sync(self.compute(), self.execute), 16)
+
+    def testTask(self):
+        task = Task(self.compute())
+        self.assertEquals(task.step(), ("add", 1, 2))
+        self.assertEquals(task.step(3), ("add", 3, 3))
+        self.assertEquals(task.step(6), ("fail",))
+        self.assertEquals(task.step(exc_info=(ValueError, ValueError(), None)), None)
+        self.assertTrue(task.done)
+        self.assertEquals(task.result, 16)
+
+    def testException(self):
+        task = Task(self.compute())
+        task.step()
+        self.assertRaises(KeyError, task.step, exc_info=(KeyError, KeyError(), None))
+        self.assertTrue(task.done)
+
+
+class TestAsyncHttpClient(unittest.TestCase):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            if self.path == "/slow":
+                time.sleep(0.5)
+            self.send_response(200)
+            if self.path == "/chunked":
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for part in [body[:2], body[2:]]:
+                    self.wfile.write("%x\r\n%s\r\n" % (len(part), part))
+                self.wfile.write("0\r\n\r\n")
+                return
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    def setUp(self):
+        self._server = self.Server(("localhost", 0), self.Handler)
+        self._server_thread = threading.Thread(target=self._server.serve_forever)
+        self._server_thread.daemon = True
+        self._server_thread.start()
+        self._url = "http://localhost:%s" % self._server.server_port
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def run_requests(self, loop, client, requests, cancel_after=None):
+        results = {}
+        def callback(name):
+            def f(status, headers, content, error):
+                results[name] = (status, content, error)
+                if len(results) == len(requests):
+                    loop.stop()
+            return f
+        for name, path, body in requests:
+            exchange = client.request(self._url + path, "POST", {}, body, callback(name))
+            if cancel_after is not None:
+                loop.call_later(cancel_after, exchange.cancel)
+        loop.run_forever()
+        return results
+
+    def testRequests(self):
+        loop = EventLoop()
+        client = AsyncHttpClient(loop, max_per_host=2, timeout=10)
+        requests = [(i, "/echo", "data%s" % i) for i in range(10)] + \
+                   [("chunked", "/chunked", "chunked")]
+        results = self.run_requests(loop, client, requests)
+        for i in range(10):
+            self.assertEquals(results[i], (200, "data%s" % i, None))
+        self.assertEquals(results["chunked"], (200, "chunked", None))
+        stats = client.get_stats()
+        self.assertEquals((stats["opened"], stats["reused"], stats["idle"]), (2, 9, 2))
+
+        results = self.run_requests(loop, client, [("slow", "/slow", "slow")],
+                                    cancel_after=0.05)
+        self.assertTrue(isinstance(results["slow"][2], HttpCancelledError))
+        client.clear()
+
+
+class TestSummedUpCache(unittest.TestCase):
+    class FakeMis(object):
+        api_url = "http://localhost/mis1/"
+        api_key = ""
+        name = "mis1"
+        multiple_starts_and_arrivals = True
+
+    def setUp(self):
+        MisApi.configure_summed_up_cache(100, 60, 60)
+
+    def tearDown(self):
+        MisApi.configure_summed_up_cache(MisApi.SUMMED_UP_CACHE_SIZE,
+                                         MisApi.SUMMED_UP_CACHE_TTL,
+                                         MisApi.SUMMED_UP_CACHE_TIME_BUCKET)
+
+    def new_call(self, departure_time, departures, modes=None):
+        request = SummedUpItinerariesRequestType()
+        request.departures = [TraceStop(PlaceTypeId=x) for x in departures]
+        request.arrivals = [TraceStop(PlaceTypeId="arrival")]
+        request.DepartureTime = departure_time
+        request.modes = modes or []
+        return MisApi(self.FakeMis()).summed_up_itineraries_call(request)
+
+    def testCache(self):
+        call = self.new_call(datetime(2014, 1, 1, 8, 0, 10), ["1", "2"])
+        self.assertEquals(call.get_cached_response(), None)
+        call.cache_response(200, "content")
+        # Same time bucket, same stops in a different order
+        call = self.new_call(datetime(2014, 1, 1, 8, 0, 50), ["2", "1", "2"])
+        self.assertEquals(call.get_cached_response(), "content")
+        # Other time bucket, other stops, other modes
+        self.assertEquals(self.new_call(datetime(2014, 1, 1, 8, 1, 0), ["1", "2"]) \
+                              .get_cached_response(), None)
+        self.assertEquals(self.new_call(datetime(2014, 1, 1, 8, 0, 10), ["1"]) \
+                              .get_cached_response(), None)
+        self.assertEquals(self.new_call(datetime(2014, 1, 1, 8, 0, 10), ["1", "2"], ["BUS"]) \
+                              .get_cached_response(), None)
+        # Failed responses are not cached.
+        call = self.new_call(datetime(2014, 1, 1, 9, 0, 0), ["1"])
+        call.cache_response(500, "error")
+        self.assertEquals(call.get_cached_response(), None)
+
+        stats = MisApi.get_summed_up_cache_stats()
+        self.assertEquals((stats["hits"], stats["size"]), (1, 1))
+        self.assertEquals(MisApi.purge_summed_up_cache("mis2"), 0)
+        self.assertEquals(MisApi.purge_summed_up_cache("mis1"), 1)
+
+    def _trip(self, departure, departure_time, arrival, arrival_time):
+        return SummedUpTripType(
+                    Departure=EndPointType(TripStopPlace=TripStopPlaceType(id=departure),
+                                           DateTime=departure_time),
+                    Arrival=EndPointType(TripStopPlace=TripStopPlaceType(id=arrival),
+                                         DateTime=arrival_time))
+
+    def testTimeBucket(self):
+        t = lambda m, s: datetime(2014, 1, 1, 8, m, s)
+        # Responses of the MIS, by requested time.
+        trips = {t(0, 0) : [("A", t(0, 10), "B", t(30, 0)), ("A", t(2, 0), "C", t(40, 0))],
+                 t(0, 45) : [("A", t(1, 0), "B", t(31, 0)), ("A", t(2, 0), "C", t(40, 0))],
+                 t(0, 59) : [("A", t(0, 5), "B", t(0, 50)), ("C", t(0, 0), "B", t(0, 58)),
+                             ("C", t(0, 0), "B", t(0, 40))]}
+        sent = [] # [(requested time, cached)]
+
+        def execute(call):
+            data = json.loads(call.body)
+            date_time = parse_datetime(data.get("DepartureTime", None) or data["ArrivalTime"])
+            if call.get_cached_response() is None:
+                sent.append((date_time, call._cache is not None))
+                call.cache_response(200, "")
+            ret = SummedUpItinerariesResponseType()
+            ret.summedUpTrips = [self._trip(*x) for x in trips[date_time]]
+            return ret
+
+        def get_trips(departure_time, arrival_time=None, access_time=0):
+            request = SummedUpItinerariesRequestType()
+            request.departures = [TraceStop(PlaceTypeId="A",
+                                            AccessTime=timedelta(seconds=access_time))]
+            request.arrivals = [TraceStop(PlaceTypeId=x, AccessTime=timedelta())
+                                for x in ["B", "C"]]
+            if arrival_time:
+                request.departures.append(TraceStop(PlaceTypeId="C",
+                                                    AccessTime=timedelta()))
+                request.arrivals = request.arrivals[:1]
+            request.DepartureTime = departure_time
+            request.ArrivalTime = arrival_time
+            resp = run_sync(MisApi(self.FakeMis()).summed_up_itineraries(request), execute)
+            return [(x.Departure.TripStopPlace.id, x.Departure.DateTime,
+                     x.Arrival.TripStopPlace.id, x.Arrival.DateTime)
+                    for x in resp.summedUpTrips]
+
+        # The MIS is asked for the beginning of the time bucket. A trip leaves
+        # before the requested time, the MIS is asked again.
+        self.assertEquals(get_trips(t(0, 45)), trips[t(0, 45)])
+        self.assertEquals(sent, [(t(0, 0), True), (t(0, 45), False)])
+        # Cached trips are valid.
+        self.assertEquals(get_trips(t(0, 5)), trips[t(0, 0)])
+        self.assertEquals(len(sent), 2)
+        # Access time of the departure stop is taken into account.
+        get_trips(t(0, 0), access_time=45)
+        self.assertEquals(sent[2:], [(t(0, 0), True), (t(0, 0), False)])
+
+        # Arrival time: end of the time bucket. A trip arriving after the
+        # requested time is removed, every pair still has a trip.
+        self.assertEquals(get_trips(None, t(0, 55)),
+                          [trips[t(0, 59)][0], trips[t(0, 59)][2]])
+        self.assertEquals(sent[4:], [(t(0, 59), True)])
+
+
+class TestMisTopologyCache(unittest.TestCase):
+    def setUp(self):
+        self._generation = 1
+        self._on_load = None
+        self._functions = mis_topology.get_import_generation, mis_topology.load_topology
+        mis_topology.get_import_generation = lambda db_session: self._generation
+        mis_topology.load_topology = self._load_topology
+        MisApi.configure_summed_up_cache(100, 60, 60)
+
+    def tearDown(self):
+        mis_topology.get_import_generation, mis_topology.load_topology = self._functions
+        MisApi.configure_summed_up_cache(MisApi.SUMMED_UP_CACHE_SIZE,
+                                         MisApi.SUMMED_UP_CACHE_TTL,
+                                         MisApi.SUMMED_UP_CACHE_TIME_BUCKET)
+
+    def _load_topology(self, db_session, generation):
+        if self._on_load:
+            self._on_load()
+        mis = MisInfo(1, "mis1", "http://localhost/mis1/", "", None, None, True, True,
+                      frozenset(["bus"]))
+        return MisTopology(generation, {1 : mis}, {})
+
+    def testReload(self):
+        reloads = []
+        cache = MisTopologyCache(on_reload=lambda *args: reloads.append(args))
+        cache.CHECK_INTERVAL = 0
+        topology = cache.get(None)
+        self.assertTrue(cache.get(None) is topology)
+        self.assertEquals(reloads, [])
+        self._generation = 2
+        new_topology = cache.get(None)
+        self.assertEquals(new_topology.generation, 2)
+        self.assertEquals(reloads, [(topology, new_topology)])
+
+    def testUnknownMis(self):
+        topology = MisTopologyCache().get(None)
+        self.assertEquals(topology.get_mis(1).name, "mis1")
+        self.assertEquals(topology.get_mis_modes(1), frozenset(["bus"]))
+        self.assertEquals(topology.get_mis(2), None)
+        self.assertEquals(topology.get_mis_modes(2), frozenset())
+
+    def testLoadOutsideLock(self):
+        cache = MisTopologyCache()
+        cache.CHECK_INTERVAL = 0
+        topology = cache.get(None)
+        def on_load():
+            self.assertTrue(cache._lock.acquire(False))
+            cache._lock.release()
+            # Meanwhile, other threads are served the current snapshot.
+            cache.CHECK_INTERVAL = 60
+            self.assertTrue(cache.get(None) is topology)
+        self._on_load = on_load
+        self._generation = 2
+        self.assertEquals(cache.get(None).generation, 2)
+
+    def testConcurrentReloads(self):
+        cache = MisTopologyCache()
+        cache.CHECK_INTERVAL = 0
+        cache.get(None)
+        def on_load():
+            # Another thread loads a newer import while generation 2 is loaded.
+            self._on_load = None
+            self._generation = 3
+            self.assertEquals(cache.get(None).generation, 3)
+        self._on_load = on_load
+        self._generation = 2
+        self.assertEquals(cache.get(None).generation, 3)
+        self.assertEquals(cache.get_stats()[1], 2)
+
+    def testPurgeSummedUpCache(self):
+        MisApi.summed_up_cache.put(("mis1", 1), "")
+        MisApi.summed_up_cache.put(("mis2", 1), "")
+        cache = MisTopologyCache(on_reload=on_topology_reload)
+        cache.CHECK_INTERVAL = 0
+        cache.get(None)
+        self.assertEquals(len(MisApi.summed_up_cache), 2)
+        self._generation = 2
+        cache.get(None)
+        self.assertEquals(MisApi.summed_up_cache.get(("mis1", 1)), None)
+        self.assertEquals(MisApi.summed_up_cache.get(("mis2", 1)), "")
+
+
+class TestNotificationThread(unittest.TestCase):
+    class FakeStream(object):
+        def __init__(self):
+            self.messages = []
+
+        def send_message(self, msg, binary=False):
+            self.messages.append(json.loads(msg))
+
+    class FakeConnection(object):
+        def __init__(self, ws_stream):
+            self.ws_stream = ws_stream
+
+    def setUp(self):
+        self._stream = self.FakeStream()
+        self._queue = Queue.Queue()
+        self._thread = NotificationThread(self.FakeConnection(self._stream), self._queue)
+        self._thread.start()
+
+    def tearDown(self):
+        self._thread.stop()
+        self._thread.join()
+
+    def _existence(self, request_id):
+        self._queue.put(PlanTripExistenceNotificationResponseType(RequestId=request_id))
+
+    def _notification(self, request_id):
+        self._queue.put(PlanTripNotificationResponseType(RequestId=request_id))
+
+    def _ending(self, request_id):
+        self._queue.put(EndingSearch(RequestId=request_id, MaxComposedTripSearched=0,
+                                     Status=PlanTripStatusEnum.OK))
+
+    # Return {request id : EndingSearch content} of sent EndingSearch messages.
+    def _endings(self):
+        self._queue.join()
+        return dict([(x["EndingSearch"]["RequestId"], x["EndingSearch"])
+                     for x in self._stream.messages if "EndingSearch" in x])
+
+    def _counts(self, ending):
+        return ending["ExistenceNotificationsSent"], ending["NotificationsSent"]
+
+    def testInterleavedRequests(self):
+        self._thread.add_request("r1")
+        self._thread.add_request("r2")
+        self._existence("r1")
+        self._notification("r2")
+        self._existence("r2")
+        self._existence("r1")
+        self._ending("r2")
+        self._notification("r1")
+        self._existence("r1")
+        self._ending("r1")
+        endings = self._endings()
+        self.assertEquals(self._counts(endings["r1"]), (3, 1))
+        self.assertEquals(self._counts(endings["r2"]), (1, 1))
+        self.assertEquals(self._thread._requests, {})
+
+    def testRejectDuplicate(self):
+        self._thread.add_request("r1")
+        self._existence("r1")
+        self._notification("r1")
+        self._queue.join()
+        self._thread._requests["r1"][0] -= timedelta(minutes=1)
+        # Another request with the same clientRequestId is rejected while
+        # r1 is running.
+        self._queue.put(UntrackedNotification(
+            PlanTripResponse(clientRequestId="r1", Status=PlanTripStatusEnum.BAD_REQUEST)))
+        self._existence("r1")
+        self._ending("r1")
+        endings = self._endings()
+        self.assertEquals(self._stream.messages[2]["PlanTripResponse"]["Status"],
+                          PlanTripStatusEnum.BAD_REQUEST)
+        self.assertEquals(self._counts(endings["r1"]), (2, 1))
+        self.assertTrue(xsd_duration_to_timedelta(endings["r1"]["Runtime"])
+                        >= timedelta(minutes=1))
+
+    def testCancellation(self):
+        self._thread.add_request("r1")
+        self._thread.add_request("r2")
+        self._existence("r1")
+        self._existence("r2")
+        self._queue.put(PlanTripCancellationResponse(RequestId="r1"))
+        # Trace computed before the cancellation took effect.
+        self._existence("r1")
+        self._queue.join()
+        self.assertEquals(self._thread._requests.keys(), ["r2"])
+        self.assertEquals(len(self._stream.messages), 3)
+        # A new request may reuse the id of the cancelled one.
+        self._thread.add_request("r1")
+        self._notification("r1")
+        self._ending("r1")
+        self._ending("r2")
+        endings = self._endings()
+        self.assertEquals(self._counts(endings["r1"]), (0, 1))
+        self.assertEquals(self._counts(endings["r2"]), (1, 0))
+
+
+    def testUnknownRequest(self):
+        self._existence("r1")
+        self._notification("r1")
+        self._ending("r1")
+        self._queue.join()
+        self.assertEquals(self._stream.messages, [])
+        self.assertEquals(self._thread._requests, {})
+
+
+class TestGeo(unittest.TestCase):
+    def testParseWktPolygon(self):
+        polygon = parse_wkt_polygon("POLYGON((0 0, 0 10, 10 10, 10 0, 0 0), "
+                                    "(4 4, 4 6, 6 6, 6 4, 4 4))")
+        self.assertEquals(len(polygon), 2)
+        self.assertEquals(polygon[0], [(0, 0), (0, 10), (10, 10), (10, 0), (0, 0)])
+        self.assertRaises(ValueError, parse_wkt_polygon, "POINT(1 2)")
+        self.assertRaises(ValueError, parse_wkt_polygon, "POLYGON((0 0, 1 1, 0 0))")
+
+    def testPolygonContains(self):
+        polygon = parse_wkt_polygon("POLYGON((0 0, 0 10, 10 10, 10 0, 0 0), "
+                                    "(4 4, 4 6, 6 6, 6 4, 4 4))")
+        self.assertTrue(polygon_contains(polygon, 2, 2))
+        self.assertFalse(polygon_contains(polygon, 5, 5)) # In hole
+        self.assertFalse(polygon_contains(polygon, 11, 2))
+        self.assertFalse(polygon_contains(polygon, 2, -1))
+
+    def testGreatCircleEdges(self):
+        # Same polygon as paysdelaloire shape. Its northern edge is a great
+        # circle arc, which goes north of 48.568 between both corners.
+        polygon = parse_wkt_polygon(
+                    "POLYGON((-2.557442956 46.26975161,-2.557442956 48.56805252," \
+                    "0.915342221 48.56805252,0.915342221 46.26975161,-2.557442956 46.26975161))")
+        self.assertTrue(polygon_contains(polygon, -1.55, 47.21))
+        self.assertTrue(polygon_contains(polygon, -0.82, 48.58))
+        self.assertFalse(polygon_contains(polygon, -0.82, 48.59))
+        self.assertFalse(polygon_contains(polygon, -1, 46.28))
+
+    def testHaversine(self):
+        self.assertEquals(haversine(2.35, 48.85, 2.35, 48.85), 0)
+        # Paris - London
+        self.assertAlmostEquals(haversine(2.3522, 48.8566, -0.1276, 51.5072) / 1000, 343.9, 0)
+        # 1 degree along the equator
+        self.assertAlmostEquals(haversine(0, 0, 1, 0), 111195, -1)
+
+
+class TestTraceState(unittest.TestCase):
+    def _stop_sets(self):
+        # a1 -> b1, a1 -> b2, a2 -> b3
+        return new_transfer_stop_sets(
+                    ([timedelta(minutes=x) for x in [1, 2, 3]],
+                     [TraceStop(PlaceTypeId=x) for x in ["a1", "a1", "a2"]],
+                     [TraceStop(PlaceTypeId=x) for x in ["b1", "b2", "b3"]]))
+
+    def testRemove(self):
+        side1, side2 = self._stop_sets()
+        self.assertEquals(side1.indexes("a1"), [0, 1])
+        self.assertEquals((len(side1), len(side2)), (3, 3))
+        side2.remove(1)
+        side2.remove(1)
+        self.assertEquals(side1.indexes("a1"), [0])
+        self.assertEquals([x.PlaceTypeId for x in side1.live_stops()], ["a1", "a2"])
+        self.assertEquals([x.PlaceTypeId for x in side2.live_stops()], ["b1", "b3"])
+        self.assertEquals((len(side1), len(side2)), (2, 2))
+
+    def testUpdateTimes(self):
+        side1, side2 = self._stop_sets()
+        t = datetime(2014, 6, 1, 8, 0)
+        removed = side1.update_times(side1.arrival_times, {"a1" : t})
+        self.assertEquals([x.PlaceTypeId for x in removed], ["a2"])
+        self.assertEquals([x.PlaceTypeId for x in side2.live_stops()], ["b1", "b2"])
+        side1.propagate_arrival_times()
+        self.assertEquals(side2.arrival_times[:2], [t + timedelta(minutes=1),
+                                                    t + timedelta(minutes=2)])
+        self.assertEquals(side2.min_time(side2.arrival_times), t + timedelta(minutes=1))
+        side2.set_access_times(side2.arrival_times, t)
+        self.assertEquals(side2.stops[1].AccessTime, timedelta(minutes=2))
+        side2.departure_times[:2] = [t, t]
+        side2.propagate_departure_times()
+        self.assertEquals(side1.departure_times, [t - timedelta(minutes=1),
+                                                  t - timedelta(minutes=2), None])
+        side1.update_times(side1.arrival_times, {})
+        self.assertEquals((len(side1), len(side2)), (0, 0))
+
+    def testUnlinked(self):
+        stops = StopSet([TraceStop(PlaceTypeId="departure")])
+        self.assertEquals(stops.linked, None)
+        self.assertEquals(stops.indexes("departure"), [0])
+        self.assertEquals(len(stops), 1)
+
+
+class TestTraceRanking(unittest.TestCase):
+    class EndPoint(object):
+        def __init__(self, date_time):
+            self.DateTime = date_time
+
+    class Trip(object):
+        def __init__(self, departure_time, arrival_time):
+            self.Departure = TestTraceRanking.EndPoint(departure_time)
+            self.Arrival = TestTraceRanking.EndPoint(arrival_time)
+
+    def testMaxSpeed(self):
+        self.assertEquals(max_speed(["BUS", "METRO"]), MAX_SPEEDS["BUS"])
+        self.assertEquals(max_speed(["BUS", "ALL"]), max(MAX_SPEEDS.values()))
+        self.assertEquals(max_speed([]), max(MAX_SPEEDS.values()))
+
+    def testTraceLowerBound(self):
+        departure = (0, 0)
+        arrival = (2, 0)
+        speed = 100
+        # Single MIS: straight line
+        bound = trace_lower_bound(departure, arrival, [speed], [])
+        self.assertAlmostEquals(bound.total_seconds(), 0.99 * haversine(0, 0, 2, 0) / speed, 3)
+
+        # Best gateway is on the way, transfer duration is added.
+        hops = [[((1, 1), (1, 1), 60), ((1, 0), (1, 0.001), 30)]]
+        bound = trace_lower_bound(departure, arrival, [speed, speed], hops)
+        expected = 0.99 * (haversine(0, 0, 1, 0) + haversine(1, 0.001, 2, 0)) / speed + 30
+        self.assertAlmostEquals(bound.total_seconds(), expected, 3)
+        # Never longer than the actual shortest path
+        self.assertTrue(bound.total_seconds() <= \
+                        (haversine(0, 0, 1, 0) + haversine(1, 0.001, 2, 0)) / speed + 30)
+
+        # No transfer between MIS
+        self.assertEquals(trace_lower_bound(departure, arrival, [speed, speed], [[]]), None)
+
+    def testRankTransfers(self):
+        departure = (0, 0)
+        arrival = (2, 0)
+        on_the_way = TransferInfo(120, StopInfo("a", 0, 1), StopInfo("b", 0.001, 1))
+        far_away = TransferInfo(60, StopInfo("c", 1, 1), StopInfo("d", 1, 1))
+        behind = TransferInfo(60, StopInfo("e", 0, -1), StopInfo("f", 0, -1))
+        quick = TransferInfo(0, StopInfo("g", 0, 1), StopInfo("h", 0, 1))
+        transfers = (far_away, behind, on_the_way, quick)
+        self.assertEquals(rank_transfers(transfers, departure, arrival, 2),
+                          (quick, on_the_way))
+        self.assertEquals(rank_transfers(transfers, departure, arrival, 3),
+                          (quick, on_the_way, far_away))
+        # Nothing to choose from
+        self.assertEquals(rank_transfers(transfers, departure, arrival, 4), transfers)
+
+    def testPruning(self):
+        params = PlanTripRequestType()
+        params.DepartureTime = datetime(2014, 1, 1, 8, 0)
+        params.clientRequestId = "r1"
+        lower_bounds = {(1,) : timedelta(minutes=10),
+                        (1, 2) : timedelta(minutes=30),
+                        (1, 3) : timedelta(minutes=50),
+                        (1, 4) : None}
+        group = JobGroup(params, [[1, 2], [1, 3], [1, 4]], Queue.Queue(), 1,
+                         TracePruner(lower_bounds, min_trips=2))
+        trip1 = [(None, self.Trip(datetime(2014, 1, 1, 8, 5), datetime(2014, 1, 1, 8, 20)))]
+        trip2 = [(None, self.Trip(datetime(2014, 1, 1, 8, 10), datetime(2014, 1, 1, 8, 40)))]
+        group.add_trip(trip1)
+        self.assertEquals((list(group.pending), group.pruned), ([[1, 2], [1, 3], [1, 4]], 0))
+        # 2 trips arrive before 08:50, [1, 3] cannot beat them.
+        group.add_trip(trip2)
+        self.assertEquals((list(group.pending), group.pruned), ([[1, 2], [1, 4]], 1))
+
+        # "Arrival at" requests compare departure times.
+        params.DepartureTime = None
+        params.ArrivalTime = datetime(2014, 1, 1, 8, 55)
+        pruner = TracePruner(lower_bounds, min_trips=1)
+        group = JobGroup(params, [[1], [1, 2], [1, 3]], Queue.Queue(), 1, pruner)
+        group.add_trip(trip2) # Departs 45 minutes before arrival time
+        self.assertEquals(list(group.pending), [[1], [1, 2]])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -76,5 +76,7 @@ INSERT INTO mis_mode (mis_id, mode_id) VALUES
     (5,2),
     (5,3);
 
+REFRESH MATERIALIZED VIEW transfer_mis;
+
 COMMIT;
 \q
@@ -61,7 +61,26 @@ def receive_msg(connection):
     return ret
 
 
-init_logging()
+def send_request(connection, request):
+    connection.send(json.dumps({"PlanTripRequestType" : marshal(request, plan_trip_request_type)}))
+
+
+# Validate message against its JSON schema, return message type.
+def validate_msg(msg):
+    for msg_type, schema in MSG_FORMATS:
+        if msg_type in msg:
+            validate(msg[msg_type], schema)
+            return msg_type
+    raise Exception("FAIL: Unexpected message: %s" % msg)
+
+
+MSG_FORMATS = [("PlanTripResponse", formats.plan_trip_response_format),
+               ("StartingSearch", formats.starting_search_format),
+               ("PlanTripExistenceNotificationResponseType",
+                formats.plan_trip_existence_notification_format),
+               ("PlanTripNotificationResponseType",
+                formats.plan_trip_notification_response_format),
+               ("EndingSearch", formats.ending_search_format)]
 
 Draft4Validator.check_schema(formats.ending_search_format)
 Draft4Validator.check_schema(formats.starting_search_format)
@@ -82,8 +101,6 @@ Draft4Validator.check_schema(formats.partial_trip_format)
 Draft4Validator.check_schema(formats.composed_trip_format)
 Draft4Validator.check_schema(formats.plan_trip_notification_response_format)
 
-ws = create_connection("ws://localhost/planner")
-
 # Below are some examples of itinerary requests.
 
 # req = new_request(
@@ -160,33 +177,37 @@ ws = create_connection("ws://localhost/planner")
 #         new_location(None, -1.547050, 47.213300))
 
 # Set DepartureTime = datetime.datetime(year=2014, month=8, day=22, hour=14) - timedelta(days=50)
-req = new_request(
+DEFAULT_DEPARTURE = new_location(
         # "gare de Pontchaillou (Rennes)"
         # "stop_area:SNC:SA:SAOCE87471391"
-        new_location(None, -1.68187574, 48.11165251),
+        None, -1.68187574, 48.11165251)
+DEFAULT_ARRIVAL = new_location(
         # "Le mans"
-        new_location(None, 0.195172, 48.005432))
+        None, 0.195172, 48.005432)
 
 
-ws.send(json.dumps({"PlanTripRequestType" : marshal(req, plan_trip_request_type)}))
+def main():
+    init_logging()
+    ws = create_connection("ws://localhost/planner")
+    req = new_request(DEFAULT_DEPARTURE, DEFAULT_ARRIVAL)
+    send_request(ws, req)
 
-msg = receive_msg(ws)
-validate(msg["PlanTripResponse"], formats.plan_trip_response_format)
-msg = receive_msg(ws)
-validate(msg["StartingSearch"], formats.starting_search_format)
-while True:
     msg = receive_msg(ws)
-    if "PlanTripExistenceNotificationResponseType" in msg:
-        validate(msg["PlanTripExistenceNotificationResponseType"],
-                 formats.plan_trip_existence_notification_format)
-    elif "PlanTripNotificationResponseType" in msg:
-        validate(msg["PlanTripNotificationResponseType"],
-                 formats.plan_trip_notification_response_format)
-    elif "EndingSearch" in msg:
-        validate(msg["EndingSearch"], formats.ending_search_format)
-        ws.close()
-        break
-    else:
-        raise Exception("FAIL: Unexpected message: %s" % msg)
-
-logging.info("SUCCESS")
+    validate(msg["PlanTripResponse"], formats.plan_trip_response_format)
+    msg = receive_msg(ws)
+    validate(msg["StartingSearch"], formats.starting_search_format)
+    while True:
+        msg = receive_msg(ws)
+        msg_type = validate_msg(msg)
+        if msg_type == "EndingSearch":
+            ws.close()
+            break
+        elif msg_type not in ["PlanTripExistenceNotificationResponseType",
+                              "PlanTripNotificationResponseType"]:
+            raise Exception("FAIL: Unexpected message: %s" % msg)
+
+    logging.info("SUCCESS")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+# -*- coding: utf8 -*-
+
+"""
+    Load generator for the planner websocket endpoint, built on planner_client.
+
+    PlanTrip requests are started at a target rate (open loop) and sent over
+    at most --sessions concurrent websocket connections, one connection per
+    request as the planner closes it once the request is finished. Departure
+    and arrival points are sampled from an OD file.
+
+    For each request, the time to the PlanTripResponse, to the first existence
+    notification, to the first full notification and to the EndingSearch are
+    recorded. Times are measured from the moment the request was scheduled,
+    so that time spent waiting for a free session is accounted for when the
+    planner cannot keep up with the target rate. With a rate of 0, sessions
+    send requests back to back and times are measured from the moment a
+    session picks the request.
+
+    OD file: one "departure_longitude departure_latitude arrival_longitude
+    arrival_latitude" line per OD pair (commas are accepted as separators,
+    lines starting with # are ignored).
+"""
+from websocket import create_connection, WebSocketTimeoutException
+from planner_client import new_location, new_request, receive_msg, send_request, \
+                           validate_msg, DEFAULT_DEPARTURE, DEFAULT_ARRIVAL
+from apiisim.common import PlanTripStatusEnum
+from apiisim.common.metrics import Histogram, monotonic
+from datetime import datetime, timedelta
+from random import Random
+import argparse, logging, Queue, sys, threading, time
+
+
+MILESTONES = ["PlanTripResponse", "FirstExistenceNotification",
+              "FirstNotification", "EndingSearch"]
+
+
+def get_cmd_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="ws://localhost/planner")
+    parser.add_argument("--od-file", default="",
+                        help="File of OD pairs to sample from, planner_client "
+                             "default request if not given")
+    parser.add_argument("--sessions", type=int, default=10,
+                        help="Maximum number of concurrent websocket sessions")
+    parser.add_argument("--rate", type=float, default=1,
+                        help="Target number of requests started per second, 0 to "
+                             "start a request as soon as a session is free")
+    parser.add_argument("--requests", type=int, default=100,
+                        help="Total number of requests")
+    parser.add_argument("--timeout", type=float, default=120,
+                        help="Maximum duration of a request, in seconds")
+    parser.add_argument("--max-trips", type=int, default=10)
+    parser.add_argument("--days-ago", type=int, default=10,
+                        help="Departure date, in days before today")
+    parser.add_argument("--no-validation", action="store_true",
+                        help="Do not validate messages against their JSON schemas")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true")
+
+    return parser.parse_args()
+
+
+def load_od_pairs(od_file):
+    if not od_file:
+        return [(DEFAULT_DEPARTURE, DEFAULT_ARRIVAL)]
+    ret = []
+    with open(od_file) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            values = [float(x) for x in line.replace(",", " ").split()]
+            if len(values) != 4:
+                raise Exception("Invalid OD line: %s" % line)
+            ret.append((new_location(None, values[0], values[1]),
+                        new_location(None, values[2], values[3])))
+    if not ret:
+        raise Exception("No OD pair in %s" % od_file)
+    return ret
+
+
+class Stats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = dict((x, Histogram()) for x in MILESTONES)
+        self.started = 0
+        self.succeeded = 0
+        self.errors = {} # {error type : count}
+
+    def add(self, milestones, error):
+        with self._lock:
+            self.started += 1
+            for name, value in milestones.items():
+                self.latencies[name].add(value)
+            if error is None:
+                self.succeeded += 1
+            else:
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+
+"""
+    Send one PlanTrip request, return ({milestone : seconds since
+    scheduled_time}, error type or None).
+"""
+def run_request(args, request, scheduled_time):
+    milestones = {}
+    ws = None
+    try:
+        ws = create_connection(args.url, timeout=args.timeout)
+        send_request(ws, request)
+        deadline = scheduled_time + args.timeout
+        while True:
+            ws.settimeout(max(0.001, deadline - monotonic()))
+            msg = receive_msg(ws)
+            elapsed = monotonic() - scheduled_time
+            msg_type = validate_msg(msg) if not args.no_validation else msg.keys()[0]
+            if msg_type == "PlanTripResponse":
+                milestones["PlanTripResponse"] = elapsed
+                if msg["PlanTripResponse"]["Status"] != PlanTripStatusEnum.OK:
+                    return milestones, "status_%s" % msg["PlanTripResponse"]["Status"]
+            elif msg_type == "PlanTripExistenceNotificationResponseType":
+                milestones.setdefault("FirstExistenceNotification", elapsed)
+            elif msg_type == "PlanTripNotificationResponseType":
+                milestones.setdefault("FirstNotification", elapsed)
+            elif msg_type == "EndingSearch":
+                milestones["EndingSearch"] = elapsed
+                return milestones, None
+    except WebSocketTimeoutException:
+        return milestones, "timeout"
+    except Exception as e:
+        logging.debug("Request %s failed: %s", request.clientRequestId, e)
+        if "PlanTripResponse" not in milestones:
+            return milestones, "connection"
+        return milestones, "protocol"
+    finally:
+        if ws is not None:
+            ws.close()
+
+
+def session_loop(args, jobs, stats):
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        request, scheduled_time = job
+        if scheduled_time is None:
+            scheduled_time = monotonic()
+        milestones, error = run_request(args, request, scheduled_time)
+        stats.add(milestones, error)
+
+
+def _ms(value):
+    return "%.0f" % (value * 1000) if value is not None else "-"
+
+
+def print_stats(stats, duration):
+    print "%d requests in %.1fs (%.2f req/s), %d succeeded, error rate %.1f%%" % \
+          (stats.started, duration, stats.started / duration, stats.succeeded,
+           100.0 * (stats.started - stats.succeeded) / (stats.started or 1))
+    for error, count in sorted(stats.errors.items()):
+        print "    %s: %d (%.1f%%)" % (error, count, 100.0 * count / stats.started)
+    print "%28s %7s %9s %9s %9s %9s" % ("TIME TO", "COUNT", "P50 (ms)", "P95 (ms)",
+                                         "P99 (ms)", "MAX (ms)")
+    for name in MILESTONES:
+        x = stats.latencies[name]
+        print "%28s %7s %9s %9s %9s %9s" % (name, x.count, _ms(x.percentile(50)),
+                                             _ms(x.percentile(95)),
+                                             _ms(x.percentile(99)), _ms(x.max))
+
+
+def run(args):
+    rand = Random(args.seed)
+    od_pairs = load_od_pairs(args.od_file)
+    stats = Stats()
+    jobs = Queue.Queue()
+    sessions = [threading.Thread(target=session_loop, args=(args, jobs, stats))
+                for _ in range(max(1, args.sessions))]
+    for t in sessions:
+        t.daemon = True
+        t.start()
+
+    start = monotonic()
+    for i in range(args.requests):
+        scheduled_time = None # Closed loop, measured once a session is free
+        if args.rate > 0:
+            scheduled_time = start + i / args.rate
+            delay = scheduled_time - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        departure, arrival = rand.choice(od_pairs)
+        request = new_request(departure, arrival)
+        request.clientRequestId = "load_%s" % i
+        request.MaxTrips = args.max_trips
+        request.DepartureTime = datetime.now() - timedelta(days=args.days_ago)
+        jobs.put((request, scheduled_time))
+    for _ in sessions:
+        jobs.put(None)
+    for t in sessions:
+        t.join()
+
+    print_stats(stats, monotonic() - start)
+
+
+if __name__ == '__main__':
+    args = get_cmd_args()
+    logging.basicConfig(stream=sys.stdout,
+                        level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format='%(asctime)s [%(levelname)s] %(message)s')
+    run(args)